@@ -0,0 +1,76 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# Micro-benchmark of the per channel sky statistics:
+# the four strided region_stats() calls against the single pass cfa_stats() kernel
+#
+# Usage: python bench/bayer_stats.py [--width 500 --height 400 --repeat 50]
+
+#--------------------
+# System wide imports
+# -------------------
+
+import argparse
+import timeit
+
+# -------------------
+# Third party imports
+# -------------------
+
+import numpy as np
+
+#--------------
+# local imports
+# -------------
+
+from azotea.utils.sky import region_stats, all_channels_stats
+
+# ----------------
+# Module constants
+# ----------------
+
+FRAME_SHAPE = (4000, 6000)  # Raw pixels of a 24 MP sensor
+CHANNELS    = ('R', 'G1', 'G2', 'B')
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def createParser():
+    parser = argparse.ArgumentParser(description='Bayer statistics micro-benchmark')
+    parser.add_argument('--width',  type=int, default=500, help='Debayered ROI width')
+    parser.add_argument('--height', type=int, default=400, help='Debayered ROI height')
+    parser.add_argument('--repeat', type=int, default=50,  help='Number of repetitions')
+    parser.add_argument('--dtype',  choices=('uint16','float32'), default='uint16', help='Pixel data type')
+    return parser
+
+
+def strided_stats(raw_pixels, roi):
+    return [region_stats(raw_pixels, 'RGGB', channel, roi) for channel in CHANNELS]
+
+
+def kernel_stats(raw_pixels, roi):
+    return all_channels_stats(raw_pixels, 'RGGB', roi, dict())
+
+
+def main():
+    options = createParser().parse_args()
+    rng = np.random.default_rng(1)
+    raw_pixels = rng.normal(2048, 50, FRAME_SHAPE).astype(options.dtype)
+    x1 = (FRAME_SHAPE[1]//2 - options.width)//2
+    y1 = (FRAME_SHAPE[0]//2 - options.height)//2
+    roi = {'x1': x1, 'x2': x1 + options.width, 'y1': y1, 'y2': y1 + options.height}
+    old = timeit.timeit(lambda: strided_stats(raw_pixels, roi), number=options.repeat) / options.repeat
+    new = timeit.timeit(lambda: kernel_stats(raw_pixels, roi),  number=options.repeat) / options.repeat
+    print(f"ROI {options.width}x{options.height} {options.dtype}")
+    print(f"region_stats() x 4 : {1000*old:8.3f} ms")
+    print(f"cfa_stats() kernel : {1000*new:8.3f} ms")
+    print(f"speedup            : {old/new:8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
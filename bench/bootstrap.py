@@ -0,0 +1,103 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# Startup benchmark of a new database: create_schema() with the set based
+# calendar scripts in sql/initial against the former date.sql made of one
+# INSERT statement per day, rendered here from the rows just created.
+# Also checks that both produce the very same date_t rows.
+#
+# Usage: python bench/bootstrap.py [--repeat 5]
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import time
+import sqlite3
+import argparse
+import tempfile
+import statistics
+
+#--------------
+# local imports
+# -------------
+
+from azotea import SQL_SCHEMA, SQL_INITIAL_DATA_DIR, SQL_UPDATES_DATA_DIR
+from azotea.utils.database import create_database, create_schema
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def createParser():
+    parser = argparse.ArgumentParser(description='New database startup benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of repetitions')
+    return parser
+
+
+def bootstrap(path):
+    '''Creates a new database the way DatabaseService does. Returns the elapsed time'''
+    t0 = time.perf_counter()
+    connection, _ = create_database(path)
+    create_schema(connection, SQL_SCHEMA, SQL_INITIAL_DATA_DIR, SQL_UPDATES_DATA_DIR)
+    elapsed = time.perf_counter() - t0
+    connection.close()
+    return elapsed
+
+
+def legacy_script(rows):
+    '''The former date.sql, one INSERT statement per day'''
+    lines = ['PRAGMA foreign_keys=OFF;', 'BEGIN TRANSACTION;']
+    for row in rows:
+        values = ','.join(f"'{value}'" if isinstance(value, str) else repr(value) for value in row)
+        lines.append(f"INSERT INTO date_t VALUES({values});")
+    lines.append('COMMIT;')
+    return '\n'.join(lines)
+
+
+def timed_script(path, script):
+    '''Runs a script on a new database with the bare schema. Returns the elapsed time'''
+    connection = sqlite3.connect(path)
+    with open(SQL_SCHEMA) as f:
+        connection.executescript(f.read())
+    t0 = time.perf_counter()
+    connection.executescript(script)
+    elapsed = time.perf_counter() - t0
+    connection.close()
+    return elapsed
+
+
+def date_rows(path):
+    connection = sqlite3.connect(path)
+    rows = connection.execute('SELECT * FROM date_t ORDER BY date_id').fetchall()
+    connection.close()
+    return rows
+
+
+def main():
+    options = createParser().parse_args()
+    with open(os.path.join(SQL_INITIAL_DATA_DIR, 'date.sql')) as f:
+        date_script = f.read()
+    full = list(); new = list(); old = list()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for i in range(options.repeat):
+            full.append(bootstrap(os.path.join(tmpdir, f"azotea-{i}.db")))
+        rows = date_rows(os.path.join(tmpdir, 'azotea-0.db'))
+        script = legacy_script(rows)
+        for i in range(options.repeat):
+            new.append(timed_script(os.path.join(tmpdir, f"new-{i}.db"), date_script))
+            old.append(timed_script(os.path.join(tmpdir, f"old-{i}.db"), script))
+        identical = date_rows(os.path.join(tmpdir, 'old-0.db')) == rows
+    print(f"date_t rows              : {len(rows)} ({'identical' if identical else 'DIFFERENT'})")
+    print(f"per row date.sql ({len(script)/1e6:.1f} MB): {1000*statistics.median(old):8.1f} ms")
+    print(f"set based date.sql       : {1000*statistics.median(new):8.1f} ms")
+    print(f"new database bootstrap   : {1000*statistics.median(full):8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -16,7 +16,8 @@ KEYWORDS     = ['Light Pollution','Astronomy']
 URL          = 'https://github.com/astrorafael/azotea-client/'
 DEPENDENCIES = [
     'numpy',      # Basic dependency
-    'twisted',    # Basic dependency
+    'twisted',    # Basic dependency (brings attrs, automat, constantly, hyperlink, incremental, typing_extensions)
+    'zope.interface', # Twisted interfaces, also used directly by the publishing HTTP body producer
     'treq',       # like requests, Twisted style 
     'pypubsub',   # Publish/Subscribe support Model/View/Controller
     'rawpy',      # Reads RAW faile formats (from libRaw)
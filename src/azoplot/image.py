@@ -11,14 +11,17 @@
 
 import os
 import glob
+import math
 import logging
+import datetime
 import traceback
 
+from fractions import Fraction
+
 # -------------------
 # Third party imports
 # -------------------
 
-import exifread
 import rawpy
 from astropy.io import fits
 
@@ -31,6 +34,7 @@ import matplotlib.patches as patches
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from matplotlib.colors import LogNorm
 from matplotlib.widgets import Button
+from matplotlib.ticker import FuncFormatter
 
 
 #--------------
@@ -42,10 +46,11 @@ from matplotlib.widgets import Button
 # -------------
 
 from azotea              import FITS_HEADER_TYPE, EXIF_HEADER_TYPE
-from azotea.utils.image  import scan_non_empty_dirs
+from azotea.utils.image  import scan_non_empty_dirs, IncorrectTimestampError
+from azotea.utils.header import exif_tags, fits_header
 from azotea.utils.camera import bayer_from_exif, BAYER_PTN_LIST
 from azotea.utils.roi    import Rect, Point
-from azotea.utils.sky    import get_debayered_for_channel
+from azotea.utils.sky    import get_debayered_for_channel, fits_unscaled_offset, all_channels_stats
 
 # ----------------
 # Module constants
@@ -144,44 +149,44 @@ def bayer_fits(header):
 
 def metadata_fits(filepath):
     metadata = dict()
-    with fits.open(filepath, memmap=False) as hdu_list:
-        header = hdu_list[0].header
-        metadata['header_type']  = FITS_HEADER_TYPE
-        metadata['filepath'] = filepath
-        metadata['bayer']    = bayer_fits(header)
-        metadata['height']   = header['NAXIS2']
-        metadata['width']    = header['NAXIS1']
-        metadata['model']    = header.get('INSTRUNE')
-        metadata['exptime']  = header.get('EXPTIME')
-        metadata['date_obs'] = header.get('DATE_OBS')
-        metadata['gain']     = header.get('LOG-GAIN')
-        metadata['iso']      = None
-        focal_length = header.get('FOCALLEN')
-        diameter     = header.get('APTDIA')
-        metadata['f_number']  = None  if focal_length is None and diameter is None else round(focal_length/diameter,1)
+    with open(filepath, 'rb') as f:
+        header = fits_header(f)
+    metadata['header_type']  = FITS_HEADER_TYPE
+    metadata['filepath'] = filepath
+    metadata['bayer']    = bayer_fits(header)
+    metadata['height']   = header['NAXIS2']
+    metadata['width']    = header['NAXIS1']
+    metadata['model']    = header.get('INSTRUME')
+    metadata['exptime']  = header.get('EXPTIME')
+    metadata['date_obs'] = header.get('DATE-OBS')
+    metadata['gain']     = header.get('LOG-GAIN')
+    metadata['iso']      = None
+    focal_length = header.get('FOCALLEN')
+    diameter     = header.get('APTDIA')
+    metadata['f_number']  = None  if focal_length is None and diameter is None else round(focal_length/diameter,1)
     return metadata
 
 
 def metadata_exif(filepath):
     metadata = dict()
     with open(filepath, 'rb') as f:
-        exif = exifread.process_file(f, details=False)
-        if not exif:
-            message = 'Could not open EXIF metadata'
-            raise ValueError(message)
-        metadata['header_type']  = EXIF_HEADER_TYPE
-        metadata['filepath']     = filepath
-        metadata['model']        = str(exif.get('Image Model', None)).strip()
-        metadata['iso']          = str(exif.get('EXIF ISOSpeedRatings', None))
-        metadata['focal_length'] = float(Fraction(str(exif.get('EXIF FocalLength', 0))))
-        metadata['f_number']     = float(Fraction(str(exif.get('EXIF FNumber', 0))))
-        metadata['exptime']      = float(Fraction(str(exif.get('EXIF ExposureTime', 0))))
-        metadata['date_id'], row['time_id'], row['widget_date'], row['widget_time'] = toDateTime(str(exif.get('Image DateTime', None)))
-        # Fixes missing Focal Length and F/ ratio
-        metadata['focal_length'] = 'Unknown' if row['focal_length'] == 0 else metadata['focal_length']
-        metadata['f_number']     = 'Unknown' if row['f_number']     == 0 else metadata['f_number']
-        # Fixed GAIN for EXIF DSLRs that provide ISO sensivity
-        metadata['gain'] = None
+        exif = exif_tags(f)
+    if not exif:
+        message = 'Could not open EXIF metadata'
+        raise ValueError(message)
+    metadata['header_type']  = EXIF_HEADER_TYPE
+    metadata['filepath']     = filepath
+    metadata['model']        = str(exif.get('Image Model', None)).strip()
+    metadata['iso']          = str(exif.get('EXIF ISOSpeedRatings', None))
+    metadata['focal_length'] = float(Fraction(str(exif.get('EXIF FocalLength', 0))))
+    metadata['f_number']     = float(Fraction(str(exif.get('EXIF FNumber', 0))))
+    metadata['exptime']      = float(Fraction(str(exif.get('EXIF ExposureTime', 0))))
+    metadata['date_obs']     = toDateTime(str(exif.get('Image DateTime', None)))
+    # Fixes missing Focal Length and F/ ratio
+    metadata['focal_length'] = 'Unknown' if metadata['focal_length'] == 0 else metadata['focal_length']
+    metadata['f_number']     = 'Unknown' if metadata['f_number']     == 0 else metadata['f_number']
+    # Fixed GAIN for EXIF DSLRs that provide ISO sensivity
+    metadata['gain'] = None
     # Get the real RAW dimensions instead
     with rawpy.imread(filepath) as img:
         imageHeight, imageWidth = img.raw_image.shape
@@ -227,6 +232,7 @@ class Cycler:
         self.i = 0
         self.N = len(filepath_list)
         self.options = options
+        self.offset = 0   # To be added to native integer pixel values (FITS BZERO)
         self.reset()
         self.one_step(0) # Proceed with first image
 
@@ -276,23 +282,31 @@ class Cycler:
     def one_step(self, i):
         metadata, roi = self.load(i)
         if metadata['header_type'] == FITS_HEADER_TYPE:
-            with fits.open(self.filepath[i], memmap=False) as hdu_list:
-                raw_pixels = hdu_list[0].data
-                # This must be executed unther the context manager
-                # for raw_pixels to become valid
-                self.plot(raw_pixels, roi, metadata)
+            # Pixels are kept in their native integer type, adding BZERO to the statistics
+            with fits.open(self.filepath[i], memmap=True, do_not_scale_image_data=True) as hdu_list:
+                self.offset = fits_unscaled_offset(hdu_list[0].header)
+                if self.offset is not None:
+                    raw_pixels = hdu_list[0].data
+                    # This must be executed unther the context manager
+                    # for raw_pixels to become valid
+                    self.plot(raw_pixels, roi, metadata)
+            if self.offset is None:
+                self.offset = 0
+                with fits.open(self.filepath[i], memmap=False) as hdu_list:
+                    raw_pixels = hdu_list[0].data
+                    self.plot(raw_pixels, roi, metadata)
         else:
+            self.offset = 0
             with rawpy.imread(self.filepath[i]) as img:
                 raw_pixels = img.raw_image
                 # This must be executed unther the context manager
                 # for raw_pixels to become valid
                 self.plot(raw_pixels, roi, metadata)
 
-    def stats(self, channel, roi):
-        x1, x2, y1, y2 = roi['x1'], roi['x2'], roi['y1'], roi['y2']
-        aver = channel[y1:y2,x1:x2].mean()
-        std  = channel[y1:y2,x1:x2].std()
-        return aver, std
+    def stats(self, raw_pixels, bayer_pattern, roi):
+        '''Average and standard deviation for all channels in one pass'''
+        row = all_channels_stats(raw_pixels, bayer_pattern, roi, dict(), self.offset)
+        return {channel: (row[f'aver_signal_{channel}'], math.sqrt(row[f'vari_signal_{channel}'])) for channel in ('R', 'G1', 'G2', 'B')}
 
 
     def stat_display(self, axe, aver, std, roi, pixels_tag):
@@ -336,11 +350,10 @@ class Cycler:
         self.figure.suptitle(label)
 
 
-    def add_subplot(self, n, pixels, pixels_tag, roi, cmap):
+    def add_subplot(self, n, pixels, pixels_tag, roi, cmap, aver, std):
         axe    = self.figure.add_subplot(220 + n)
-        aver, std = self.stats(pixels, roi)
         vmin, vmax = self.plot_range(aver, std)
-        img    = axe.imshow(pixels, cmap=cmap, vmin=vmin, vmax=vmax)
+        img    = axe.imshow(pixels, cmap=cmap, vmin=vmin - self.offset, vmax=vmax - self.offset)
         plt.text(0.05, 0.90, pixels_tag, ha='left', va='center', transform=axe.transAxes, fontsize=10)
         self.stat_display(axe, aver, std ,roi, pixels_tag)
         caxe = self.color_bar(axe, img)
@@ -350,7 +363,8 @@ class Cycler:
     def color_bar(self, axe, img):
         divider = make_axes_locatable(axe)
         caxe = divider.append_axes("right", size="5%", pad=0.05)
-        self.figure.colorbar(img, cax=caxe)
+        offset = self.offset
+        self.figure.colorbar(img, cax=caxe, format=FuncFormatter(lambda value, pos: f"{value + offset:g}"))
         axe.axes.get_yaxis().set_ticks([])
         axe.axes.get_xaxis().set_ticks([])
         return caxe
@@ -359,22 +373,24 @@ class Cycler:
     def plot(self, raw_pixels, roi, metadata):
         self.set_title(metadata)
         bayer_pattern = metadata['bayer']
+        stats = self.stats(raw_pixels, bayer_pattern, roi)
         image_R1 = get_debayered_for_channel(raw_pixels, bayer_pattern, 'R')
-        self.r1_axe, self.cr1_axe = self.add_subplot(1, image_R1, 'R1', roi, 'Reds')
+        self.r1_axe, self.cr1_axe = self.add_subplot(1, image_R1, 'R1', roi, 'Reds', *stats['R'])
         image_G2 = get_debayered_for_channel(raw_pixels, bayer_pattern, 'G1')
-        self.g2_axe, self.cg2_axe = self.add_subplot(2, image_G2, 'G2', roi, 'Greens')
+        self.g2_axe, self.cg2_axe = self.add_subplot(2, image_G2, 'G2', roi, 'Greens', *stats['G1'])
         image_G3 = get_debayered_for_channel(raw_pixels, bayer_pattern, 'G2')
-        self.g3_axe, self.cg3_axe = self.add_subplot(3, image_G3, 'G3', roi, 'Greens')
+        self.g3_axe, self.cg3_axe = self.add_subplot(3, image_G3, 'G3', roi, 'Greens', *stats['G2'])
         image_B4 = get_debayered_for_channel(raw_pixels, bayer_pattern, 'B')
-        self.b4_axe, self.cb4_axe = self.add_subplot(4, image_B4, 'B4', roi, 'Blues')
+        self.b4_axe, self.cb4_axe = self.add_subplot(4, image_B4, 'B4', roi, 'Blues', *stats['B'])
 
 
     def plot(self, raw_pixels, roi, metadata):
         self.set_title(metadata)
         bayer_pattern = metadata['bayer']
+        stats = self.stats(raw_pixels, bayer_pattern, roi)
         for i, t in enumerate(self.PLOT_CODES,start=1):
             image = get_debayered_for_channel(raw_pixels, bayer_pattern, t[0])
-            axe, caxe = self.add_subplot(i, image, t[1], roi, t[2])
+            axe, caxe = self.add_subplot(i, image, t[1], roi, t[2], *stats[t[0]])
             self.all_axes.append(axe)
             self.all_axes.append(caxe)
 
@@ -30,7 +30,10 @@ from azotea import __version__
 from azotea.utils import get_status_code
 from azotea.logger  import startLogging
 from azotea.batch.service import BatchService
-from azotea.dbase.service import DatabaseService
+from azotea.utils.workers import POOL_TYPES, THREAD_POOL
+from azotea.utils.sky import TILES_GRID
+from azotea.utils.readahead import READ_AHEAD
+from azotea.dbase.service import DatabaseService, PRAGMA_PROFILES, DEFAULT_PROFILE
 import azotea.consent.form
 
 # ----------------
@@ -55,6 +58,7 @@ def createParser():
     parser.add_argument('-d', '--dbase',    type=str, required=True, action='store', metavar='<file path>', help='SQLite database to operate upon')
     parser.add_argument('-c', '--console', action='store_true',  help='log to console.')
     parser.add_argument('-l', '--log-file', type=str, default=None, action='store', metavar='<file path>', help='log to file')
+    parser.add_argument('--db-profile', choices=tuple(PRAGMA_PROFILES), default=DEFAULT_PROFILE, help='SQLite connection tuning profile')
    
     # --------------------------
     # Create first level parsers
@@ -71,6 +75,18 @@ def createParser():
 
     parser_batch.add_argument('--images-dir', type=str, default=None, action='store', metavar='<path>', help='Images working directory')
     parser_batch.add_argument('--depth',      type=int, default=None, help='Specify images dir max. scanning depth')
+    parser_batch.add_argument('--workers',    type=int, default=None, help='Number of parallel workers (default: number of CPUs)')
+    parser_batch.add_argument('--pool',       choices=POOL_TYPES, default=THREAD_POOL, help='Worker pool type')
+    parser_batch.add_argument('--full-scan',  action='store_true', help='List all directories, even those unchanged since last scan, and retry rejected images')
+    parser_batch.add_argument('--watch',      action='store_true', help='Keep running, processing new images as they arrive')
+    parser_batch.add_argument('--interval',   type=int, default=10, help='Seconds between directory polls in watch mode')
+    parser_batch.add_argument('--rois',       type=int, nargs='+', default=None, metavar='<roi_id>', help='ROI ids to measure in each image (default: the default ROI)')
+    parser_batch.add_argument('--stats-cache', type=str, default=None, metavar='<path>', help='Sky statistics cache file, shared among databases')
+    parser_batch.add_argument('--histograms',  action='store_true', help='Also store the per channel ROI histograms')
+    parser_batch.add_argument('--tiles',       type=int, nargs='?', const=TILES_GRID, default=0, metavar='<N>', help=f'Also store full frame statistics maps on a NxN grid of tiles (default N: {TILES_GRID})')
+    parser_batch.add_argument('--subtract-master', type=str, nargs='?', const='DARK', default=None, choices=('DARK','BIAS'), help="Subtract the night's master frame ROI averages, built with 'azotool image master' (default: DARK)")
+    parser_batch.add_argument('--read-ahead',  type=int, default=READ_AHEAD, metavar='<N>', help=f'Images read ahead into the page cache during sky processing, 0 disables (default: {READ_AHEAD})')
+    parser_batch.add_argument('--fused',       action='store_true', help='Measure the sky background of new images while loading them, reading each file only once')
     group = parser_batch.add_mutually_exclusive_group()
     group.add_argument('--only-sky',  action='store_true', help='only compute sky background')
     group.add_argument('--only-load', action='store_true', help='only loads images to database')
@@ -109,7 +125,7 @@ startLogging(
 
 application = service.Application("azotea")
 
-dbaseService = DatabaseService(options.dbase, False)
+dbaseService = DatabaseService(options.dbase, False, profile=options.db_profile)
 dbaseService.setName(DatabaseService.NAME)
 dbaseService.setServiceParent(application)
 
@@ -125,7 +141,19 @@ elif options.command == 'batch':
         only_load  = options.only_load, 
         only_sky   = options.only_sky,
         only_pub   = options.only_publish,
-        also_pub   = options.publish
+        also_pub   = options.publish,
+        workers    = options.workers,
+        pool_type  = options.pool,
+        full_scan  = options.full_scan,
+        watch      = options.watch,
+        interval   = options.interval,
+        roi_ids    = options.rois,
+        stats_cache = options.stats_cache,
+        histograms  = options.histograms,
+        tiles       = options.tiles,
+        master_type = options.subtract_master,
+        read_ahead  = options.read_ahead,
+        fused       = options.fused,
         )
     batchService.setName(BatchService.NAME)
     batchService.setServiceParent(application)
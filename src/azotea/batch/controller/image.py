@@ -10,9 +10,8 @@
 # -------------------
 
 import os
-import glob
+import time
 import datetime
-import sqlite3
 
 # ---------------
 # Twisted imports
@@ -34,8 +33,12 @@ from pubsub import pub
 
 from azotea import FITS_HEADER_TYPE, EXIF_HEADER_TYPE
 from azotea.logger  import setLogLevel
-from azotea.utils.image import classify_image_type, scan_non_empty_dirs, hash_func, exif_metadata, toDateTime
+from azotea.utils.image import scan_images, fingerprints
 from azotea.utils.image import hash_and_metadata_exif, hash_and_metadata_fits
+from azotea.utils.workers import WorkerPool, THREAD_POOL
+from azotea.utils.sky import registerAndProcessImage
+from azotea.dbase.cache import cache_key
+from azotea.dbase.image import INSERTED, RELOCATED, DISCARDED
 from azotea.batch.controller import NAMESPACE, log
 
 
@@ -64,13 +67,18 @@ class ImageController:
 
     NAME = NAMESPACE
 
-    def __init__(self, model, config, next_event):
+    def __init__(self, model, config, next_event, workers=None, pool_type=THREAD_POOL, fused=False, fail_event=None):
         self.model = model
         self.image = model.image
         self.config = config
         self.default_focal_length = None
         self.default_f_number = None
         self.next_event = next_event
+        self.fail_event = fail_event    # Sent instead of quitting on errors, if given
+        self.workers = WorkerPool(workers, pool_type)
+        self.fused   = fused    # Measure the sky background of new images while loading them
+        self.skyCtrl = None
+        self._measured = 0
         setLogLevel(namespace=NAMESPACE, levelStr='info')
         pub.subscribe(self.onLoadReq, 'images_load_req')
          
@@ -80,33 +88,66 @@ class ImageController:
     # --------------
 
     @inlineCallbacks  
-    def onLoadReq(self, root_dir, depth):
+    def onLoadReq(self, root_dir, depth, full_scan=False, settle=0):
         try:
             lvl = yield self.config.load('logging', NAMESPACE)
             setLogLevel(namespace=NAMESPACE, levelStr=lvl[NAMESPACE])
             log.warn('Starting image registration process')
             ok = yield self.doCheckDefaults()
+            if ok and self.fused:
+                ok = yield self.skyCtrl.doCheckDefaults()
             if not ok:
                 log.error("Missing default values")
-                pub.sendMessage('quit', exit_code = 1)
+                if self.fail_event:
+                    pub.sendMessage(self.fail_event)
+                else:
+                    pub.sendMessage('quit', exit_code = 1)
                 return
-            sub_dirs = yield deferToThread(scan_non_empty_dirs, root_dir, depth)
+            # We cannot afford skipping unchanged directories with FITS images
+            # because they can be edited in place afterwards
+            index = None
+            if not full_scan and self.header_type != FITS_HEADER_TYPE:
+                index = yield self.model.directory.loadIndex({'root_dir': root_dir, 'extension': self.extension})
+            scanner = scan_images(root_dir, self.extension, depth, index)
             self.session = int(datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d%H%M%S'))
+            self._measured = 0
             N_Files = 0; i = 0
-            for images_dir in sorted(sub_dirs, reverse=True):
-                result = yield self.doRegister(images_dir)
-                if not result:
+            while True:
+                # Registration starts as soon as the first directory is listed
+                item = yield deferToThread(next, scanner, None)
+                if item is None:
                     break
-                j, M_Files = result
-                i += j
-                N_Files += M_Files
+                images_dir, (mtime_ns, entries, subdirs), file_list = item
+                unsettled = 0
+                if file_list:
+                    result = yield self.doRegister(images_dir, file_list, settle, full_scan)
+                    if not result:
+                        break
+                    j, M_Files, unsettled = result
+                    i += j
+                    N_Files += M_Files
+                if unsettled:
+                    # Files still being written. Keep listing this directory
+                    continue
+                yield self.model.directory.save({
+                    'directory': images_dir, 
+                    'extension': self.extension,
+                    'mtime_ns' : mtime_ns, 
+                    'entries'  : entries, 
+                    'subdirs'  : subdirs,
+                })
             if N_Files:
                 log.warn("{i}/{N} images loaded", i=i, N=N_Files)
+            if self._measured:
+                log.warn("Sky background measured in {n} images while loading", n=self._measured)
             # Purge FITS duplicates after FITS re-editing if any
             yield self.image.purgeDuplicates()
         except Exception as e:
             log.failure('{e}',e=e)
-            pub.sendMessage('quit', exit_code = 1)
+            if self.fail_event:
+                pub.sendMessage(self.fail_event)
+            else:
+                pub.sendMessage('quit', exit_code = 1)
         else:
             if self.next_event:
                 pub.sendMessage(self.next_event)
@@ -118,6 +159,10 @@ class ImageController:
     # Helper methods
     # --------------
 
+    def shutdown(self):
+        '''Stops the worker pool'''
+        self.workers.shutdown()
+
     # We assign the default optics here
     @inlineCallbacks
     def getDefault(self):
@@ -139,6 +184,7 @@ class ImageController:
      
         if default_camera_id:
             self.default_camera_id = int(default_camera_id)
+            self.default_model = default_camera['model']
             self.extension     = default_camera['extension']
             self.header_type   = default_camera['header_type']
             self.bayer_pattern = default_camera['bayer_pattern']
@@ -173,31 +219,44 @@ class ImageController:
             return(True)
     
 
+    def saveMeasurements(self, txn, inserted, save_list):
+        '''Sky background of the newly inserted images, committed together with them'''
+        rows = [dict(sky_row, image_id=inserted[row['hash']]) 
+            for row in save_list if row['hash'] in inserted
+            for sky_row in row.get('sky', [])]
+        self.model.sky.saveRows(txn, [self.skyCtrl.subtractMaster(row) for row in rows])
+        if self.skyCtrl.histograms:
+            self.model.histogram.saveRows(txn, rows)
+        if self.skyCtrl.tiles:
+            self.model.tiles.saveRows(txn, rows)
+
+
     @inlineCallbacks
     def saveAndFix(self, save_list):
-        try:
-            yield self.image.save(save_list)
-        except sqlite3.IntegrityError as e:
-            for row in save_list:
-                try:
-                    yield self.image.save(row)
-                except  sqlite3.IntegrityError as e:
-                    name, directory = yield self.image.getByHash(row)
-                    if row['name'] == name:
-                        oldpath = os.path.join(directory, name)
-                        newpath = os.path.join(row['directory'], row['name'])
-                        # Avoid fixing path with itself. It happens in FITS handling, by design
-                        if row['directory'] != directory:
-                            oldpath = os.path.join(directory, name)
-                            newpath = os.path.join(row['directory'], row['name'])
-                            log.error("Fixing '{oldpath}' -> '{newpath}'", oldpath=oldpath, newpath=newpath)
-                            yield self.image.fixDirectory(row)
-                    else:
-                        log.error("Discarding new image '{name}'", name=row['name'])
-                        log.error("Keeping '{prev}' image instead",name=row['name'], prev=name) 
+        if self.fused:
+            then = lambda txn, inserted: self.saveMeasurements(txn, inserted, save_list)
+        else:
+            then = None
+        report = yield self.image.bulkSave(save_list, then)
+        if self.fused:
+            self._measured += sum(1 for row, outcome in zip(save_list, report) if outcome[2] == INSERTED and 'sky' in row)
+            if self.skyCtrl.cache:
+                yield self.skyCtrl.cache.save([
+                    dict(sky_row, **cache_key(row['hash'], self.skyCtrl.roi_dict[sky_row['roi_id']], self.bayer_pattern))
+                    for row in save_list for sky_row in row.get('sky', [])])
+        for name, directory, outcome, prev_name, prev_directory in report:
+            if outcome == RELOCATED:
+                oldpath = os.path.join(prev_directory, prev_name)
+                newpath = os.path.join(directory, name)
+                log.error("Fixing '{oldpath}' -> '{newpath}'", oldpath=oldpath, newpath=newpath)
+            elif outcome == DISCARDED:
+                log.error("Discarding new image '{name}'", name=name)
+                log.error("Keeping '{prev}' image instead", prev=prev_name)
+        # Remember what has been hashed so that unchanged files are not hashed again
+        yield self.model.fingerprint.save(save_list)
 
     @inlineCallbacks
-    def newImages(self, directory, file_list):
+    def newImages(self, directory, file_list, settle=0, full_scan=False):
         input_set = set(os.path.basename(f) for f in file_list)
         db_set = set()
         # We cannot afford this trick with FITS images
@@ -205,65 +264,110 @@ class ImageController:
         if self.header_type != FITS_HEADER_TYPE:
             db_set = yield self.image.imagesInDirectory({'directory': directory})
             db_set = set(img[0] for img in db_set)
-        result = sorted(list(input_set - db_set))
-        return list(os.path.join(directory, f) for f in (input_set - db_set))
+        input_set = input_set - db_set
+        # Skip files not modified since their hash was registered.
+        # This works for FITS images too, as re-edited files change their fingerprint.
+        # Files once rejected are skipped as well, unless doing a full scan
+        current = yield deferToThread(fingerprints, directory, input_set)
+        known   = yield self.model.fingerprint.unchanged({'directory': directory}, rejected=not full_scan)
+        result  = sorted(name for name, fp in current.items() if known.get(name) != fp)
+        # Files modified in the last settle seconds may not be completely written yet
+        unsettled = 0
+        if settle:
+            youngest  = time.time_ns() - int(settle*1e9)
+            unsettled = sum(1 for name in result if current[name][1] > youngest)
+            result    = [name for name in result if current[name][1] <= youngest]
+        return list(os.path.join(directory, f) for f in result), unsettled, current
+
+    def newRow(self, directory, filepath):
+        return {
+            'name'        : os.path.basename(filepath), 
+            'directory'   : directory,
+            'flagged'     : 0, # Assume a good image for the time being
+            'header_type' : self.header_type,
+            'observer_id' : self.observer_id,
+            'location_id' : self.location_id,
+            'session'     : self.session,
+            'def_fl'      : self.default_focal_length['focal_length'],  # these 2 are not real table columns
+            'def_fn'      : self.default_f_number['f_number'],      # they are here just to fix EXIF optics reading
+        }
+
+    def rejectedRow(self, directory, name, fingerprint):
+        '''Fingerprint of a file that cannot be registered, so that it is not read again while unchanged'''
+        size, mtime_ns, inode = fingerprint
+        return {
+            'directory': directory,
+            'name'     : name,
+            'size'     : size,
+            'mtime_ns' : mtime_ns,
+            'inode'    : inode,
+            'hash'     : None,
+        }
 
 
     @inlineCallbacks
-    def doRegister(self, directory):
+    def doRegister(self, directory, file_list, settle=0, full_scan=False):
         extension = '*' + self.extension
-        file_list  = glob.glob(os.path.join(directory, extension))
         N0_Files = len(file_list)
-        file_list = yield self.newImages(directory, file_list)
+        file_list, unsettled, current = yield self.newImages(directory, file_list, settle, full_scan)
         N_Files = len(file_list)
         log.warn("Scanning directory '{dir}'. Found {n} images matching '{ext}', loading {m} images", 
             dir=os.path.basename(directory), n=N0_Files, m=N_Files, ext=extension)
         save_list = list()
-        if self.header_type == FITS_HEADER_TYPE:
-            hash_and_metadata_f = hash_and_metadata_fits
+        # Images taken with other cameras are rejected by the workers before being hashed
+        if self.fused:
+            # Each new image is read from disk once for both registration and sky background
+            roi_ids = sorted(self.skyCtrl.roi_dict)
+            rois = [self.skyCtrl.roi_dict[roi_id] for roi_id in roi_ids]
+            jobs = ((filepath, self.newRow(directory, filepath), self.default_model, rois, self.bayer_pattern,
+                [{'roi_id': roi_id} for roi_id in roi_ids], self.skyCtrl.histograms, self.skyCtrl.tiles) for filepath in file_list)
+            results = self.skyCtrl.getWorkers(self.header_type).imap(registerAndProcessImage, jobs)
         else:
-            hash_and_metadata_f = hash_and_metadata_exif
-        i = 0
-        for i, filepath in enumerate(file_list, start=1):
-            row = {
-                'name'        : os.path.basename(filepath), 
-                'directory'   : directory,
-                'imagetype'   : classify_image_type(self.header_type, filepath),
-                'flagged'     : 0, # Assume a good image for the time being
-                'header_type' : self.header_type,
-                'observer_id' : self.observer_id,
-                'location_id' : self.location_id,
-                'def_fl'      : self.default_focal_length['focal_length'],  # these 2 are not real table columns
-                'def_fn'      : self.default_f_number['f_number'],      # they are here just to fix EXIF optics reading
-            }
-            log.info("Loading {n} ({i}/{N}) [{p}%]", i=i, N=N_Files, n=row['name'], p=(100*i//N_Files) )
-            row['session'] = self.session
-            try:
-                row = yield deferToThread(hash_and_metadata_f, filepath, row)
-            except Exception as e:
-                log.error("Skipping {n} ({i}/{N}) [{p}%] => {e}",
-                        e=e, i=i, N=N_Files, n=row['name'], p=(100*i//N_Files))
-                continue
-            existing_camera = yield self.model.camera.lookup(row)
-            if not existing_camera:
-                msg = 'Camera model {0} not found in the database'.format(row['model'])
-                log.error("Skipping {n} ({i}/{N}) [{p}%] => {m}",
-                        m=msg, i=i, N=N_Files, n=row['name'], p=(100*i//N_Files))
-                continue
-            row['camera_id'] = int(existing_camera['camera_id'])
-            if row['camera_id'] != self.default_camera_id:
-                msg = 'Camera model {0} is not the default camera'.format(row['model'])
-                log.error("Skipping {n} ({i}/{N}) [{p}%] => {m}",
-                        m=msg, i=i, N=N_Files, n=row['name'], p=(100*i//N_Files))
-                continue
-            # Finally, save the new row
-            save_list.append(row)
-            if (i % BUFFER_SIZE) == 0:
-                log.debug("saving to database")
-                yield self.saveAndFix(save_list)
-                save_list = list()
+            if self.header_type == FITS_HEADER_TYPE:
+                hash_and_metadata_f = hash_and_metadata_fits
+            else:
+                hash_and_metadata_f = hash_and_metadata_exif
+            jobs = ((filepath, self.newRow(directory, filepath), self.default_model) for filepath in file_list)
+            results = self.workers.imap(hash_and_metadata_f, jobs)
+        i = 0; rejected = list()
+        try:
+            for i, ((filepath, row, *_), deferred) in enumerate(results, start=1):
+                log.info("Loading {n} ({i}/{N}) [{p}%]", i=i, N=N_Files, n=row['name'], p=(100*i//N_Files) )
+                try:
+                    row = yield deferred
+                except Exception as e:
+                    log.error("Skipping {n} ({i}/{N}) [{p}%] => {e}",
+                            e=e, i=i, N=N_Files, n=row['name'], p=(100*i//N_Files))
+                    # The file state before reading it, as it may have changed in the meantime
+                    rejected.append(self.rejectedRow(directory, row['name'], current[row['name']]))
+                    continue
+                if 'hash' not in row:
+                    existing_camera = yield self.model.camera.lookup(row)
+                    if not existing_camera:
+                        msg = 'Camera model {0} not found in the database'.format(row['model'])
+                    else:
+                        msg = 'Camera model {0} is not the default camera'.format(row['model'])
+                    log.error("Skipping {n} ({i}/{N}) [{p}%] => {m}",
+                            m=msg, i=i, N=N_Files, n=row['name'], p=(100*i//N_Files))
+                    rejected.append(self.rejectedRow(directory, row['name'], (row['size'], row['mtime_ns'], row['inode'])))
+                    continue
+                row['camera_id'] = self.default_camera_id
+                if 'sky' in row:
+                    master_id = yield self.skyCtrl.getMaster(row['camera_id'], row['imagetype'], row['date_id'], row['time_id'], self.bayer_pattern, roi_ids)
+                    for sky_row in row['sky']:
+                        sky_row['master_id'] = master_id
+                # Finally, save the new row
+                save_list.append(row)
+                if (i % BUFFER_SIZE) == 0:
+                    log.debug("saving to database")
+                    yield self.saveAndFix(save_list)
+                    save_list = list()
+        finally:
+            results.close()
         if save_list:
             log.debug("saving to database")
             yield self.saveAndFix(save_list)
-        return((i, N_Files))
+        if rejected:
+            yield self.model.fingerprint.save(rejected)
+        return((i, N_Files, unsettled))
         
\ No newline at end of file
@@ -75,11 +75,12 @@ class PublishingError(Exception):
 
 class PublishingController:
     
-    def __init__(self, model, config, next_event):
+    def __init__(self, model, config, next_event, fail_event=None):
         self.model = model
         self.sky    = model.sky
         self.config = config
-        self.next_event = None
+        self.next_event = next_event
+        self.fail_event = fail_event    # Sent instead of quitting on errors, if given
         self.observerCtrl = None
         self.username = None
         self.password = None
@@ -99,20 +100,29 @@ class PublishingController:
             lvl = yield self.config.load('logging', NAMESPACE)
             setLogLevel(namespace=NAMESPACE, levelStr=lvl[NAMESPACE])
             result = yield self.doCheckDefaults()
-            if result:
-                total = yield self.sky.getPublishingCount({'observer_id': self.observer_id})
-                if total == 0:
-                    log.info("Publishing Processor: No Sky Brightness measurements to publish")
+            if not result:
+                if self.fail_event:
+                    pub.sendMessage(self.fail_event)
                 else:
-                    log.info("Publishing Processor: Publishing {total} measurements. This may take a while", total=total)
-                    yield self.doPublish(total)
+                    pub.sendMessage('quit', exit_code = 1)
+                return
+            total = yield self.sky.getPublishingCount({'observer_id': self.observer_id})
+            if total == 0:
+                log.info("Publishing Processor: No Sky Brightness measurements to publish")
             else:
-                pub.sendMessage('quit', exit_code = 1)
+                log.info("Publishing Processor: Publishing {total} measurements. This may take a while", total=total)
+                yield self.doPublish(total)
         except Exception as e:
             log.failure('{e}',e=e)
-            pub.sendMessage('quit', exit_code = 1)
+            if self.fail_event:
+                pub.sendMessage(self.fail_event)
+            else:
+                pub.sendMessage('quit', exit_code = 1)
         else:
-            pub.sendMessage('quit')
+            if self.next_event:
+                pub.sendMessage(self.next_event)
+            else:
+                pub.sendMessage('quit')
 
     # --------------
     # Helper methods
@@ -18,6 +18,7 @@ import csv
 # ---------------
 
 from twisted.logger   import Logger
+from twisted.internet import defer
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet.threads import deferToThread
 
@@ -31,9 +32,14 @@ from pubsub import pub
 # local imports
 # -------------
 
+from azotea import EXIF_HEADER_TYPE
 from azotea.logger  import setLogLevel
-from azotea.utils.roi import Rect
-from azotea.utils.sky import processImage, RAWPY_EXCEPTIONS
+from azotea.utils.workers import WorkerPool, THREAD_POOL, PROCESS_POOL
+from azotea.utils.readahead import READ_AHEAD, read_ahead, dont_need
+from azotea.utils.image import night_id
+from azotea.utils.master import master_roi_stats
+from azotea.dbase.cache import cache_key
+from azotea.utils.sky import processImageROIs, RAWPY_EXCEPTIONS
 
 # ----------------
 # Module constants
@@ -61,13 +67,30 @@ class SkyBackgroundController:
 
     NAME = NAMESPACE
     
-    def __init__(self, config, model, next_event):
+    def __init__(self, config, model, next_event, roi_ids=None, workers=None, pool_type=THREAD_POOL, cache=None, histograms=False, tiles=0, master_type=None,
+        read_ahead=READ_AHEAD, fail_event=None):
         self.model  = model
         self.sky    = model.sky
         self.image  = model.image
         self.roi    = model.roi
         self.config = config
         self.next_event = next_event
+        self.fail_event = fail_event    # Sent instead of quitting on errors, if given
+        self.roi_ids    = roi_ids   # None means the default ROI only
+        self.workers    = workers
+        self.pool_type  = pool_type
+        self._pools     = dict()
+        self.cache      = cache     # Optional StatsCache
+        self.histograms = histograms
+        self.histogram  = model.histogram
+        self.tiles      = tiles     # Tiles per side in full frame maps, 0 for none
+        self.tile_maps  = model.tiles
+        self.master_type = master_type  # DARK or BIAS master frame to subtract, if any
+        self._master_stats = dict()     # (master_id, roi_id) => master ROI statistics
+        self.read_ahead  = read_ahead   # Images read ahead of the workers, 0 disables page cache hints
+        self._save_list  = list()
+        self._cache_list = list()
+        self._writer     = None
         self.observerCtrl = None
         self.roiCtrl      = None
         setLogLevel(namespace=NAMESPACE, levelStr='info')
@@ -84,13 +107,19 @@ class SkyBackgroundController:
             self.logLevel = lvl[NAMESPACE]
             setLogLevel(namespace=NAMESPACE, levelStr=self.logLevel)
             result = yield self.doCheckDefaults()
-            if result:
-                yield self.doStatistics()
-            else:
-                pub.sendMessage('quit', exit_code = 1)
+            if not result:
+                if self.fail_event:
+                    pub.sendMessage(self.fail_event)
+                else:
+                    pub.sendMessage('quit', exit_code = 1)
+                return
+            yield self.doStatistics()
         except Exception as e:
             log.failure('{e}',e=e)
-            pub.sendMessage('quit', exit_code = 1)
+            if self.fail_event:
+                pub.sendMessage(self.fail_event)
+            else:
+                pub.sendMessage('quit', exit_code = 1)
         else:
             if self.next_event:
                 pub.sendMessage(self.next_event)
@@ -101,6 +130,84 @@ class SkyBackgroundController:
     # Helper methods
     # --------------
 
+    def getWorkers(self, header_type):
+        '''LibRaw decoding is CPU bound and always runs in a process pool. FITS use the selected pool'''
+        pool_type = PROCESS_POOL if header_type == EXIF_HEADER_TYPE else self.pool_type
+        if pool_type not in self._pools:
+            self._pools[pool_type] = WorkerPool(self.workers, pool_type)
+        return self._pools[pool_type]
+
+
+    def shutdown(self):
+        '''Stops the worker pools'''
+        for pool in self._pools.values():
+            pool.shutdown()
+
+
+    def subtractMaster(self, row):
+        '''
+        Master frame ROI averages subtracted. Cached statistics are kept as measured.
+        Only the averages are corrected: variances are left as measured on the raw frame,
+        as the variance of a pixel by pixel difference also depends on the covariance
+        between the image and the master, which the ROI statistics do not provide
+        '''
+        if row.get('master_id') is None:
+            return row
+        row = dict(row)
+        for channel, (average, variance) in self._master_stats[(row['master_id'], row['roi_id'])].items():
+            row[f'aver_signal_{channel}'] = round(row[f'aver_signal_{channel}'] - average, 1)
+        return row
+
+
+    @inlineCallbacks
+    def getMaster(self, camera_id, imagetype, date_id, time_id, bayer_pattern, roi_ids):
+        '''Master frame id for an image, computing its ROI statistics when first used'''
+        if not self.master_type or imagetype in ('DARK', 'BIAS'):
+            return None
+        master = self._master_index.get((camera_id, night_id(date_id, time_id)))
+        if not master:
+            return None
+        master_id, path = master
+        for roi_id in roi_ids:
+            if (master_id, roi_id) not in self._master_stats:
+                self._master_stats[(master_id, roi_id)] = yield deferToThread(master_roi_stats, path, bayer_pattern, self.roi_dict[roi_id])
+        return master_id
+
+
+    def bufferRows(self, rows, computed=True):
+        self._save_list.extend(self.subtractMaster(row) for row in rows)
+        if computed and self.cache:
+            self._cache_list.extend(rows)
+
+
+    @inlineCallbacks
+    def flush(self, force=False):
+        '''
+        Single database writer. Waits for the previous write to complete
+        and starts the next one without waiting for it, unless forced.
+        '''
+        if not force and len(self._save_list) < BUFFER_SIZE:
+            return
+        if self._writer:
+            yield self._writer
+            self._writer = None
+        if self._save_list:
+            log.debug("Saving to database")
+            writes = [self.sky.save(self._save_list)]
+            if self.histograms:
+                writes[0].addCallback(lambda _, save_list: self.histogram.save(save_list), self._save_list)
+            if self.tiles:
+                writes[0].addCallback(lambda _, save_list: self.tile_maps.save(save_list), self._save_list)
+            if self._cache_list:
+                writes.append(self.cache.save(self._cache_list))
+            self._writer = defer.gatherResults(writes, consumeErrors=True)
+            self._save_list  = list()
+            self._cache_list = list()
+        if force and self._writer:
+            yield self._writer
+            self._writer = None
+
+
     @inlineCallbacks
     def doCheckDefaults(self):
         result = True
@@ -113,11 +220,24 @@ class SkyBackgroundController:
         else:
             self.observer_id = None
             errors.append( "- No default observer defined.")
-        if default_roi_id: 
-            self.roi_id = int(default_roi_id)
+        if self.roi_ids:
+            self.roi_dict = dict()
+            for roi_id in self.roi_ids:
+                roi_dict = yield self.roi.loadById({'roi_id': roi_id})
+                if roi_dict:
+                    self.roi_dict[roi_id] = roi_dict
+                else:
+                    errors.append( "- ROI {0} not found.".format(roi_id))
+        elif default_roi_id: 
+            roi_id = int(default_roi_id)
+            roi_dict = yield self.roi.loadById({'roi_id': roi_id})
+            self.roi_dict = {roi_id: roi_dict}
         else:
-            self.roi_id = None
-            errors.append( _("- No default ROI selected.") )
+            self.roi_dict = None
+            errors.append( "- No default ROI selected.")
+        if self.master_type:
+            self._master_index = yield self.model.master.loadIndex({'imagetype': self.master_type})
+            log.warn("Subtracting {t} master frames from {n} nights", t=self.master_type, n=len(self._master_index))
         if errors:
             error_list = '\n'.join(errors)
             message = _("These things are missing:\n{0}").format(error_list)
@@ -129,40 +249,73 @@ class SkyBackgroundController:
     @inlineCallbacks
     def doStatistics(self):
         # Default settings extracted by doCheckDefaults()
-        conditions = {'observer_id' : self.observer_id, 'roi_id': self.roi_id,}
-        roi_dict = yield self.roi.loadById(conditions)
-        rect = Rect.from_dict(roi_dict)
-        image_id_list = yield self.sky.pending(conditions)
-        N_stats = len(image_id_list)
-        save_list = list()
-        log.warn("Processing sky background in {N} images", N=N_stats)
-        for i, (image_id,) in enumerate(image_id_list, start=1):
-            name, directory, header_type, exptime, cfa_pattern, camera_id, date_id, time_id, observer_id, location_id = yield self.image.getInitialMetadata({'image_id':image_id})
-            row = {
-                'roi_id'     : self.roi_id,
-                'image_id'   : image_id,
-            }
-            if self.logLevel == 'warn':
-                if  (i % PAGE_SIZE) == 0:
-                    log.warn("{name} ({i}/{N}) [{p}%]", i=i, N=N_stats, name=name, p=(100*i//N_stats))
-            else:
-                log.info("{name} ({i}/{N}) [{p}%]", i=i, N=N_stats, name=name, p=(100*i//N_stats))
-            try:
-                row = yield deferToThread(processImage, name, directory, roi_dict, header_type, cfa_pattern, row)
-            except RAWPY_EXCEPTIONS as e:
-                log.error("Corrupt {name} ({i}/{N}) [{p}%]", i=i, N=N_stats, name=name, p=(100*i//N_stats))
-                yield self.image.flagAsBad(row)
-                continue
-            save_list.append(row)
-            if (i % BUFFER_SIZE) == 0:
-                log.debug("Saving to database")
-                yield self.sky.save(save_list)
-                save_list = list()
-        if save_list:
-            log.debug("Saving to database")
-            yield self.sky.save(save_list)
+        # Each image is decoded only once, whatever the number of ROIs pending in it
+        conditions = {'observer_id' : self.observer_id}
+        roi_ids = sorted(self.roi_dict)
+        N_stats = yield self.sky.pendingCount(conditions, roi_ids)
+        log.warn("Processing sky background in {N} images for {M} ROIs", N=N_stats, M=len(roi_ids))
+        # Workers decode ahead of us within their window while a single writer
+        # saves the previous batch of results to the database
+        i = 0; N_cached = 0
+        chunk = yield self.sky.pendingWithMetadata(conditions, roi_ids)
+        while chunk:
+            # The next chunk of pending work is read while this one is being processed
+            next_chunk = self.sky.pendingWithMetadata(conditions, roi_ids, after=(chunk[-1][2], chunk[-1][1], chunk[-1][0]))
+            # Rows carry their cache key columns too
+            work = list()
+            for image_id, name, directory, image_hash, header_type, exptime, cfa_pattern, date_id, time_id, camera_id, imagetype, pending_ids in chunk:
+                master_id = yield self.getMaster(camera_id, imagetype, date_id, time_id, cfa_pattern, pending_ids)
+                rows = [dict(cache_key(image_hash, self.roi_dict[roi_id], cfa_pattern), roi_id=roi_id, image_id=image_id, master_id=master_id) for roi_id in pending_ids]
+                work.append((name, directory, header_type, cfa_pattern, rows))
+            # Cached statistics come without histograms or tile maps
+            if self.cache and not (self.histograms or self.tiles):
+                all_rows = [row for *_, rows in work for row in rows]
+                hits = yield self.cache.lookup(all_rows)
+                for row, stats in zip(all_rows, hits):
+                    if stats:
+                        row.update(stats)
+            jobs = dict()   # header_type => list of processImageROIs() arguments
+            for name, directory, header_type, cfa_pattern, rows in work:
+                cached = [row for row in rows if 'aver_signal_R' in row]
+                rows   = [row for row in rows if 'aver_signal_R' not in row]
+                if cached:
+                    N_cached += len(cached)
+                    self.bufferRows(cached, computed=False)
+                if rows:
+                    rois = [self.roi_dict[row['roi_id']] for row in rows]
+                    jobs.setdefault(header_type, list()).append((name, directory, rois, header_type, cfa_pattern, rows, self.histograms, self.tiles))
+                else:
+                    i += 1
+            yield self.flush()
+            for header_type, job_list in jobs.items():
+                results = self.getWorkers(header_type).imap(processImageROIs, read_ahead(job_list, self.read_ahead))
+                try:
+                    for (name, directory, rois, header_type, cfa_pattern, rows, histograms, tiles), deferred in results:
+                        i += 1
+                        if self.logLevel == 'warn':
+                            if  (i % PAGE_SIZE) == 0:
+                                log.warn("{name} ({i}/{N}) [{p}%]", i=i, N=N_stats, name=name, p=(100*i//N_stats))
+                        else:
+                            log.info("{name} ({i}/{N}) [{p}%]", i=i, N=N_stats, name=name, p=(100*i//N_stats))
+                        try:
+                            rows = yield deferred
+                        except RAWPY_EXCEPTIONS as e:
+                            log.error("Corrupt {name} ({i}/{N}) [{p}%]", i=i, N=N_stats, name=name, p=(100*i//N_stats))
+                            yield self.image.flagAsBad(rows[0])
+                            continue
+                        finally:
+                            # Already read images must not evict the database from the page cache
+                            if self.read_ahead:
+                                dont_need(os.path.join(directory, name))
+                        self.bufferRows(rows)
+                        yield self.flush()
+                finally:
+                    results.close()
+            chunk = yield next_chunk
+        yield self.flush(force=True)
+        if N_cached:
+            log.warn("{n} sky background measurements taken from cache", n=N_cached)
         if N_stats:
             log.warn("Sky background processed in {n}/{d} images", n=i, d=N_stats)
         else:
             log.warn("No images to process for sky background")
-        
\ No newline at end of file
@@ -32,13 +32,21 @@ from twisted.internet.threads import deferToThread
 
 from pubsub import pub
 
+try:
+    from twisted.internet import inotify
+    from twisted.python.filepath import FilePath
+except ImportError:
+    inotify = None
+
 #--------------
 # local imports
 # -------------
 
 from azotea import FULL_VERSION_STRING
 from azotea.logger import setLogLevel
+from azotea.utils.workers import THREAD_POOL
 from azotea.dbase.service   import DatabaseService
+from azotea.dbase.cache     import StatsCache
 from azotea.batch.controller.image    import ImageController
 from azotea.batch.controller.sky      import SkyBackgroundController
 from azotea.batch.controller.camera   import CameraController
@@ -54,6 +62,13 @@ from azotea.batch.controller.publishing import PublishingController
 
 NAMESPACE = 'batch'
 
+CYCLE_DONE_EVENT   = 'batch_cycle_done'
+CYCLE_FAILED_EVENT = 'batch_cycle_failed'
+
+INTERVAL = 10     # Seconds between directory polls in watch mode
+
+SETTLE_TIME = 2   # Seconds to wait for new files to be completely written in watch mode
+
 # -----------------------
 # Module global variables
 # -----------------------
@@ -73,15 +88,37 @@ class BatchService(Service):
     # Service name
     NAME = NAMESPACE
 
-    def __init__(self, images_dir, depth, only_load, only_sky, only_pub, also_pub):
+    def __init__(self, images_dir, depth, only_load, only_sky, only_pub, also_pub, workers=None, pool_type=THREAD_POOL, full_scan=False,
+        watch=False, interval=INTERVAL, roi_ids=None, stats_cache=None, histograms=False, tiles=0, master_type=None, read_ahead=0, fused=False):
         super().__init__()   
         setLogLevel(namespace=NAMESPACE, levelStr='info')
         self.images_dir = images_dir
         self.depth      = depth
+        self.full_scan  = full_scan
         self.only_load  = only_load
         self.only_sky   = only_sky
         self.only_pub   = only_pub
         self.also_pub   = also_pub
+        self.workers    = workers
+        self.pool_type  = pool_type
+        self.watch      = watch
+        self.interval   = interval
+        self.roi_ids    = roi_ids
+        self.stats_cache = stats_cache
+        self.histograms  = histograms
+        self.tiles       = tiles
+        self.master_type = master_type
+        self.read_ahead  = read_ahead
+        self.fused       = fused
+        self.start_event = None
+        self.controllers = tuple()
+        self.cache       = None
+        self.notifier    = None
+        self._cycle_call = None
+        self._busy       = False
+        self._dirty      = False
+        self._cycle_start = 0
+        self._last_event  = None
 
     #------------
     # Service API
@@ -122,10 +159,20 @@ class BatchService(Service):
             next_event_sky = None
             next_event_pub = None
 
-
-            
+        # In watch mode, the last stage ends the cycle instead of quitting
+        if self.watch:
+            if next_event_img is None and start_event == 'images_load_req':
+                next_event_img = CYCLE_DONE_EVENT
+            elif next_event_sky is None and start_event != 'publishing_publish_req':
+                next_event_sky = CYCLE_DONE_EVENT
+            else:
+                next_event_pub = CYCLE_DONE_EVENT
+        self.start_event = start_event
+        # In watch mode, a failed cycle is retried instead of quitting
+        fail_event = CYCLE_FAILED_EVENT if self.watch else None
 
         self.dbaseService = self.parent.getServiceNamed(DatabaseService.NAME)
+        self.cache = StatsCache(self.stats_cache) if self.stats_cache else None
         self.controllers = (
                 CameraController(
                     model  = self.dbaseService.dao.camera,
@@ -147,16 +194,31 @@ class BatchService(Service):
                     model      = self.dbaseService.dao,
                     config     = self.dbaseService.dao.config,
                     next_event = next_event_img,
+                    workers    = self.workers,
+                    pool_type  = self.pool_type,
+                    # Only when the sky background stage follows, to take care of older pending images
+                    fused      = self.fused and next_event_img == 'sky_brightness_stats_req',
+                    fail_event = fail_event,
                 ),
                 SkyBackgroundController(
                     model      = self.dbaseService.dao,
                     config     = self.dbaseService.dao.config,
                     next_event = next_event_sky,
+                    roi_ids    = self.roi_ids,
+                    workers    = self.workers,
+                    pool_type  = self.pool_type,
+                    cache      = self.cache,
+                    histograms = self.histograms,
+                    tiles      = self.tiles,
+                    master_type = self.master_type,
+                    read_ahead  = self.read_ahead,
+                    fail_event  = fail_event,
                 ),
                 PublishingController(
                     model      = self.dbaseService.dao,
                     config     = self.dbaseService.dao.config,
                     next_event = next_event_pub,
+                    fail_event = fail_event,
                 ),
         )
         # Dirty monkey patching
@@ -165,6 +227,7 @@ class BatchService(Service):
         self.controllers[-3].cameraCtrl   = self.controllers[0]
         self.controllers[-3].observerCtrl = self.controllers[1]
         self.controllers[-3].locationCtrl = self.controllers[2]
+        self.controllers[-3].skyCtrl      = self.controllers[-2]
 
         # patch SkyBackgroundController
         self.controllers[-2].observerCtrl = self.controllers[1]
@@ -173,30 +236,99 @@ class BatchService(Service):
         # patch PublishingController
         self.controllers[-1].observerCtrl = self.controllers[1]
 
-        if start_event == 'images_load_req':
-            pub.sendMessage(start_event, root_dir=self.images_dir, depth=self.depth)
-        else:
-            pub.sendMessage(start_event)
+        if self.watch:
+            pub.subscribe(self.onCycleDone, CYCLE_DONE_EVENT)
+            pub.subscribe(self.onCycleFailed, CYCLE_FAILED_EVENT)
+            self.startWatching()
+        self.startCycle()
                 
         
 
     def stopService(self):
         log.info("Stopping Batch Service")
+        if self._cycle_call and self._cycle_call.active():
+            self._cycle_call.cancel()
+        if self.notifier:
+            self.notifier.loseConnection()
+        # Worker pools of the image and sky background controllers
+        for controller in self.controllers:
+            if hasattr(controller, 'shutdown'):
+                controller.shutdown()
+        if self.cache:
+            self.cache.close()
         
 
     # ---------------
     # OPERATIONAL API
     # ---------------
 
+    def startCycle(self):
+        self._cycle_call = None
+        self._busy  = True
+        self._dirty = False
+        self._cycle_start = reactor.seconds()
+        if self.start_event == 'images_load_req':
+            settle = SETTLE_TIME if self.watch else 0
+            pub.sendMessage(self.start_event, root_dir=self.images_dir, depth=self.depth, full_scan=self.full_scan, settle=settle)
+        else:
+            pub.sendMessage(self.start_event)
 
-    # =============
-    # Twisted Tasks
-    # =============
-   
-        
 
-      
+    def scheduleCycle(self, delay):
+        if self._busy:
+            self._dirty = True   # Another cycle is needed as soon as this one finishes
+            return
+        if self._cycle_call and self._cycle_call.active():
+            if self._cycle_call.getTime() - reactor.seconds() > delay:
+                self._cycle_call.reset(delay)
+            return
+        self._cycle_call = reactor.callLater(delay, self.startCycle)
+
+    # --------------
+    # Event handlers
+    # --------------
+
+    def onCycleDone(self):
+        self._busy = False
+        # Files notified just before this cycle may have been left for the next one
+        recent = self._last_event is not None and self._cycle_start - self._last_event < SETTLE_TIME
+        delay = SETTLE_TIME if self._dirty or recent else self.interval
+        log.info("Next cycle in {delay} seconds", delay=delay)
+        self.scheduleCycle(delay)
+
+
+    def onCycleFailed(self):
+        self._busy = False
+        log.error("Cycle failed. Retrying in {delay} seconds", delay=self.interval)
+        self.scheduleCycle(self.interval)
+
+
+    def onFileSystemEvent(self, ignored, filepath, mask):
+        log.debug("{event} {path}", event=inotify.humanReadableMask(mask), path=filepath.path)
+        self._last_event = reactor.seconds()
+        self.scheduleCycle(SETTLE_TIME)
+
     # ==============
     # Helper methods
     # ==============
 
+    def startWatching(self):
+        '''Use inotify when available, otherwise just poll every interval seconds'''
+        if inotify is None or self.start_event != 'images_load_req':
+            log.info("Polling {wd} every {n} seconds", wd=self.images_dir, n=self.interval)
+            return
+        try:
+            self.notifier = inotify.INotify()
+            self.notifier.startReading()
+            self.notifier.watch(
+                FilePath(self.images_dir),
+                mask      = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE,
+                autoAdd   = True,
+                recursive = True,
+                callbacks = [self.onFileSystemEvent],
+            )
+        except Exception as e:
+            log.warn("inotify not available ({e}). Polling {wd} every {n} seconds", e=e, wd=self.images_dir, n=self.interval)
+            self.notifier = None
+        else:
+            log.info("Watching {wd} for new images", wd=self.images_dir)
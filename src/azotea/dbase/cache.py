@@ -0,0 +1,130 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# Content addressed cache of sky statistics in a sidecar SQLite file.
+# Statistics are keyed by image hash, ROI rectangle, Bayer pattern and
+# algorithm version, so they survive database rebuilds and deletions
+# and can be shared among several observer databases.
+
+#--------------------
+# System wide imports
+# -------------------
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.logger import Logger
+from twisted.enterprise import adbapi
+
+#--------------
+# local imports
+# -------------
+
+from azotea.logger import setLogLevel
+from azotea.utils.sky import STATS_VERSION, STATS_COLUMNS
+
+# ----------------
+# Module constants
+# ----------------
+
+NAMESPACE = 'cache'
+
+KEY_COLUMNS = ('hash', 'x1', 'y1', 'x2', 'y2', 'bayer_pattern', 'version')
+
+SQL_CREATE = f'''
+    CREATE TABLE IF NOT EXISTS stats_cache_t
+    (
+        hash            BLOB,
+        x1              INTEGER,
+        y1              INTEGER,
+        x2              INTEGER,
+        y2              INTEGER,
+        bayer_pattern   TEXT,
+        version         INTEGER,
+        {', '.join(f'{column} REAL' for column in STATS_COLUMNS)},
+        PRIMARY KEY({', '.join(KEY_COLUMNS)})
+    ) WITHOUT ROWID;
+'''
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+log = Logger(namespace=NAMESPACE)
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def _openfun(connection):
+    connection.execute("PRAGMA journal_mode=WAL;")
+    connection.execute("PRAGMA synchronous=NORMAL;")
+    connection.execute(SQL_CREATE)
+    connection.commit()
+
+
+def cache_key(hash, roi, bayer_pattern):
+    '''Cache key dictionary for an image hash, ROI dictionary and Bayer pattern'''
+    return {
+        'hash'         : hash,
+        'x1'           : roi['x1'],
+        'y1'           : roi['y1'],
+        'x2'           : roi['x2'],
+        'y2'           : roi['y2'],
+        'bayer_pattern': bayer_pattern,
+        'version'      : STATS_VERSION,
+    }
+
+# --------------
+# Module Classes
+# --------------
+
+class StatsCache:
+
+    def __init__(self, path):
+        setLogLevel(namespace=NAMESPACE, levelStr='info')
+        self.path  = path
+        self._pool = adbapi.ConnectionPool("sqlite3", path, check_same_thread=False, 
+            cp_min=1, cp_max=1, cp_openfun=_openfun)
+        log.info("Using sky statistics cache at {path}", path=path)
+
+    def lookup(self, key_list):
+        '''
+        Looks up a list of cache_key() dictionaries.
+        Returns a list, with the statistics dictionary or None for each key
+        '''
+        def _lookup(txn, key_list):
+            sql = f'''
+                SELECT {', '.join(STATS_COLUMNS)}
+                FROM stats_cache_t
+                WHERE {' AND '.join(f'{column} = :{column}' for column in KEY_COLUMNS)};
+            '''
+            # One primary key probe per key, all within a single interaction.
+            # Staging the keys into a temporary table and joining it, as bulkSave() does,
+            # is not faster: the time goes to binding the key columns, not to the statements
+            result = list()
+            for key in key_list:
+                txn.execute(sql, key)
+                stats = txn.fetchone()
+                result.append(dict(zip(STATS_COLUMNS, stats)) if stats else None)
+            return result
+        return self._pool.runInteraction(_lookup, key_list)
+
+    def save(self, row_list):
+        '''Saves a list of dictionaries with both the cache_key() and the statistics columns'''
+        def _save(txn, row_list):
+            columns = KEY_COLUMNS + STATS_COLUMNS
+            sql = f'''
+                INSERT OR REPLACE INTO stats_cache_t ({', '.join(columns)})
+                VALUES ({', '.join(f':{column}' for column in columns)});
+            '''
+            txn.executemany(sql, row_list)
+        return self._pool.runInteraction(_save, row_list)
+
+    def close(self):
+        self._pool.close()
@@ -29,7 +29,7 @@ from twisted.internet.threads import deferToThread
 from azotea import SQL_SCHEMA, SQL_INITIAL_DATA_DIR, SQL_UPDATES_DATA_DIR
 
 from azotea.logger import setLogLevel
-from azotea.dbase import log, NAMESPACE, tables, image, sky, roi
+from azotea.dbase import log, NAMESPACE, tables, image, sky, roi, fingerprint, directory, master, rollup
 
 # ----------------
 # Module constants
@@ -107,12 +107,51 @@ class DataAccesObject():
             id_column           = 'image_id',
             natural_key_columns = ('name','directory'), 
             other_columns       = ('hash','iso','gain','exptime','focal_length','f_number','session', 'imagetype', 'flagged',
-                                   'date_id','time_id','camera_id','observer_id','location_id'),
+                                   'date_id','time_id','camera_id','observer_id','location_id','night_id','month_id'),
             insert_mode         = tables.INSERT,
             log_level           = img_dbg,
         )
+        self.fingerprint = fingerprint.FingerprintTable(
+            pool                = self.pool, 
+            table               = 'fingerprint_t',
+            id_column           = None,
+            natural_key_columns = ('directory','name'), 
+            other_columns       = ('size','mtime_ns','inode','hash'),
+            insert_mode         = tables.INSERT_OR_REPLACE,
+            log_level           = img_dbg,
+        )
+        self.directory = directory.DirectoryTable(
+            pool                = self.pool, 
+            table               = 'directory_t',
+            id_column           = None,
+            natural_key_columns = ('directory','extension'), 
+            other_columns       = ('mtime_ns','entries','subdirs'),
+            insert_mode         = tables.INSERT_OR_REPLACE,
+            log_level           = img_dbg,
+        )
+        self.master = master.MasterTable(
+            pool                = self.pool, 
+            table               = 'master_t',
+            id_column           = 'master_id',
+            natural_key_columns = ('key',), 
+            other_columns       = ('imagetype','method','camera_id','night_id','frames','path'),
+            insert_mode         = tables.QUERY_INSERT_OR_REPLACE,
+            log_level           = sky_dbg,
+        )
         self.sky = sky.SkyBrightness(
             pool      = self.pool,
             log_level = sky_dbg,
         )
+        self.histogram = sky.SkyHistogram(
+            pool      = self.pool,
+            log_level = sky_dbg,
+        )
+        self.tiles = sky.SkyTiles(
+            pool      = self.pool,
+            log_level = sky_dbg,
+        )
+        self.rollup = rollup.Rollup(
+            pool      = self.pool,
+            log_level = img_dbg,
+        )
         
\ No newline at end of file
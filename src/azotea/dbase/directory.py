@@ -0,0 +1,51 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import sqlite3
+import datetime
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.logger import Logger
+from twisted.enterprise import adbapi
+
+#--------------
+# local imports
+# -------------
+
+from azotea.logger import setLogLevel
+from azotea.dbase.tables import Table
+
+# ----------------
+# Module constants
+# ----------------
+
+class DirectoryTable(Table):
+
+    def loadIndex(self, filter_dict):
+        '''
+        Directories under a given root directory scanned for a given image extension.
+        Returns a dictionary directory => (mtime_ns, entries, subdirs)
+        '''
+        def _loadIndex(txn, filter_dict):
+            sql = '''
+                SELECT directory, mtime_ns, entries, subdirs
+                FROM directory_t
+                WHERE directory >= :root_dir AND directory < :root_dir || char(1114111)
+                AND substr(directory, 1, length(:root_dir)) = :root_dir
+                AND extension = :extension;
+            '''
+            self.log.debug(sql)
+            txn.execute(sql, filter_dict)
+            return {row[0]: tuple(row[1:]) for row in txn.fetchall()}
+        return self._pool.runReadInteraction(_loadIndex, filter_dict)
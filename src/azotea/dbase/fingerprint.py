@@ -0,0 +1,63 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import sqlite3
+import datetime
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.logger import Logger
+from twisted.enterprise import adbapi
+
+#--------------
+# local imports
+# -------------
+
+from azotea.logger import setLogLevel
+from azotea.dbase.tables import Table
+
+# ----------------
+# Module constants
+# ----------------
+
+class FingerprintTable(Table):
+
+    def unchanged(self, filter_dict, rejected=False):
+        '''
+        Fingerprints of files in a directory whose hash is already registered in image_t.
+        Files rejected at registration time are recorded with a NULL hash
+        and also included when rejected is True.
+        Returns a dictionary name => (size, mtime_ns, inode)
+        '''
+        def _unchanged(txn, filter_dict):
+            sql = '''
+                SELECT f.name, f.size, f.mtime_ns, f.inode
+                FROM fingerprint_t AS f
+                JOIN image_t AS i USING(hash)
+                WHERE f.directory = :directory;
+            '''
+            self.log.debug(sql)
+            txn.execute(sql, filter_dict)
+            result = {row[0]: tuple(row[1:]) for row in txn.fetchall()}
+            if rejected:
+                sql = '''
+                    SELECT name, size, mtime_ns, inode
+                    FROM fingerprint_t
+                    WHERE directory = :directory
+                    AND hash IS NULL;
+                '''
+                self.log.debug(sql)
+                txn.execute(sql, filter_dict)
+                result.update({row[0]: tuple(row[1:]) for row in txn.fetchall()})
+            return result
+        return self._pool.runReadInteraction(_unchanged, filter_dict)
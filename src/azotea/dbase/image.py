@@ -30,6 +30,12 @@ from azotea.dbase.tables import Table, VersionedTable
 # Module constants
 # ----------------
 
+# Bulk ingest outcomes
+INSERTED  = 'inserted'   # New image
+RELOCATED = 'relocated'  # Same image & name found in other directory. Directory fixed
+DUPLICATE = 'duplicate'  # Same image & name already registered in the same directory
+DISCARDED = 'discarded'  # Same image already registered with another name
+
 
 class ImageTable(Table):
 
@@ -65,6 +71,75 @@ class ImageTable(Table):
             '''Fixes directory in case of file movement'''
         return self._pool.runInteraction(_fixDirectory, filter_dict)
 
+    def bulkSave(self, rows, then=None):
+        '''
+        Insert a batch of rows resolving hash conflicts with set-based SQL in a single transaction.
+        Rows are staged into a temporary table and compared against both the existing images
+        and previous rows in the same batch.
+        The optional then(txn, inserted) function is called within the same transaction,
+        with a dictionary hash => image_id of the newly inserted images.
+        Returns a list of (name, directory, outcome, prev_name, prev_directory) tuples, one per row
+        '''
+        def _bulkSave(txn, rows, then):
+            column_list = self._natural_key_columns + self._other_columns
+            all_columns = ",".join(column_list)
+            all_values  = ",".join([f":{column}" for column in column_list])
+            txn.execute(f"CREATE TEMP TABLE IF NOT EXISTS image_staging_t (seq INTEGER PRIMARY KEY, {all_columns})")
+            txn.execute("DELETE FROM temp.image_staging_t")
+            sql = f"INSERT INTO temp.image_staging_t (seq, {all_columns}) VALUES (:seq, {all_values})"
+            self.log.debug("{sql}", sql=sql)
+            txn.executemany(sql, (dict(row, seq=seq) for seq, row in enumerate(rows)))
+            # Classify each staged row against the already registered images
+            # or else against the first staged row with the same hash
+            sql = f'''
+                SELECT s.name, s.directory,
+                    CASE
+                        WHEN p.name IS NULL               THEN '{INSERTED}'
+                        WHEN p.name != s.name             THEN '{DISCARDED}'
+                        WHEN p.directory != s.directory   THEN '{RELOCATED}'
+                        ELSE                                   '{DUPLICATE}'
+                    END,
+                    p.name, p.directory
+                FROM temp.image_staging_t AS s
+                LEFT JOIN (
+                    SELECT i.hash, i.name, i.directory, -1 AS seq FROM image_t AS i
+                    WHERE i.hash IN (SELECT hash FROM temp.image_staging_t)
+                    UNION ALL
+                    SELECT f.hash, f.name, f.directory, f.seq FROM temp.image_staging_t AS f
+                    WHERE NOT EXISTS (SELECT 1 FROM image_t AS i WHERE i.hash = f.hash)
+                    AND f.seq = (SELECT MIN(seq) FROM temp.image_staging_t AS m WHERE m.hash = f.hash)
+                ) AS p ON p.hash = s.hash AND p.seq < s.seq
+                ORDER BY s.seq
+            '''
+            txn.execute(sql)
+            report = txn.fetchall()
+            txn.execute(f'''
+                INSERT INTO image_t ({all_columns})
+                SELECT {all_columns} FROM temp.image_staging_t AS s
+                WHERE NOT EXISTS (SELECT 1 FROM image_t AS i WHERE i.hash = s.hash)
+                AND s.seq = (SELECT MIN(seq) FROM temp.image_staging_t AS m WHERE m.hash = s.hash)
+                ORDER BY s.seq
+            ''')
+            # Fixes directory in case of file movement. The latest location wins
+            txn.execute('''
+                UPDATE image_t
+                SET directory = (
+                    SELECT s.directory FROM temp.image_staging_t AS s 
+                    WHERE s.hash = image_t.hash AND s.name = image_t.name
+                    ORDER BY s.seq DESC LIMIT 1)
+                WHERE hash IN (SELECT hash FROM temp.image_staging_t)
+                AND EXISTS (
+                    SELECT 1 FROM temp.image_staging_t AS s 
+                    WHERE s.hash = image_t.hash AND s.name = image_t.name AND s.directory != image_t.directory)
+            ''')
+            if then is not None:
+                txn.execute("SELECT hash, image_id FROM image_t WHERE hash IN (SELECT hash FROM temp.image_staging_t)")
+                image_ids = dict(txn.fetchall())
+                then(txn, {row['hash']: image_ids[row['hash']] for row, outcome in zip(rows, report) if outcome[2] == INSERTED})
+            txn.execute("DELETE FROM temp.image_staging_t")
+            return report
+        return self._pool.runInteraction(_bulkSave, rows, then)
+
     def getByHash(self, filter_dict):
         def _getByHash(txn, filter_dict):
             sql = '''
@@ -74,7 +149,7 @@ class ImageTable(Table):
             '''
             txn.execute(sql, filter_dict)
             return txn.fetchone()
-        return self._pool.runInteraction(_getByHash, filter_dict)
+        return self._pool.runReadInteraction(_getByHash, filter_dict)
 
 
     # This only happens when we edit *in-place* an image after being loaded by AZOTEA
@@ -84,17 +159,18 @@ class ImageTable(Table):
         '''Purge images with the same path and different hashes'''
         def _purgeDuplicates(txn):
             # We must delete foreign key referernces first
-            txn.execute(
-                '''
-                DELETE FROM sky_brightness_t
-                WHERE image_id IN (
-                    SELECT image_id 
-                    FROM image_t 
-                    GROUP BY directory, name 
-                    HAVING count(*) > 1 AND session = MIN(session)
-                    );
-                '''
-            )
+            for table in ('sky_brightness_t', 'sky_histogram_t', 'sky_tiles_t'):
+                txn.execute(
+                    f'''
+                    DELETE FROM {table}
+                    WHERE image_id IN (
+                        SELECT image_id 
+                        FROM image_t 
+                        GROUP BY directory, name 
+                        HAVING count(*) > 1 AND session = MIN(session)
+                        );
+                    '''
+                )
             txn.execute(
                 '''
                 DELETE FROM image_t
@@ -119,42 +195,29 @@ class ImageTable(Table):
             '''
             txn.execute(sql, filter_dict)
             return txn.fetchall()
-        return self._pool.runInteraction(_imagesInDirectory, filter_dict)
+        return self._pool.runReadInteraction(_imagesInDirectory, filter_dict)
     
-    def getInitialMetadata(self, filter_dict):
-        '''Gets all the metadata needed for sky brightness mmeasurements'''
-        def _getInitialMetadata(txn, filter_dict):
-            sql = '''
-                SELECT i.name, i.directory, c.header_type, i.exptime, c.bayer_pattern, i.camera_id,  i.date_id, i.time_id, i.observer_id, i.location_id
-                FROM image_t AS i
-                JOIN camera_t AS c USING (camera_id)
-                WHERE i.image_id = :image_id;
-            '''
-            txn.execute(sql, filter_dict)
-            return txn.fetchone()
-        return self._pool.runInteraction(_getInitialMetadata, filter_dict)
-
     def summaryStatistics(self):
         def _summaryStatistics(txn):
             sql = '''
-                SELECT o.surname, o.family_name, i.imagetype, i.flagged, count(*) as cnt 
-                FROM image_t AS i
+                SELECT o.surname, o.family_name, r.imagetype, r.flagged, SUM(r.images) as cnt 
+                FROM image_rollup_t AS r
                 JOIN observer_t AS o USING(observer_id)
-                GROUP BY observer_id, i.imagetype, i.flagged
-                ORDER BY o.surname, o.family_name, i.imagetype, cnt DESC'''
+                GROUP BY observer_id, r.imagetype, r.flagged
+                ORDER BY o.surname, o.family_name, r.imagetype, cnt DESC'''
             txn.execute(sql)
             return txn.fetchall()
-        return self._pool.runInteraction(_summaryStatistics)
+        return self._pool.runReadInteraction(_summaryStatistics)
 
     def rangeSummary(self):
         def _rangeSummary(txn):
             sql = '''
-                SELECT o.surname, o.family_name, MIN(d.sql_date), MAX(d.sql_date), count(*) as cnt 
-                FROM image_t AS i
+                SELECT o.surname, o.family_name, MIN(d.sql_date), MAX(d.sql_date), SUM(r.images) as cnt 
+                FROM image_rollup_t AS r
                 JOIN observer_t AS o USING(observer_id)
                 JOIN date_t AS d USING(date_id)
                 GROUP BY observer_id
                 ORDER BY o.surname, o.family_name'''
             txn.execute(sql)
             return txn.fetchall()
-        return self._pool.runInteraction(_rangeSummary)
+        return self._pool.runReadInteraction(_rangeSummary)
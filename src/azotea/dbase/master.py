@@ -0,0 +1,68 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.logger import Logger
+from twisted.enterprise import adbapi
+
+#--------------
+# local imports
+# -------------
+
+from azotea.logger import setLogLevel
+from azotea.dbase.tables import Table
+
+# ----------------
+# Module constants
+# ----------------
+
+class MasterTable(Table):
+
+    def calibrationImages(self, filter_dict):
+        '''
+        Calibration images of a given type for an observer.
+        Returns a list of (camera_id, header_type, date_id, time_id, name, directory, hash)
+        '''
+        def _calibrationImages(txn, filter_dict):
+            sql = '''
+                SELECT i.camera_id, c.header_type, i.date_id, i.time_id, i.name, i.directory, i.hash
+                FROM image_t AS i
+                JOIN camera_t AS c USING(camera_id)
+                WHERE i.observer_id = :observer_id
+                AND i.imagetype = :imagetype
+                AND i.flagged = 0
+                ORDER BY i.camera_id, i.date_id, i.time_id;
+            '''
+            self.log.debug(sql)
+            txn.execute(sql, filter_dict)
+            return txn.fetchall()
+        return self._pool.runReadInteraction(_calibrationImages, filter_dict)
+
+
+    def loadIndex(self, filter_dict):
+        '''
+        Latest master frames of a given type.
+        Returns a dictionary (camera_id, night_id) => (master_id, path)
+        '''
+        def _loadIndex(txn, filter_dict):
+            sql = '''
+                SELECT camera_id, night_id, master_id, path
+                FROM master_t
+                WHERE imagetype = :imagetype
+                ORDER BY master_id;
+            '''
+            self.log.debug(sql)
+            txn.execute(sql, filter_dict)
+            return {(camera_id, night_id): (master_id, path) for camera_id, night_id, master_id, path in txn.fetchall()}
+        return self._pool.runReadInteraction(_loadIndex, filter_dict)
@@ -49,4 +49,4 @@ class ROITable(Table):
             if result:
                 result = dict(zip((self._id_column,), result))
             return result
-        return self._pool.runInteraction(_lookupByComment, filter_dict)
+        return self._pool.runReadInteraction(_lookupByComment, filter_dict)
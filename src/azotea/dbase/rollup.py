@@ -0,0 +1,83 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# Summary rollup tables image_rollup_t and sky_rollup_t are kept current
+# by triggers on image_t and sky_brightness_t. They can also be rebuilt
+# from scratch, which doubles as a consistency check of the triggers.
+
+#--------------------
+# System wide imports
+# -------------------
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.logger import Logger
+
+#--------------
+# local imports
+# -------------
+
+from azotea.logger import setLogLevel
+
+# ----------------
+# Module constants
+# ----------------
+
+# Rollup table => contents computed from the base tables
+ROLLUPS = {
+    'image_rollup_t': '''
+        SELECT observer_id, night_id, date_id, imagetype, flagged, COUNT(*)
+        FROM image_t
+        GROUP BY observer_id, night_id, date_id, imagetype, flagged
+    ''',
+    'sky_rollup_t': '''
+        SELECT i.observer_id, i.night_id, i.date_id, s.roi_id, s.published, COUNT(*)
+        FROM sky_brightness_t AS s
+        JOIN image_t AS i USING(image_id)
+        GROUP BY i.observer_id, i.night_id, i.date_id, s.roi_id, s.published
+    ''',
+}
+
+# --------------
+# Module Classes
+# --------------
+
+class Rollup:
+
+    def __init__(self, pool, log_level):
+        self._pool = pool
+        self.log = Logger(namespace='rollup')
+        setLogLevel(namespace='rollup', levelStr=log_level)
+
+
+    def rebuild(self, check_only=False):
+        '''
+        Compares the rollup tables with their contents computed from the base tables
+        and rewrites them unless check_only is set.
+        Returns a dictionary rollup table => number of stale or missing rows
+        '''
+        def _rebuild(txn, check_only):
+            result = dict()
+            for table, select in ROLLUPS.items():
+                txn.execute("DROP TABLE IF EXISTS temp.rollup_fresh_t")
+                txn.execute(f"CREATE TEMP TABLE rollup_fresh_t AS {select}")
+                sql = f'''
+                    SELECT
+                        (SELECT COUNT(*) FROM (SELECT * FROM {table} EXCEPT SELECT * FROM temp.rollup_fresh_t)) +
+                        (SELECT COUNT(*) FROM (SELECT * FROM temp.rollup_fresh_t EXCEPT SELECT * FROM {table}))
+                '''
+                self.log.debug(sql)
+                txn.execute(sql)
+                result[table] = txn.fetchone()[0]
+                if result[table] and not check_only:
+                    txn.execute(f"DELETE FROM {table}")
+                    txn.execute(f"INSERT INTO {table} SELECT * FROM temp.rollup_fresh_t")
+                txn.execute("DROP TABLE temp.rollup_fresh_t")
+            return result
+        return self._pool.runInteraction(_rebuild, check_only)
@@ -53,6 +53,41 @@ from azotea.dbase import NAMESPACE, log
 
 SQL_TEST_STRING = "SELECT COUNT(*) FROM image_t"
 
+# SQLite pragmas applied to every new connection, by profile name.
+# All of them use WAL, so that readers never wait for the writer
+PRAGMA_PROFILES = {
+    'default' : {
+        'journal_mode' : 'WAL',
+        'synchronous'  : 'NORMAL',      # May lose the last transactions on power loss, never corrupts
+        'foreign_keys' : 'ON',
+        'temp_store'   : 'MEMORY',
+        'cache_size'   : -65536,        # KiB
+        'mmap_size'    : 268435456,     # bytes
+    },
+    'safe' : {
+        'journal_mode' : 'WAL',
+        'synchronous'  : 'FULL',
+        'foreign_keys' : 'ON',
+        'temp_store'   : 'MEMORY',
+        'cache_size'   : -65536,
+        'mmap_size'    : 268435456,
+    },
+    'low-memory' : {
+        'journal_mode' : 'WAL',
+        'synchronous'  : 'NORMAL',
+        'foreign_keys' : 'ON',
+        'temp_store'   : 'DEFAULT',
+        'cache_size'   : -2000,
+        'mmap_size'    : 0,
+    },
+}
+
+DEFAULT_PROFILE = 'default'
+
+READER_CONNECTIONS = 3      # Read only connections, besides the single writer connection
+
+MAINTENANCE_PERIOD = 3600   # Seconds between PRAGMA optimize runs in long running sessions
+
 # -----------------------
 # Module global variables
 # -----------------------
@@ -67,6 +102,20 @@ def getPool(*args, **kargs):
     return adbapi.ConnectionPool("sqlite3", *args, **kargs)
 
 
+def apply_pragmas(connection, profile):
+    for pragma, value in PRAGMA_PROFILES[profile].items():
+        connection.execute(f"PRAGMA {pragma}={value};")
+
+
+def openfun_factory(profile, read_only=False):
+    '''Connection initialization function for adbapi applying a pragma profile'''
+    def _openfun(connection):
+        apply_pragmas(connection, profile)
+        if read_only:
+            connection.execute("PRAGMA query_only=ON;")
+    return _openfun
+
+
 def read_database_version(connection):
     cursor = connection.cursor()
     query = 'SELECT value FROM config_t WHERE section = "database" AND property = "version";'
@@ -145,25 +194,52 @@ def read_debug_levels(connection):
 # Module Classes
 # --------------
 
+class SQLitePool:
+    '''
+    A single writer connection plus a pool of read only connections to the same database.
+    runInteraction() goes to the writer, so that writes are queued in this process instead
+    of failing with 'database is locked'. runReadInteraction() goes to the readers,
+    which in WAL mode do not wait for the writer, even in another process.
+    '''
+
+    def __init__(self, path, profile=DEFAULT_PROFILE, readers=READER_CONNECTIONS):
+        self.writer = getPool(path, cp_min=1, cp_max=1, cp_openfun=openfun_factory(profile))
+        self.reader = getPool(path, cp_min=1, cp_max=readers, cp_openfun=openfun_factory(profile, read_only=True))
+
+    def runInteraction(self, interaction, *args, **kw):
+        return self.writer.runInteraction(interaction, *args, **kw)
+
+    def runReadInteraction(self, interaction, *args, **kw):
+        return self.reader.runInteraction(interaction, *args, **kw)
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
 class DatabaseService(Service):
 
     # Service name
     NAME = NAMESPACE
 
-    def __init__(self, path, create_only, **kargs):
+    def __init__(self, path, create_only, profile=DEFAULT_PROFILE, **kargs):
         super().__init__()   
         self.path = path
         self.pool = None
         self.preferences = None
-        self.getPoolFunc = getPool
         self.create_only = create_only
-    
-    def foreign_keys(self, flag):
-        def _foreign_keys(txn, flag):
-            value = "ON" if flag else "OFF"
-            sql = f"PRAGMA foreign_keys={value};"
-            txn.execute(sql)
-        return self.pool.runInteraction(_foreign_keys, flag)
+        self.profile = profile
+        self.maintenanceTask = task.LoopingCall(self.onMaintenanceReq)
+
+    def maintenance(self, vacuum=True):
+        '''Refreshes the query planner statistics and gives back the pages freed by bulk deletes'''
+        def _maintenance(txn, vacuum):
+            txn.execute("PRAGMA optimize;")
+            txn.execute("PRAGMA freelist_count;")
+            if vacuum and txn.fetchone()[0]:
+                # execute() would only run the first step, freeing a single page
+                txn.executescript("PRAGMA incremental_vacuum;")
+        return self.pool.runInteraction(_maintenance, vacuum)
 
     #------------
     # Service API
@@ -181,6 +257,7 @@ class DatabaseService(Service):
         else:
             for sql_file in file_list:
                 log.warn("Applying updates to data model from {f}", f=os.path.basename(sql_file))
+        apply_pragmas(connection, self.profile)
         levels  = read_debug_levels(connection)
         version = read_database_version(connection)
         guid    = make_database_uuid(connection)
@@ -191,6 +268,7 @@ class DatabaseService(Service):
             uuid     = guid,
         )
         pub.subscribe(self.quit,  'quit')
+        pub.subscribe(self.onMaintenanceReq, 'database_maintenance_req')
         # Remainder Service initialization
         super().startService()
         connection.commit()
@@ -202,11 +280,13 @@ class DatabaseService(Service):
             self.dao = DataAccesObject(self.pool, *levels)
             self.dao.version = version
             self.dao.uuid = guid
-            self.foreign_keys(True)
+            self.maintenanceTask.start(MAINTENANCE_PERIOD, now=False)
 
 
     def stopService(self):
         log.info("Stopping Database Service")
+        if self.maintenanceTask.running:
+            self.maintenanceTask.stop()
         self.closePool()
         try:
             reactor.stop()
@@ -219,10 +299,28 @@ class DatabaseService(Service):
     # OPERATIONAL API
     # ---------------
 
+    @inlineCallbacks
     def quit(self, exit_code = 0):
         set_status_code(exit_code)
+        if self.pool:
+            # As recommended by SQLite before closing the connections
+            try:
+                yield self.maintenance(vacuum=False)
+            except Exception as e:
+                log.warn("Database maintenance skipped: {e}", e=e)
         reactor.callLater(0, self.parent.stopService)
 
+    # --------------
+    # Event handlers
+    # --------------
+
+    @inlineCallbacks
+    def onMaintenanceReq(self):
+        try:
+            yield self.maintenance()
+        except Exception as e:
+            log.warn("Database maintenance skipped: {e}", e=e)
+
     # =============
     # Twisted Tasks
     # =============
@@ -237,12 +335,14 @@ class DatabaseService(Service):
     def openPool(self):
         # setup the connection pool for asynchronouws adbapi
         log.debug("Opening DB Connection to {conn!s}", conn=self.path)
-        self.pool  = self.getPoolFunc(self.path)
+        self.pool  = SQLitePool(self.path, self.profile)
         log.debug("Opened DB Connection to {conn!s}", conn=self.path)
 
 
     def closePool(self):
         '''setup the connection pool for asynchronouws adbapi'''
         log.debug("Closing DB Connection to {conn!s}", conn=self.path)
-        self.pool.close()
+        if self.pool:
+            self.pool.close()
+            self.pool = None
         log.debug("Closed DB Connection to {conn!s}", conn=self.path)
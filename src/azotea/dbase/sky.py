@@ -25,6 +25,7 @@ from twisted.enterprise import adbapi
 
 from azotea.logger import setLogLevel
 from azotea.dbase.tables import Table, VersionedTable
+from azotea.utils.sky import decode_histogram, decode_tiles
 
 # ----------------
 # Module constants
@@ -52,6 +53,8 @@ PUB_COLUMN_NAMES = (
     'aver_signal_G2','vari_signal_G2','aver_signal_B','vari_signal_B'
 )
 
+PENDING_CHUNK = 1000   # Pending images read per query
+
 
 # ------------------------
 # Module Utility Functions
@@ -88,29 +91,28 @@ class SkyBrightness:
     def summaryStatistics(self):
         def _summaryStatistics(txn):
             sql = '''
-                SELECT o.surname, o.family_name, s.display_name, s.width, s.height, s.published, count(*) as cnt
-                FROM image_t AS i
+                SELECT o.surname, o.family_name, r.display_name, (r.x2 - r.x1), (r.y2 - r.y1), k.published, SUM(k.measurements) as cnt
+                FROM sky_rollup_t AS k
                 JOIN observer_t AS o USING(observer_id)
-                JOIN sky_brightness_v AS s USING(image_id)
-                GROUP BY observer_id,  s.display_name --, s.published # I don't know why this is not working
-                ORDER BY o.surname, s.display_name, cnt DESC'''
+                JOIN roi_t AS r USING(roi_id)
+                GROUP BY observer_id,  r.display_name --, k.published # I don't know why this is not working
+                ORDER BY o.surname, r.display_name, cnt DESC'''
             txn.execute(sql)
             return txn.fetchall()
-        return self._pool.runInteraction(_summaryStatistics)
+        return self._pool.runReadInteraction(_summaryStatistics)
 
     def rangeSummary(self):
         def _rangeSummary(txn):
             sql = '''
-                SELECT o.surname, o.family_name, MIN(d.sql_date), MAX(d.sql_date), count(*) as cnt
-                FROM image_t AS i
+                SELECT o.surname, o.family_name, MIN(d.sql_date), MAX(d.sql_date), SUM(k.measurements) as cnt
+                FROM sky_rollup_t AS k
                 JOIN observer_t AS o USING(observer_id)
-                JOIN sky_brightness_v AS s USING(image_id)
                 JOIN date_t AS d USING(date_id)
                 GROUP BY observer_id
                 ORDER BY o.surname, o.family_name'''
             txn.execute(sql)
             return txn.fetchall()
-        return self._pool.runInteraction(_rangeSummary)
+        return self._pool.runReadInteraction(_rangeSummary)
 
     def countAll(self, filter_dict):
         def _countAll(txn, filter_dict):
@@ -120,7 +122,7 @@ class SkyBrightness:
                 WHERE i.observer_id = :observer_id;'''
             txn.execute(sql, filter_dict)
             return txn.fetchone()[0]
-        return self._pool.runInteraction(_countAll, filter_dict)
+        return self._pool.runReadInteraction(_countAll, filter_dict)
 
     def deleteAll(self, filter_dict):
         def _deleteAll(txn, filter_dict):
@@ -152,19 +154,12 @@ class SkyBrightness:
         def _deleteLatestNight(txn, filter_dict):
             sql = '''DELETE FROM sky_brightness_t
             WHERE image_id IN (
-                SELECT i.image_id 
-                FROM image_t AS i
-                JOIN date_t AS d USING(date_id)
-                JOIN time_t AS t USING(time_id)
-                JOIN observer_t AS o USING(observer_id)
-                WHERE i.observer_id = :observer_id
-                AND round((d.julian_day - 0.5 + t.day_fraction),0) = (
-                    SELECT MAX(round((d.julian_day - 0.5 + t.day_fraction),0))
-                    FROM image_t AS i
-                    JOIN date_t AS d USING(date_id)
-                    JOIN time_t AS t USING(time_id)
-                    JOIN observer_t AS o USING(observer_id)
-                    WHERE i.observer_id = :observer_id
+                SELECT image_id 
+                FROM image_t
+                WHERE observer_id = :observer_id
+                AND night_id = (
+                    SELECT MAX(night_id) FROM image_t
+                    WHERE observer_id = :observer_id
                 )
             )
             '''
@@ -176,23 +171,11 @@ class SkyBrightness:
             sql = '''DELETE FROM sky_brightness_t
             WHERE image_id IN (
                 SELECT image_id
-                FROM sky_brightness_t AS s
-                JOIN date_t AS d USING(date_id)
-                JOIN observer_t AS o USING(observer_id)
-                WHERE s.observer_id = :observer_id
-                AND d.year = (
-                    SELECT MAX(d.year)
-                    FROM sky_brightness_t AS s
-                    JOIN date_t AS d USING(date_id)
-                    JOIN observer_t AS o USING(observer_id)
-                    WHERE s.observer_id = :observer_id
-                )
-                AND d.month_num = (
-                    SELECT MAX(d.month_num)
-                    FROM sky_brightness_t AS s
-                    JOIN date_t AS d USING(date_id)
-                    JOIN observer_t AS o USING(observer_id)
-                    WHERE s.observer_id = :observer_id
+                FROM image_t
+                WHERE observer_id = :observer_id
+                AND month_id = (
+                    SELECT MAX(month_id) FROM image_t
+                    WHERE observer_id = :observer_id
                 )
             )
             '''
@@ -213,147 +196,163 @@ class SkyBrightness:
         return self._pool.runInteraction(_deleteDateRange, filter_dict)
 
 
-    # For the time being, no filter
-    def pending(self, filter_dict):
-        def _pending(txn, filter_dict):
-            sql = '''
-                SELECT image_id
-                FROM image_t
-                WHERE flagged = 0
-                AND observer_id = :observer_id
-                EXCEPT 
-                SELECT DISTINCT image_id 
-                FROM sky_brightness_t;
-            '''
+    # Pending work is read in chunks, ordered by directory and name.
+    # image_id breaks the ties of FITS images edited in place, registered twice until purged
+    def _sqlPending(self, roi_ids, columns):
+        roi_list = ','.join(f":roi_{roi_id}" for roi_id in roi_ids)
+        return f'''
+            SELECT {columns}
+            FROM image_t AS i
+            JOIN camera_t AS c USING (camera_id)
+            JOIN roi_t AS r ON r.roi_id IN ({roi_list})
+            WHERE i.flagged = 0
+            AND i.observer_id = :observer_id
+            AND (i.directory, i.name, i.image_id) > (:last_directory, :last_name, :last_image_id)
+            AND NOT EXISTS (
+                SELECT 1 FROM sky_brightness_t AS s 
+                WHERE s.image_id = i.image_id AND s.roi_id = r.roi_id)
+        '''
+
+    def _sqlPendingWithMetadata(self, roi_ids):
+        # Grouped in the pending images index order, so that no sorting is needed
+        columns = 'i.image_id, i.name, i.directory, i.hash, c.header_type, i.exptime, c.bayer_pattern, i.date_id, i.time_id, i.camera_id, i.imagetype, group_concat(r.roi_id)'
+        return self._sqlPending(roi_ids, columns) + '''
+            GROUP BY i.directory, i.name, i.image_id
+            ORDER BY i.directory, i.name, i.image_id
+            LIMIT :limit;
+        '''
+
+    def _pendingParams(self, filter_dict, roi_ids, after):
+        params = dict(filter_dict, last_directory=after[0], last_name=after[1], last_image_id=after[2])
+        params.update({f"roi_{roi_id}": roi_id for roi_id in roi_ids})
+        return params
+
+    def pendingCount(self, filter_dict, roi_ids):
+        '''Number of images with some of the given ROIs not yet measured'''
+        def _pendingCount(txn, filter_dict, roi_ids):
+            sql = self._sqlPending(roi_ids, 'count(DISTINCT i.image_id)')
             self.log.debug(sql)
-            txn.execute(sql, filter_dict)
-            return txn.fetchall()
-        return self._pool.runInteraction(_pending, filter_dict)
+            txn.execute(sql, self._pendingParams(filter_dict, roi_ids, ('', '', 0)))
+            return txn.fetchone()[0]
+        return self._pool.runReadInteraction(_pendingCount, filter_dict, roi_ids)
+
+    def pendingWithMetadata(self, filter_dict, roi_ids, after=('', '', 0), limit=PENDING_CHUNK):
+        '''
+        Next chunk of pending work after the (directory, name, image_id) given, with all the metadata needed for sky brightness measurements.
+        Returns a list of (image_id, name, directory, hash, header_type, exptime, bayer_pattern, date_id, time_id, camera_id, imagetype, [roi_id, ...])
+        with the ROIs not yet measured for each image. An empty list means no more pending work.
+        Images come in directory and file name order, so that they are read sequentially from disk.
+        '''
+        def _pendingWithMetadata(txn, filter_dict, roi_ids, after, limit):
+            sql = self._sqlPendingWithMetadata(roi_ids)
+            self.log.debug(sql)
+            params = self._pendingParams(filter_dict, roi_ids, after)
+            params['limit'] = limit
+            txn.execute(sql, params)
+            return [row[:-1] + (sorted(int(roi_id) for roi_id in row[-1].split(',')),) for row in txn.fetchall()]
+        return self._pool.runReadInteraction(_pendingWithMetadata, filter_dict, roi_ids, after, limit)
+
+    def saveRows(self, txn, row_dict):
+        '''Same as save(), within an already running transaction'''
+        sql = '''
+            INSERT INTO sky_brightness_t (
+                image_id,
+                roi_id,
+                aver_signal_R,
+                vari_signal_R,
+                aver_signal_G1,
+                vari_signal_G1,
+                aver_signal_G2,
+                vari_signal_G2,
+                aver_signal_B,
+                vari_signal_B,
+                master_id
+            )
+            VALUES (
+                :image_id,
+                :roi_id,
+                :aver_signal_R,
+                :vari_signal_R,
+                :aver_signal_G1,
+                :vari_signal_G1,
+                :aver_signal_G2,
+                :vari_signal_G2,
+                :aver_signal_B,
+                :vari_signal_B,
+                :master_id
+            )
+        '''
+        self.log.debug(sql)
+        # Only dark subtracted measurements come with a master frame
+        if type(row_dict) in (list, tuple):
+            txn.executemany(sql, (dict(row, master_id=row.get('master_id')) for row in row_dict))
+        else:
+            txn.execute(sql, dict(row_dict, master_id=row_dict.get('master_id')))
 
     def save(self, row_dict):
-        def _save(txn, row_dict):
-            sql = '''
-                INSERT INTO sky_brightness_t (
-                    image_id,
-                    roi_id,
-                    aver_signal_R,
-                    vari_signal_R,
-                    aver_signal_G1,
-                    vari_signal_G1,
-                    aver_signal_G2,
-                    vari_signal_G2,
-                    aver_signal_B,
-                    vari_signal_B
-                )
-                VALUES (
-                    :image_id,
-                    :roi_id,
-                    :aver_signal_R,
-                    :vari_signal_R,
-                    :aver_signal_G1,
-                    :vari_signal_G1,
-                    :aver_signal_G2,
-                    :vari_signal_G2,
-                    :aver_signal_B,
-                    :vari_signal_B
-                )
-            '''
-            self.log.debug(sql)
-            if type(row_dict) in (list, tuple):
-                txn.executemany(sql, row_dict)
-            else:
-                txn.execute(sql, row_dict)
-        return self._pool.runInteraction(_save, row_dict)
+        return self._pool.runInteraction(self.saveRows, row_dict)
 
     # To generate a file name
     def getLatestMonth(self, filter_dict):
         def _getLatestMonth(txn, filter_dict):
             sql = '''
-            SELECT MAX(d.year),MAX(d.month_num),1
-            FROM image_t AS i
-            JOIN date_t AS d USING(date_id)
-            JOIN observer_t AS o USING(observer_id)
-            WHERE i.observer_id = :observer_id
+            SELECT month_id / 100, month_id % 100, 1
+            FROM (
+                SELECT MAX(month_id) AS month_id FROM image_t
+                WHERE observer_id = :observer_id
+            )
             '''
             self.log.debug(sql)
             txn.execute(sql, filter_dict)
             return txn.fetchone()
-        return self._pool.runInteraction(_getLatestMonth, filter_dict)
+        return self._pool.runReadInteraction(_getLatestMonth, filter_dict)
 
     def getLatestMonthCount(self, filter_dict):
         def _getLatestMonthCount(txn, filter_dict):
             sql = '''
             SELECT COUNT(*)
-            FROM image_t AS i
-            JOIN date_t AS d USING(date_id)
-            JOIN observer_t AS o USING(observer_id)
-            WHERE i.observer_id = :observer_id
-            AND d.year = (
-                SELECT MAX(d.year)
-                FROM image_t AS i
-                JOIN date_t AS d USING(date_id)
-                JOIN observer_t AS o USING(observer_id)
-                WHERE i.observer_id = :observer_id
-            )
-            AND d.month_num = (
-                SELECT MAX(d.month_num)
-                FROM image_t AS i
-                JOIN date_t AS d USING(date_id)
-                JOIN observer_t AS o USING(observer_id)
-                WHERE i.observer_id = :observer_id
+            FROM image_t
+            WHERE observer_id = :observer_id
+            AND month_id = (
+                SELECT MAX(month_id) FROM image_t
+                WHERE observer_id = :observer_id
             )
             '''
             self.log.debug(sql)
             txn.execute(sql, filter_dict)
             return txn.fetchone()[0]
-        return self._pool.runInteraction(_getLatestMonthCount, filter_dict)
+        return self._pool.runReadInteraction(_getLatestMonthCount, filter_dict)
 
     # To generate a file name
     def getLatestNight(self, filter_dict):
         def _getLatestNight(txn, filter_dict):
             sql = '''
-            SELECT d.year, d.month_num, d.day
-            FROM image_t AS i
-            JOIN date_t AS d USING(date_id)
-            JOIN time_t AS t USING(time_id)
-            JOIN observer_t AS o USING(observer_id)
-            WHERE i.observer_id = :observer_id
-            AND round((d.julian_day - 0.5 + t.day_fraction),0) = (
-                SELECT MAX(round((d.julian_day - 0.5 + t.day_fraction),0))
-                FROM image_t AS i
-                JOIN date_t AS d USING(date_id)
-                JOIN time_t AS t USING(time_id)
-                JOIN observer_t AS o USING(observer_id)
-                WHERE i.observer_id = :observer_id
+            SELECT night_id / 10000, (night_id / 100) % 100, night_id % 100
+            FROM (
+                SELECT MAX(night_id) AS night_id FROM image_t
+                WHERE observer_id = :observer_id
             )
             '''
             self.log.debug(sql)
             txn.execute(sql, filter_dict)
             return txn.fetchone()
-        return self._pool.runInteraction(_getLatestNight, filter_dict)
+        return self._pool.runReadInteraction(_getLatestNight, filter_dict)
 
     def getLatestNightCount(self, filter_dict):
         def _getLatestNightCount(txn, filter_dict):
             sql = '''
             SELECT count(*)
             FROM image_t AS i
-            JOIN date_t AS d USING(date_id)
-            JOIN time_t AS t USING(time_id)
-            JOIN observer_t AS o USING(observer_id)
             WHERE i.observer_id = :observer_id
-            AND round((d.julian_day - 0.5 + t.day_fraction),0) = (
-                SELECT MAX(round((d.julian_day - 0.5 + t.day_fraction),0))
-                FROM image_t AS i
-                JOIN date_t AS d USING(date_id)
-                JOIN time_t AS t USING(time_id)
-                JOIN observer_t AS o USING(observer_id)
-                WHERE i.observer_id = :observer_id
+            AND i.night_id = (
+                SELECT MAX(night_id) FROM image_t
+                WHERE observer_id = :observer_id
             )
             '''
             self.log.debug(sql)
             txn.execute(sql, filter_dict)
             return txn.fetchone()[0]
-        return self._pool.runInteraction(_getLatestNightCount, filter_dict)
+        return self._pool.runReadInteraction(_getLatestNightCount, filter_dict)
 
     def getDateRangeCount(self, filter_dict):
         def _getDateRangeCount(txn, filter_dict):
@@ -367,7 +366,7 @@ class SkyBrightness:
             self.log.debug(sql)
             txn.execute(sql, filter_dict)
             return txn.fetchone()[0]
-        return self._pool.runInteraction(_getDateRangeCount, filter_dict)
+        return self._pool.runReadInteraction(_getDateRangeCount, filter_dict)
 
 
     def exportAll(self, filter_dict):
@@ -409,7 +408,7 @@ class SkyBrightness:
             self.log.debug(sql)
             txn.execute(sql, filter_dict)
             return txn.fetchall()
-        return self._pool.runInteraction(_exportAll, filter_dict)
+        return self._pool.runReadInteraction(_exportAll, filter_dict)
 
 
     def exportUnpublished(self, filter_dict):
@@ -452,7 +451,7 @@ class SkyBrightness:
             self.log.debug(sql)
             txn.execute(sql, filter_dict)
             return txn.fetchall()
-        return self._pool.runInteraction(_exportUnpublished, filter_dict)
+        return self._pool.runReadInteraction(_exportUnpublished, filter_dict)
 
 
     def exportDateRange(self, filter_dict):
@@ -495,7 +494,7 @@ class SkyBrightness:
             self.log.debug(sql)
             txn.execute(sql, filter_dict)
             return txn.fetchall()
-        return self._pool.runInteraction(_exportDateRange, filter_dict)
+        return self._pool.runReadInteraction(_exportDateRange, filter_dict)
 
 
     def exportLatestNight(self, filter_dict):
@@ -532,20 +531,16 @@ class SkyBrightness:
             JOIN observer_t AS o USING(observer_id)
             JOIN location_t AS l USING(location_id)
             WHERE i.observer_id = :observer_id
-            AND round((d.julian_day - 0.5 + t.day_fraction),0) = (
-                SELECT MAX(round((d.julian_day - 0.5 + t.day_fraction),0))
-                FROM image_t AS i
-                JOIN date_t AS d USING(date_id)
-                JOIN time_t AS t USING(time_id)
-                JOIN observer_t AS o USING(observer_id)
-                WHERE i.observer_id = :observer_id
+            AND i.night_id = (
+                SELECT MAX(night_id) FROM image_t
+                WHERE observer_id = :observer_id
             )
             ORDER BY i.date_id ASC, i.time_id ASC;
             '''
             self.log.debug(sql)
             txn.execute(sql, filter_dict)
             return txn.fetchall()
-        return self._pool.runInteraction(_exportLatestNight, filter_dict)
+        return self._pool.runReadInteraction(_exportLatestNight, filter_dict)
 
     def exportLatestMonth(self, filter_dict):
         def _exportLatestMonth(txn, filter_dict):
@@ -581,26 +576,16 @@ class SkyBrightness:
             JOIN observer_t AS o USING(observer_id)
             JOIN location_t AS l USING(location_id)
             WHERE i.observer_id = :observer_id
-            AND d.month_num = (
-                SELECT MAX(d.month_num)
-                FROM image_t AS i
-                JOIN date_t AS d USING(date_id)
-                JOIN observer_t AS o USING(observer_id)
-                WHERE i.observer_id = :observer_id
-            )
-            AND d.year = (
-                SELECT MAX(d.year)
-                FROM image_t AS i
-                JOIN date_t AS d USING(date_id)
-                JOIN observer_t AS o USING(observer_id)
-                WHERE i.observer_id = :observer_id
+            AND i.month_id = (
+                SELECT MAX(month_id) FROM image_t
+                WHERE observer_id = :observer_id
             )
             ORDER BY i.date_id ASC, i.time_id ASC;
             '''
             self.log.debug(sql)
             txn.execute(sql, filter_dict)
             return txn.fetchall()
-        return self._pool.runInteraction(_exportLatestMonth, filter_dict)
+        return self._pool.runReadInteraction(_exportLatestMonth, filter_dict)
 
 
     def getPublishingCount(self, filter_dict):
@@ -615,7 +600,7 @@ class SkyBrightness:
             self.log.debug(sql)
             txn.execute(sql, filter_dict)
             return txn.fetchone()[0]
-        return self._pool.runInteraction(_getPublishingCount, filter_dict)
+        return self._pool.runReadInteraction(_getPublishingCount, filter_dict)
 
 
     def updatePublishingCount(self, filter_dict):
@@ -664,6 +649,114 @@ class SkyBrightness:
             self.log.debug(sql)
             txn.execute(sql, filter_dict) 
             return tuple(slice_func(row) for row in txn.fetchall())
-        return self._pool.runInteraction(_getAll, filter_dict)
+        return self._pool.runReadInteraction(_getAll, filter_dict)
+
+
+class SkyHistogram:
+
+    def __init__(self, pool, log_level):
+        self._pool = pool
+        self.log = Logger(namespace='sky_histogram_t')
+        setLogLevel(namespace='sky_histogram_t', levelStr=log_level)
+
+
+    def saveRows(self, txn, row_list):
+        '''Same as save(), within an already running transaction'''
+        sql = '''
+            INSERT OR REPLACE INTO sky_histogram_t (image_id, roi_id, channel, origin, counts)
+            VALUES (?, ?, ?, ?, ?);
+        '''
+        txn.executemany(sql, (
+            (row['image_id'], row['roi_id'], channel, origin, counts)
+            for row in row_list 
+            for channel, (origin, counts) in row.get('histograms', {}).items()
+        ))
+
+
+    def save(self, row_list):
+        '''Saves the histograms found under the 'histograms' key of sky brightness rows'''
+        return self._pool.runInteraction(self.saveRows, row_list)
+
+
+    def derive(self, filter_dict, func):
+        '''
+        Derives a new statistic from the stored histograms of an observer and ROI,
+        applying func(values, counts) to each channel histogram given as NumPy arrays.
+        Returns a list of (image_id, channel, statistic)
+        '''
+        def _derive(txn, filter_dict, func):
+            sql = '''
+                SELECT h.image_id, h.channel, h.origin, h.counts
+                FROM sky_histogram_t AS h
+                JOIN image_t AS i USING(image_id)
+                WHERE i.observer_id = :observer_id
+                AND h.roi_id = :roi_id
+                ORDER BY h.image_id, h.channel;
+            '''
+            self.log.debug(sql)
+            txn.execute(sql, filter_dict)
+            return [(image_id, channel, func(*decode_histogram(origin, counts))) for image_id, channel, origin, counts in iter(txn.fetchone, None)]
+        return self._pool.runReadInteraction(_derive, filter_dict, func)
+
+
+class SkyTiles:
+
+    def __init__(self, pool, log_level):
+        self._pool = pool
+        self.log = Logger(namespace='sky_tiles_t')
+        setLogLevel(namespace='sky_tiles_t', levelStr=log_level)
+
+
+    def saveRows(self, txn, row_list):
+        '''Same as save(), within an already running transaction'''
+        sql = '''
+            INSERT OR REPLACE INTO sky_tiles_t (image_id, channel, grid, tile_width, tile_height, stats)
+            VALUES (?, ?, ?, ?, ?, ?);
+        '''
+        txn.executemany(sql, (
+            (row['image_id'], channel, grid, tile_width, tile_height, stats)
+            for row in row_list 
+            for channel, (grid, tile_width, tile_height, stats) in row.get('tiles', {}).items()
+        ))
+
+
+    def save(self, row_list):
+        '''Saves the tile statistics maps found under the 'tiles' key of sky brightness rows'''
+        return self._pool.runInteraction(self.saveRows, row_list)
+
+
+    def load(self, filter_dict):
+        '''
+        Tile statistics maps of an image.
+        Returns a dictionary channel => (average, variance) grid x grid NumPy arrays
+        '''
+        def _load(txn, filter_dict):
+            sql = '''
+                SELECT channel, grid, stats
+                FROM sky_tiles_t
+                WHERE image_id = :image_id;
+            '''
+            self.log.debug(sql)
+            txn.execute(sql, filter_dict)
+            return {channel: decode_tiles(grid, stats) for channel, grid, stats in txn.fetchall()}
+        return self._pool.runReadInteraction(_load, filter_dict)
 
 
+    def loadDateRange(self, filter_dict):
+        '''
+        Tile statistics maps of an observer between two dates.
+        Returns a list of (image_id, channel, average, variance) with grid x grid NumPy arrays
+        '''
+        def _loadDateRange(txn, filter_dict):
+            sql = '''
+                SELECT t.image_id, t.channel, t.grid, t.stats
+                FROM sky_tiles_t AS t
+                JOIN image_t AS i USING(image_id)
+                WHERE i.observer_id = :observer_id
+                AND i.date_id BETWEEN :start_date_id AND :end_date_id
+                ORDER BY i.date_id, i.time_id, t.channel;
+            '''
+            self.log.debug(sql)
+            txn.execute(sql, filter_dict)
+            return [(image_id, channel) + decode_tiles(grid, stats) for image_id, channel, grid, stats in iter(txn.fetchone, None)]
+        return self._pool.runReadInteraction(_loadDateRange, filter_dict)
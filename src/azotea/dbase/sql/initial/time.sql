@@ -0,0 +1,23 @@
+------------------------------------------------------
+-- Time of day data to be inserted at database creation
+------------------------------------------------------
+
+PRAGMA foreign_keys=OFF;
+BEGIN TRANSACTION;
+
+-- One row per second of the day, as time_id HHMMSS.
+-- A cross join of hours, minutes and seconds is much faster than a recursion over 86400 seconds
+INSERT OR IGNORE INTO time_t(time_id, time, hour, minute, second, day_fraction)
+WITH RECURSIVE
+hours(hour) AS (
+    SELECT 0 UNION ALL SELECT hour + 1 FROM hours WHERE hour < 23
+),
+minutes(minute) AS (
+    SELECT 0 UNION ALL SELECT minute + 1 FROM minutes WHERE minute < 59
+)
+SELECT hour*10000 + minute*100 + second, printf('%02d:%02d:%02d', hour, minute, second), hour, minute, second, (hour*3600 + minute*60 + second)/86400.0
+FROM hours
+CROSS JOIN minutes
+CROSS JOIN (SELECT minute AS second FROM minutes);
+
+COMMIT;
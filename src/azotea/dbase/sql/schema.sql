@@ -2,6 +2,9 @@
 -- azotea database Data Model
 -------------------------------
 
+-- Must be set before creating any table
+PRAGMA auto_vacuum = INCREMENTAL;
+
 -- This is the database counterpart of a configuration file
 -- All configurations are stored here
 CREATE TABLE IF NOT EXISTS config_t
@@ -122,6 +125,8 @@ CREATE TABLE IF NOT EXISTS image_t
     camera_id           INTEGER NOT NULL,  -- From EXIF lookup   
     location_id         INTEGER NOT NULL,  -- From default observer
     observer_id         INTEGER NOT NULL,  -- From default location
+    night_id            INTEGER,           -- Date YYYYMMDD when the observing night began
+    month_id            INTEGER,           -- Month YYYYMM when the image was taken
 
     FOREIGN KEY(date_id)     REFERENCES date_t(date_id),
     FOREIGN KEY(time_id)     REFERENCES time_t(time_id),
@@ -147,12 +152,258 @@ CREATE TABLE IF NOT EXISTS sky_brightness_t
     vari_signal_B      REAL,             -- B raw signal variance without dark substraction
     -- Management
     published         INTEGER DEFAULT 0, -- Published in server flag
+    master_id         INTEGER,           -- Master dark or bias frame subtracted from the averages, if any
 
     FOREIGN KEY(image_id)    REFERENCES image_t(image_id),
     FOREIGN KEY(roi_id)      REFERENCES roi_t(roi_id),
+    FOREIGN KEY(master_id)   REFERENCES master_t(master_id),
     PRIMARY KEY(image_id, roi_id)
 );
 
+-- File fingerprints to avoid rehashing unchanged files
+CREATE TABLE IF NOT EXISTS fingerprint_t
+(
+    directory       TEXT NOT NULL,    -- Directory path
+    name            TEXT NOT NULL,    -- Image name without the path
+    size            INTEGER,          -- File size in bytes when hashed
+    mtime_ns        INTEGER,          -- File modification time in nanoseconds when hashed
+    inode           INTEGER,          -- File inode number when hashed
+    hash            BLOB,             -- Image hash computed for this file state, NULL if rejected
+    PRIMARY KEY(directory, name)
+);
+
+-- Scanned directories to avoid listing unchanged ones
+CREATE TABLE IF NOT EXISTS directory_t
+(
+    directory       TEXT NOT NULL,    -- Directory path
+    extension       TEXT NOT NULL,    -- Image file extension scanned for (default camera)
+    mtime_ns        INTEGER,          -- Directory modification time in nanoseconds when scanned
+    entries         INTEGER,          -- Number of directory entries when scanned
+    subdirs         INTEGER,          -- Number of subdirectories when scanned
+    PRIMARY KEY(directory, extension)
+);
+
+-- Compact per channel histograms of the ROI raw pixels
+CREATE TABLE IF NOT EXISTS sky_histogram_t
+(
+    image_id        INTEGER NOT NULL,
+    roi_id          INTEGER NOT NULL,
+    channel         TEXT NOT NULL,    -- CFA channel: R, G1, G2, B
+    origin          INTEGER,          -- Raw pixel value of the first histogram bin
+    counts          BLOB,             -- zlib compressed little endian uint32 counts, one bin per raw value
+    FOREIGN KEY(image_id)    REFERENCES image_t(image_id),
+    FOREIGN KEY(roi_id)      REFERENCES roi_t(roi_id),
+    PRIMARY KEY(image_id, roi_id, channel)
+);
+
+-- Histograms go away with their sky brightness measurements
+CREATE TRIGGER IF NOT EXISTS sky_histogram_delete_trg
+AFTER DELETE ON sky_brightness_t
+BEGIN
+    DELETE FROM sky_histogram_t WHERE image_id = OLD.image_id AND roi_id = OLD.roi_id;
+END;
+
+-- Full frame statistics maps on a coarse grid of tiles
+CREATE TABLE IF NOT EXISTS sky_tiles_t
+(
+    image_id        INTEGER NOT NULL,
+    channel         TEXT NOT NULL,    -- CFA channel: R, G1, G2, B
+    grid            INTEGER,          -- Number of tiles per side
+    tile_width      INTEGER,          -- Tile width in debayered pixels
+    tile_height     INTEGER,          -- Tile height in debayered pixels
+    stats           BLOB,             -- zlib compressed little endian float32 [grid, grid, (average, variance)] array
+    FOREIGN KEY(image_id)    REFERENCES image_t(image_id),
+    PRIMARY KEY(image_id, channel)
+);
+
+-- Tile maps go away with their images
+CREATE TRIGGER IF NOT EXISTS sky_tiles_delete_trg
+BEFORE DELETE ON image_t
+BEGIN
+    DELETE FROM sky_tiles_t WHERE image_id = OLD.image_id;
+END;
+
+-- Master dark and bias frames per camera and night
+CREATE TABLE IF NOT EXISTS master_t
+(
+    master_id       INTEGER,
+    key             TEXT NOT NULL,     -- Hash of the input image hashes, combine method and algorithm version
+    imagetype       TEXT NOT NULL,     -- Either DARK or BIAS
+    method          TEXT NOT NULL,     -- Combine method: mean or median
+    camera_id       INTEGER NOT NULL,
+    night_id        INTEGER NOT NULL,  -- Date YYYYMMDD when the observing night began
+    frames          INTEGER,           -- Number of frames combined
+    path            TEXT,              -- Master frame file
+    FOREIGN KEY(camera_id)   REFERENCES camera_t(camera_id),
+    PRIMARY KEY(master_id),
+    UNIQUE(key)
+);
+
+-- Observer images by date, as in every export and date range selection
+CREATE INDEX IF NOT EXISTS image_observer_date_i ON image_t(observer_id, date_id, time_id);
+
+-- Images by path, as in directory scans and natural key lookups
+CREATE INDEX IF NOT EXISTS image_directory_i ON image_t(directory, name);
+
+-- Pending sky background work, read in directory order
+CREATE INDEX IF NOT EXISTS image_pending_i ON image_t(observer_id, flagged, directory, name);
+
+-- Measurements not yet published, usually a small fraction of them
+CREATE INDEX IF NOT EXISTS sky_unpublished_i ON sky_brightness_t(image_id) WHERE published = 0;
+
+-- Latest night and latest month selections, in date order
+CREATE INDEX IF NOT EXISTS image_observer_night_i ON image_t(observer_id, night_id, date_id, time_id);
+CREATE INDEX IF NOT EXISTS image_observer_month_i ON image_t(observer_id, month_id, date_id, time_id);
+
+-- Summary rollups, kept current by triggers so that summaries
+-- only visit one row per observer, night, date and kind of image.
+-- Nights span two dates, hence the date_id in the keys
+
+CREATE TABLE IF NOT EXISTS image_rollup_t
+(
+    observer_id     INTEGER NOT NULL,
+    night_id        INTEGER,
+    date_id         INTEGER NOT NULL,
+    imagetype       TEXT,
+    flagged         INTEGER,
+    images          INTEGER NOT NULL,  -- Number of images
+    PRIMARY KEY(observer_id, night_id, date_id, imagetype, flagged)
+);
+
+CREATE TABLE IF NOT EXISTS sky_rollup_t
+(
+    observer_id     INTEGER NOT NULL,
+    night_id        INTEGER,
+    date_id         INTEGER NOT NULL,
+    roi_id          INTEGER NOT NULL,
+    published       INTEGER,
+    measurements    INTEGER NOT NULL,  -- Number of sky brightness measurements
+    PRIMARY KEY(observer_id, night_id, date_id, roi_id, published)
+);
+
+CREATE TRIGGER IF NOT EXISTS image_rollup_insert_tr AFTER INSERT ON image_t
+BEGIN
+    INSERT INTO image_rollup_t(observer_id, night_id, date_id, imagetype, flagged, images)
+    SELECT NEW.observer_id, NEW.night_id, NEW.date_id, NEW.imagetype, NEW.flagged, 0
+    WHERE NOT EXISTS (
+        SELECT 1 FROM image_rollup_t 
+        WHERE observer_id = NEW.observer_id AND night_id IS NEW.night_id AND date_id = NEW.date_id 
+        AND imagetype IS NEW.imagetype AND flagged IS NEW.flagged);
+    UPDATE image_rollup_t SET images = images + 1
+    WHERE observer_id = NEW.observer_id AND night_id IS NEW.night_id AND date_id = NEW.date_id 
+    AND imagetype IS NEW.imagetype AND flagged IS NEW.flagged;
+END;
+
+CREATE TRIGGER IF NOT EXISTS image_rollup_delete_tr AFTER DELETE ON image_t
+BEGIN
+    UPDATE image_rollup_t SET images = images - 1
+    WHERE observer_id = OLD.observer_id AND night_id IS OLD.night_id AND date_id = OLD.date_id 
+    AND imagetype IS OLD.imagetype AND flagged IS OLD.flagged;
+    DELETE FROM image_rollup_t WHERE images <= 0
+    AND observer_id = OLD.observer_id AND night_id IS OLD.night_id AND date_id = OLD.date_id 
+    AND imagetype IS OLD.imagetype AND flagged IS OLD.flagged;
+END;
+
+CREATE TRIGGER IF NOT EXISTS image_rollup_update_tr AFTER UPDATE OF observer_id, night_id, date_id, imagetype, flagged ON image_t
+BEGIN
+    UPDATE image_rollup_t SET images = images - 1
+    WHERE observer_id = OLD.observer_id AND night_id IS OLD.night_id AND date_id = OLD.date_id 
+    AND imagetype IS OLD.imagetype AND flagged IS OLD.flagged;
+    DELETE FROM image_rollup_t WHERE images <= 0
+    AND observer_id = OLD.observer_id AND night_id IS OLD.night_id AND date_id = OLD.date_id 
+    AND imagetype IS OLD.imagetype AND flagged IS OLD.flagged;
+    INSERT INTO image_rollup_t(observer_id, night_id, date_id, imagetype, flagged, images)
+    SELECT NEW.observer_id, NEW.night_id, NEW.date_id, NEW.imagetype, NEW.flagged, 0
+    WHERE NOT EXISTS (
+        SELECT 1 FROM image_rollup_t 
+        WHERE observer_id = NEW.observer_id AND night_id IS NEW.night_id AND date_id = NEW.date_id 
+        AND imagetype IS NEW.imagetype AND flagged IS NEW.flagged);
+    UPDATE image_rollup_t SET images = images + 1
+    WHERE observer_id = NEW.observer_id AND night_id IS NEW.night_id AND date_id = NEW.date_id 
+    AND imagetype IS NEW.imagetype AND flagged IS NEW.flagged;
+END;
+
+CREATE TRIGGER IF NOT EXISTS sky_rollup_insert_tr AFTER INSERT ON sky_brightness_t
+BEGIN
+    INSERT INTO sky_rollup_t(observer_id, night_id, date_id, roi_id, published, measurements)
+    SELECT i.observer_id, i.night_id, i.date_id, NEW.roi_id, NEW.published, 0
+    FROM image_t AS i
+    WHERE i.image_id = NEW.image_id
+    AND NOT EXISTS (
+        SELECT 1 FROM sky_rollup_t AS k
+        WHERE k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id 
+        AND k.roi_id = NEW.roi_id AND k.published IS NEW.published);
+    UPDATE sky_rollup_t SET measurements = measurements + 1
+    WHERE rowid IN (
+        SELECT k.rowid FROM image_t AS i JOIN sky_rollup_t AS k
+        ON k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id
+        WHERE i.image_id = NEW.image_id AND k.roi_id = NEW.roi_id AND k.published IS NEW.published);
+END;
+
+CREATE TRIGGER IF NOT EXISTS sky_rollup_delete_tr AFTER DELETE ON sky_brightness_t
+BEGIN
+    UPDATE sky_rollup_t SET measurements = measurements - 1
+    WHERE rowid IN (
+        SELECT k.rowid FROM image_t AS i JOIN sky_rollup_t AS k
+        ON k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id
+        WHERE i.image_id = OLD.image_id AND k.roi_id = OLD.roi_id AND k.published IS OLD.published);
+    DELETE FROM sky_rollup_t WHERE measurements <= 0
+    AND rowid IN (
+        SELECT k.rowid FROM image_t AS i JOIN sky_rollup_t AS k
+        ON k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id
+        WHERE i.image_id = OLD.image_id AND k.roi_id = OLD.roi_id AND k.published IS OLD.published);
+END;
+
+CREATE TRIGGER IF NOT EXISTS sky_rollup_update_tr AFTER UPDATE OF image_id, roi_id, published ON sky_brightness_t
+BEGIN
+    UPDATE sky_rollup_t SET measurements = measurements - 1
+    WHERE rowid IN (
+        SELECT k.rowid FROM image_t AS i JOIN sky_rollup_t AS k
+        ON k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id
+        WHERE i.image_id = OLD.image_id AND k.roi_id = OLD.roi_id AND k.published IS OLD.published);
+    DELETE FROM sky_rollup_t WHERE measurements <= 0
+    AND rowid IN (
+        SELECT k.rowid FROM image_t AS i JOIN sky_rollup_t AS k
+        ON k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id
+        WHERE i.image_id = OLD.image_id AND k.roi_id = OLD.roi_id AND k.published IS OLD.published);
+    INSERT INTO sky_rollup_t(observer_id, night_id, date_id, roi_id, published, measurements)
+    SELECT i.observer_id, i.night_id, i.date_id, NEW.roi_id, NEW.published, 0
+    FROM image_t AS i
+    WHERE i.image_id = NEW.image_id
+    AND NOT EXISTS (
+        SELECT 1 FROM sky_rollup_t AS k
+        WHERE k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id 
+        AND k.roi_id = NEW.roi_id AND k.published IS NEW.published);
+    UPDATE sky_rollup_t SET measurements = measurements + 1
+    WHERE rowid IN (
+        SELECT k.rowid FROM image_t AS i JOIN sky_rollup_t AS k
+        ON k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id
+        WHERE i.image_id = NEW.image_id AND k.roi_id = NEW.roi_id AND k.published IS NEW.published);
+END;
+
+-- Measurements follow their image when it changes observer, night or date
+CREATE TRIGGER IF NOT EXISTS sky_rollup_image_update_tr AFTER UPDATE OF observer_id, night_id, date_id ON image_t
+BEGIN
+    UPDATE sky_rollup_t SET measurements = measurements - (
+        SELECT COUNT(*) FROM sky_brightness_t AS s
+        WHERE s.image_id = OLD.image_id AND s.roi_id = sky_rollup_t.roi_id AND s.published IS sky_rollup_t.published)
+    WHERE observer_id = OLD.observer_id AND night_id IS OLD.night_id AND date_id = OLD.date_id;
+    DELETE FROM sky_rollup_t WHERE measurements <= 0
+    AND observer_id = OLD.observer_id AND night_id IS OLD.night_id AND date_id = OLD.date_id;
+    INSERT INTO sky_rollup_t(observer_id, night_id, date_id, roi_id, published, measurements)
+    SELECT DISTINCT NEW.observer_id, NEW.night_id, NEW.date_id, s.roi_id, s.published, 0
+    FROM sky_brightness_t AS s
+    WHERE s.image_id = NEW.image_id
+    AND NOT EXISTS (
+        SELECT 1 FROM sky_rollup_t AS k
+        WHERE k.observer_id = NEW.observer_id AND k.night_id IS NEW.night_id AND k.date_id = NEW.date_id 
+        AND k.roi_id = s.roi_id AND k.published IS s.published);
+    UPDATE sky_rollup_t SET measurements = measurements + (
+        SELECT COUNT(*) FROM sky_brightness_t AS s
+        WHERE s.image_id = NEW.image_id AND s.roi_id = sky_rollup_t.roi_id AND s.published IS sky_rollup_t.published)
+    WHERE observer_id = NEW.observer_id AND night_id IS NEW.night_id AND date_id = NEW.date_id;
+END;
+
 -------------------------------------------------------------------
 -- This view is needed to perform exports including the ROI details
 -- not present in the image_t table
@@ -0,0 +1,26 @@
+------------------------------------------------------
+-- Miscelanea data to be inserted at database creation
+------------------------------------------------------
+
+PRAGMA foreign_keys=OFF;
+BEGIN TRANSACTION;
+
+-- ----------------------
+-- Schema version upgrade
+-- ----------------------
+
+CREATE TABLE IF NOT EXISTS fingerprint_t
+(
+    directory       TEXT NOT NULL,    -- Directory path
+    name            TEXT NOT NULL,    -- Image name without the path
+    size            INTEGER,          -- File size in bytes when hashed
+    mtime_ns        INTEGER,          -- File modification time in nanoseconds when hashed
+    inode           INTEGER,          -- File inode number when hashed
+    hash            BLOB,             -- Image hash computed for this file state, NULL if rejected
+    PRIMARY KEY(directory, name)
+);
+
+INSERT OR REPLACE INTO config_t(section, property, value) 
+VALUES ('database', 'version', '03');
+
+COMMIT;
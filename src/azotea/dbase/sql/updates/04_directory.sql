@@ -0,0 +1,25 @@
+------------------------------------------------------
+-- Miscelanea data to be inserted at database creation
+------------------------------------------------------
+
+PRAGMA foreign_keys=OFF;
+BEGIN TRANSACTION;
+
+-- ----------------------
+-- Schema version upgrade
+-- ----------------------
+
+CREATE TABLE IF NOT EXISTS directory_t
+(
+    directory       TEXT NOT NULL,    -- Directory path
+    extension       TEXT NOT NULL,    -- Image file extension scanned for (default camera)
+    mtime_ns        INTEGER,          -- Directory modification time in nanoseconds when scanned
+    entries         INTEGER,          -- Number of directory entries when scanned
+    subdirs         INTEGER,          -- Number of subdirectories when scanned
+    PRIMARY KEY(directory, extension)
+);
+
+INSERT OR REPLACE INTO config_t(section, property, value) 
+VALUES ('database', 'version', '04');
+
+COMMIT;
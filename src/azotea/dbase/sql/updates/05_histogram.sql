@@ -0,0 +1,34 @@
+------------------------------------------------------
+-- Miscelanea data to be inserted at database creation
+------------------------------------------------------
+
+PRAGMA foreign_keys=OFF;
+BEGIN TRANSACTION;
+
+-- ----------------------
+-- Schema version upgrade
+-- ----------------------
+
+CREATE TABLE IF NOT EXISTS sky_histogram_t
+(
+    image_id        INTEGER NOT NULL,
+    roi_id          INTEGER NOT NULL,
+    channel         TEXT NOT NULL,    -- CFA channel: R, G1, G2, B
+    origin          INTEGER,          -- Raw pixel value of the first histogram bin
+    counts          BLOB,             -- zlib compressed little endian uint32 counts, one bin per raw value
+    FOREIGN KEY(image_id)    REFERENCES image_t(image_id),
+    FOREIGN KEY(roi_id)      REFERENCES roi_t(roi_id),
+    PRIMARY KEY(image_id, roi_id, channel)
+);
+
+-- Histograms go away with their sky brightness measurements
+CREATE TRIGGER IF NOT EXISTS sky_histogram_delete_trg
+AFTER DELETE ON sky_brightness_t
+BEGIN
+    DELETE FROM sky_histogram_t WHERE image_id = OLD.image_id AND roi_id = OLD.roi_id;
+END;
+
+INSERT OR REPLACE INTO config_t(section, property, value) 
+VALUES ('database', 'version', '05');
+
+COMMIT;
@@ -0,0 +1,34 @@
+------------------------------------------------------
+-- Miscelanea data to be inserted at database creation
+------------------------------------------------------
+
+PRAGMA foreign_keys=OFF;
+BEGIN TRANSACTION;
+
+-- ----------------------
+-- Schema version upgrade
+-- ----------------------
+
+CREATE TABLE IF NOT EXISTS sky_tiles_t
+(
+    image_id        INTEGER NOT NULL,
+    channel         TEXT NOT NULL,    -- CFA channel: R, G1, G2, B
+    grid            INTEGER,          -- Number of tiles per side
+    tile_width      INTEGER,          -- Tile width in debayered pixels
+    tile_height     INTEGER,          -- Tile height in debayered pixels
+    stats           BLOB,             -- zlib compressed little endian float32 [grid, grid, (average, variance)] array
+    FOREIGN KEY(image_id)    REFERENCES image_t(image_id),
+    PRIMARY KEY(image_id, channel)
+);
+
+-- Tile maps go away with their images
+CREATE TRIGGER IF NOT EXISTS sky_tiles_delete_trg
+BEFORE DELETE ON image_t
+BEGIN
+    DELETE FROM sky_tiles_t WHERE image_id = OLD.image_id;
+END;
+
+INSERT OR REPLACE INTO config_t(section, property, value) 
+VALUES ('database', 'version', '06');
+
+COMMIT;
@@ -0,0 +1,32 @@
+------------------------------------------------------
+-- Miscelanea data to be inserted at database creation
+------------------------------------------------------
+
+PRAGMA foreign_keys=OFF;
+BEGIN TRANSACTION;
+
+-- ----------------------
+-- Schema version upgrade
+-- ----------------------
+
+CREATE TABLE IF NOT EXISTS master_t
+(
+    master_id       INTEGER,
+    key             TEXT NOT NULL,     -- Hash of the input image hashes, combine method and algorithm version
+    imagetype       TEXT NOT NULL,     -- Either DARK or BIAS
+    method          TEXT NOT NULL,     -- Combine method: mean or median
+    camera_id       INTEGER NOT NULL,
+    night_id        INTEGER NOT NULL,  -- Date YYYYMMDD when the observing night began
+    frames          INTEGER,           -- Number of frames combined
+    path            TEXT,              -- Master frame file
+    FOREIGN KEY(camera_id)   REFERENCES camera_t(camera_id),
+    PRIMARY KEY(master_id),
+    UNIQUE(key)
+);
+
+ALTER TABLE sky_brightness_t ADD COLUMN master_id INTEGER REFERENCES master_t(master_id);
+
+INSERT OR REPLACE INTO config_t(section, property, value) 
+VALUES ('database', 'version', '07');
+
+COMMIT;
@@ -0,0 +1,27 @@
+------------------------------------------------------
+-- Miscelanea data to be inserted at database creation
+------------------------------------------------------
+
+PRAGMA foreign_keys=OFF;
+BEGIN TRANSACTION;
+
+-- ----------------------
+-- Schema version upgrade
+-- ----------------------
+
+-- Observer images by date, as in every export and date range selection
+CREATE INDEX IF NOT EXISTS image_observer_date_i ON image_t(observer_id, date_id, time_id);
+
+-- Images by path, as in directory scans and natural key lookups
+CREATE INDEX IF NOT EXISTS image_directory_i ON image_t(directory, name);
+
+-- Pending sky background work, read in directory order
+CREATE INDEX IF NOT EXISTS image_pending_i ON image_t(observer_id, flagged, directory, name);
+
+-- Measurements not yet published, usually a small fraction of them
+CREATE INDEX IF NOT EXISTS sky_unpublished_i ON sky_brightness_t(image_id) WHERE published = 0;
+
+INSERT OR REPLACE INTO config_t(section, property, value) 
+VALUES ('database', 'version', '08');
+
+COMMIT;
@@ -0,0 +1,27 @@
+------------------------------------------------------
+-- Miscelanea data to be inserted at database creation
+------------------------------------------------------
+
+PRAGMA foreign_keys=OFF;
+BEGIN TRANSACTION;
+
+-- ----------------------
+-- Schema version upgrade
+-- ----------------------
+
+-- Foreign keys are now enforced on every connection,
+-- so image_t rows need their time of day in time_t
+INSERT OR IGNORE INTO time_t(time_id, time, hour, minute, second, day_fraction)
+WITH RECURSIVE seq(n) AS (SELECT 0 UNION ALL SELECT n+1 FROM seq WHERE n < 86399)
+SELECT (n/3600)*10000 + ((n/60)%60)*100 + n%60, printf('%02d:%02d:%02d', n/3600, (n/60)%60, n%60), n/3600, (n/60)%60, n%60, n/86400.0
+FROM seq;
+
+INSERT OR REPLACE INTO config_t(section, property, value) 
+VALUES ('database', 'version', '09');
+
+COMMIT;
+
+-- Pages freed by bulk deletes are given back with PRAGMA incremental_vacuum.
+-- Changing auto_vacuum in an existing database takes a full VACUUM, outside any transaction
+PRAGMA auto_vacuum = INCREMENTAL;
+VACUUM;
@@ -0,0 +1,30 @@
+------------------------------------------------------
+-- Miscelanea data to be inserted at database creation
+------------------------------------------------------
+
+PRAGMA foreign_keys=OFF;
+BEGIN TRANSACTION;
+
+-- ----------------------
+-- Schema version upgrade
+-- ----------------------
+
+ALTER TABLE image_t ADD COLUMN night_id INTEGER;
+ALTER TABLE image_t ADD COLUMN month_id INTEGER;
+
+-- Images taken before noon belong to the previous night
+UPDATE image_t SET night_id = CAST(strftime('%Y%m%d', 
+    printf('%04d-%02d-%02d %02d:%02d:%02d', date_id/10000, (date_id/100)%100, date_id%100, time_id/10000, (time_id/100)%100, time_id%100), 
+    '-12 hours') AS INTEGER);
+
+-- Calendar month of the image date, as the former month_num of date_t
+UPDATE image_t SET month_id = date_id / 100;
+
+-- Latest night and latest month selections, in date order
+CREATE INDEX IF NOT EXISTS image_observer_night_i ON image_t(observer_id, night_id, date_id, time_id);
+CREATE INDEX IF NOT EXISTS image_observer_month_i ON image_t(observer_id, month_id, date_id, time_id);
+
+INSERT OR REPLACE INTO config_t(section, property, value) 
+VALUES ('database', 'version', '10');
+
+COMMIT;
@@ -0,0 +1,175 @@
+------------------------------------------------------
+-- Miscelanea data to be inserted at database creation
+------------------------------------------------------
+
+PRAGMA foreign_keys=OFF;
+BEGIN TRANSACTION;
+
+-- ----------------------
+-- Schema version upgrade
+-- ----------------------
+
+-- Summary rollups, kept current by triggers so that summaries
+-- only visit one row per observer, night, date and kind of image.
+-- Nights span two dates, hence the date_id in the keys
+
+CREATE TABLE IF NOT EXISTS image_rollup_t
+(
+    observer_id     INTEGER NOT NULL,
+    night_id        INTEGER,
+    date_id         INTEGER NOT NULL,
+    imagetype       TEXT,
+    flagged         INTEGER,
+    images          INTEGER NOT NULL,  -- Number of images
+    PRIMARY KEY(observer_id, night_id, date_id, imagetype, flagged)
+);
+
+CREATE TABLE IF NOT EXISTS sky_rollup_t
+(
+    observer_id     INTEGER NOT NULL,
+    night_id        INTEGER,
+    date_id         INTEGER NOT NULL,
+    roi_id          INTEGER NOT NULL,
+    published       INTEGER,
+    measurements    INTEGER NOT NULL,  -- Number of sky brightness measurements
+    PRIMARY KEY(observer_id, night_id, date_id, roi_id, published)
+);
+
+CREATE TRIGGER IF NOT EXISTS image_rollup_insert_tr AFTER INSERT ON image_t
+BEGIN
+    INSERT INTO image_rollup_t(observer_id, night_id, date_id, imagetype, flagged, images)
+    SELECT NEW.observer_id, NEW.night_id, NEW.date_id, NEW.imagetype, NEW.flagged, 0
+    WHERE NOT EXISTS (
+        SELECT 1 FROM image_rollup_t 
+        WHERE observer_id = NEW.observer_id AND night_id IS NEW.night_id AND date_id = NEW.date_id 
+        AND imagetype IS NEW.imagetype AND flagged IS NEW.flagged);
+    UPDATE image_rollup_t SET images = images + 1
+    WHERE observer_id = NEW.observer_id AND night_id IS NEW.night_id AND date_id = NEW.date_id 
+    AND imagetype IS NEW.imagetype AND flagged IS NEW.flagged;
+END;
+
+CREATE TRIGGER IF NOT EXISTS image_rollup_delete_tr AFTER DELETE ON image_t
+BEGIN
+    UPDATE image_rollup_t SET images = images - 1
+    WHERE observer_id = OLD.observer_id AND night_id IS OLD.night_id AND date_id = OLD.date_id 
+    AND imagetype IS OLD.imagetype AND flagged IS OLD.flagged;
+    DELETE FROM image_rollup_t WHERE images <= 0
+    AND observer_id = OLD.observer_id AND night_id IS OLD.night_id AND date_id = OLD.date_id 
+    AND imagetype IS OLD.imagetype AND flagged IS OLD.flagged;
+END;
+
+CREATE TRIGGER IF NOT EXISTS image_rollup_update_tr AFTER UPDATE OF observer_id, night_id, date_id, imagetype, flagged ON image_t
+BEGIN
+    UPDATE image_rollup_t SET images = images - 1
+    WHERE observer_id = OLD.observer_id AND night_id IS OLD.night_id AND date_id = OLD.date_id 
+    AND imagetype IS OLD.imagetype AND flagged IS OLD.flagged;
+    DELETE FROM image_rollup_t WHERE images <= 0
+    AND observer_id = OLD.observer_id AND night_id IS OLD.night_id AND date_id = OLD.date_id 
+    AND imagetype IS OLD.imagetype AND flagged IS OLD.flagged;
+    INSERT INTO image_rollup_t(observer_id, night_id, date_id, imagetype, flagged, images)
+    SELECT NEW.observer_id, NEW.night_id, NEW.date_id, NEW.imagetype, NEW.flagged, 0
+    WHERE NOT EXISTS (
+        SELECT 1 FROM image_rollup_t 
+        WHERE observer_id = NEW.observer_id AND night_id IS NEW.night_id AND date_id = NEW.date_id 
+        AND imagetype IS NEW.imagetype AND flagged IS NEW.flagged);
+    UPDATE image_rollup_t SET images = images + 1
+    WHERE observer_id = NEW.observer_id AND night_id IS NEW.night_id AND date_id = NEW.date_id 
+    AND imagetype IS NEW.imagetype AND flagged IS NEW.flagged;
+END;
+
+CREATE TRIGGER IF NOT EXISTS sky_rollup_insert_tr AFTER INSERT ON sky_brightness_t
+BEGIN
+    INSERT INTO sky_rollup_t(observer_id, night_id, date_id, roi_id, published, measurements)
+    SELECT i.observer_id, i.night_id, i.date_id, NEW.roi_id, NEW.published, 0
+    FROM image_t AS i
+    WHERE i.image_id = NEW.image_id
+    AND NOT EXISTS (
+        SELECT 1 FROM sky_rollup_t AS k
+        WHERE k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id 
+        AND k.roi_id = NEW.roi_id AND k.published IS NEW.published);
+    UPDATE sky_rollup_t SET measurements = measurements + 1
+    WHERE rowid IN (
+        SELECT k.rowid FROM image_t AS i JOIN sky_rollup_t AS k
+        ON k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id
+        WHERE i.image_id = NEW.image_id AND k.roi_id = NEW.roi_id AND k.published IS NEW.published);
+END;
+
+CREATE TRIGGER IF NOT EXISTS sky_rollup_delete_tr AFTER DELETE ON sky_brightness_t
+BEGIN
+    UPDATE sky_rollup_t SET measurements = measurements - 1
+    WHERE rowid IN (
+        SELECT k.rowid FROM image_t AS i JOIN sky_rollup_t AS k
+        ON k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id
+        WHERE i.image_id = OLD.image_id AND k.roi_id = OLD.roi_id AND k.published IS OLD.published);
+    DELETE FROM sky_rollup_t WHERE measurements <= 0
+    AND rowid IN (
+        SELECT k.rowid FROM image_t AS i JOIN sky_rollup_t AS k
+        ON k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id
+        WHERE i.image_id = OLD.image_id AND k.roi_id = OLD.roi_id AND k.published IS OLD.published);
+END;
+
+CREATE TRIGGER IF NOT EXISTS sky_rollup_update_tr AFTER UPDATE OF image_id, roi_id, published ON sky_brightness_t
+BEGIN
+    UPDATE sky_rollup_t SET measurements = measurements - 1
+    WHERE rowid IN (
+        SELECT k.rowid FROM image_t AS i JOIN sky_rollup_t AS k
+        ON k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id
+        WHERE i.image_id = OLD.image_id AND k.roi_id = OLD.roi_id AND k.published IS OLD.published);
+    DELETE FROM sky_rollup_t WHERE measurements <= 0
+    AND rowid IN (
+        SELECT k.rowid FROM image_t AS i JOIN sky_rollup_t AS k
+        ON k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id
+        WHERE i.image_id = OLD.image_id AND k.roi_id = OLD.roi_id AND k.published IS OLD.published);
+    INSERT INTO sky_rollup_t(observer_id, night_id, date_id, roi_id, published, measurements)
+    SELECT i.observer_id, i.night_id, i.date_id, NEW.roi_id, NEW.published, 0
+    FROM image_t AS i
+    WHERE i.image_id = NEW.image_id
+    AND NOT EXISTS (
+        SELECT 1 FROM sky_rollup_t AS k
+        WHERE k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id 
+        AND k.roi_id = NEW.roi_id AND k.published IS NEW.published);
+    UPDATE sky_rollup_t SET measurements = measurements + 1
+    WHERE rowid IN (
+        SELECT k.rowid FROM image_t AS i JOIN sky_rollup_t AS k
+        ON k.observer_id = i.observer_id AND k.night_id IS i.night_id AND k.date_id = i.date_id
+        WHERE i.image_id = NEW.image_id AND k.roi_id = NEW.roi_id AND k.published IS NEW.published);
+END;
+
+-- Measurements follow their image when it changes observer, night or date
+CREATE TRIGGER IF NOT EXISTS sky_rollup_image_update_tr AFTER UPDATE OF observer_id, night_id, date_id ON image_t
+BEGIN
+    UPDATE sky_rollup_t SET measurements = measurements - (
+        SELECT COUNT(*) FROM sky_brightness_t AS s
+        WHERE s.image_id = OLD.image_id AND s.roi_id = sky_rollup_t.roi_id AND s.published IS sky_rollup_t.published)
+    WHERE observer_id = OLD.observer_id AND night_id IS OLD.night_id AND date_id = OLD.date_id;
+    DELETE FROM sky_rollup_t WHERE measurements <= 0
+    AND observer_id = OLD.observer_id AND night_id IS OLD.night_id AND date_id = OLD.date_id;
+    INSERT INTO sky_rollup_t(observer_id, night_id, date_id, roi_id, published, measurements)
+    SELECT DISTINCT NEW.observer_id, NEW.night_id, NEW.date_id, s.roi_id, s.published, 0
+    FROM sky_brightness_t AS s
+    WHERE s.image_id = NEW.image_id
+    AND NOT EXISTS (
+        SELECT 1 FROM sky_rollup_t AS k
+        WHERE k.observer_id = NEW.observer_id AND k.night_id IS NEW.night_id AND k.date_id = NEW.date_id 
+        AND k.roi_id = s.roi_id AND k.published IS s.published);
+    UPDATE sky_rollup_t SET measurements = measurements + (
+        SELECT COUNT(*) FROM sky_brightness_t AS s
+        WHERE s.image_id = NEW.image_id AND s.roi_id = sky_rollup_t.roi_id AND s.published IS sky_rollup_t.published)
+    WHERE observer_id = NEW.observer_id AND night_id IS NEW.night_id AND date_id = NEW.date_id;
+END;
+
+INSERT INTO image_rollup_t(observer_id, night_id, date_id, imagetype, flagged, images)
+SELECT observer_id, night_id, date_id, imagetype, flagged, COUNT(*)
+FROM image_t
+GROUP BY observer_id, night_id, date_id, imagetype, flagged;
+
+INSERT INTO sky_rollup_t(observer_id, night_id, date_id, roi_id, published, measurements)
+SELECT i.observer_id, i.night_id, i.date_id, s.roi_id, s.published, COUNT(*)
+FROM sky_brightness_t AS s
+JOIN image_t AS i USING(image_id)
+GROUP BY i.observer_id, i.night_id, i.date_id, s.roi_id, s.published;
+
+INSERT OR REPLACE INTO config_t(section, property, value) 
+VALUES ('database', 'version', '11');
+
+COMMIT;
@@ -63,7 +63,7 @@ class Table:
         nk_dict is a dictionary containing at least the values for the natural key columns
         Returns a Deferred
         '''
-        return self._pool.runInteraction( self._readId, nk_dict)
+        return self._pool.runReadInteraction( self._readId, nk_dict)
 
 
     def load(self, nk_dict):
@@ -72,7 +72,7 @@ class Table:
         nk_dict is a dictionary containing at least the values for the natural key columns
         Returns a Deferred
         '''
-        return self._pool.runInteraction(self._readEntry, nk_dict)
+        return self._pool.runReadInteraction(self._readEntry, nk_dict)
 
     def loadById(self, id_dict):
         '''
@@ -80,7 +80,7 @@ class Table:
         id_dict is a dictionary containing at least the value for the column_id
         Returns a Deferred
         '''
-        return self._pool.runInteraction(self._readEntryById, id_dict)
+        return self._pool.runReadInteraction(self._readEntryById, id_dict)
 
 
     def loadAll(self):
@@ -88,7 +88,7 @@ class Table:
         Read all rows in the table returning a dictionary with both the natural key columns and other columns
         Returns a Deferred
         '''
-        return self._pool.runInteraction(self._readEntries)
+        return self._pool.runReadInteraction(self._readEntries)
 
 
     def loadAllNK(self):
@@ -96,7 +96,7 @@ class Table:
         Read all rows in the table returning a dictionary with the natural key columns
         Returns a Deferred
         '''
-        return self._pool.runInteraction(self._readNaturalKeys)
+        return self._pool.runReadInteraction(self._readNaturalKeys)
 
 
     def save(self, all_dict):
@@ -582,12 +582,12 @@ class ConfigTable:
     def load(self, section, property):
         '''Returns a Deferred'''
         row = {'section': section, 'property': property}
-        return self._pool.runInteraction(self._read, row)
+        return self._pool.runReadInteraction(self._read, row)
 
     def loadSection(self, section):
         '''Returns a Deferred'''
         row= {'section': section}
-        return self._pool.runInteraction(self._readSection, row)
+        return self._pool.runReadInteraction(self._readSection, row)
 
     def save(self, section, property, value):
         '''Returns a Deferred'''
@@ -42,8 +42,10 @@ import rawpy
 
 from azotea import __version__
 from azotea.utils.roi import Point, Rect
-from azotea.utils.image import classify_image_type, scan_non_empty_dirs, hash_func, exif_metadata, toDateTime
+from azotea.utils.image import classify_image_type, scan_non_empty_dirs, hash_func, exif_metadata, toDateTime, fingerprints
 from azotea.utils.image import hash_and_metadata_exif, hash_and_metadata_fits
+from azotea.utils.workers import WorkerPool
+from azotea.dbase.image import INSERTED, RELOCATED, DISCARDED
 from azotea.logger  import startLogging, setLogLevel
 
 from azotea import FITS_HEADER_TYPE, EXIF_HEADER_TYPE
@@ -86,6 +88,7 @@ class ImageController:
         self.default_focal_length = None
         self.default_f_number = None
         self._abort = False
+        self.workers = WorkerPool()
         setLogLevel(namespace=NAMESPACE, levelStr='info')
         pub.subscribe(self.onLoadReq,  'images_load_req')
         pub.subscribe(self.onAbortReq,  'images_abort_load_req')
@@ -151,6 +154,10 @@ class ImageController:
     # Helper methods
     # --------------
 
+    def shutdown(self):
+        '''Stops the worker pool'''
+        self.workers.shutdown()
+
     # We assign the default optics here
     @inlineCallbacks
     def getDefault(self):
@@ -171,6 +178,7 @@ class ImageController:
      
         if default_camera_id:
             self.default_camera_id = int(default_camera_id)
+            self.default_model = default_camera['model']
             self.extension     = default_camera['extension']
             self.header_type   = default_camera['header_type']
             self.bayer_pattern = default_camera['bayer_pattern']
@@ -208,26 +216,21 @@ class ImageController:
 
     @inlineCallbacks
     def saveAndFix(self, save_list):
-        try:
-            yield self.image.save(save_list)
-        except sqlite3.IntegrityError as e:
-            for row in save_list:
-                try:
-                    yield self.image.save(row)
-                except  sqlite3.IntegrityError as e:
-                    name, directory = yield self.image.getByHash(row)
-                    log.warn("Possible duplicate image: '{name}' with existing '{prev}' in {dir}",name=row['name'], prev=name, dir=directory)
-                    if row['name'] == name:
-                        oldpath = os.path.join(directory, name)
-                        newpath = os.path.join(row['directory'], row['name'])
-                        # Avoid fixing path with itself. It happens in FITS handling, by design
-                        if oldpath != newpath:
-                            log.error("Fixing '{oldpath}' -> '{newpath}'", oldpath=oldpath, newpath=newpath)
-                            yield self.image.fixDirectory(row)
-                    else:
-                        message = _("image: '{0}' is completely discarded, using '{1}' instead").format(row['name'], name)
-                        self.view.messageBoxWarn(who=_("Register"), message=message)
-                        log.warn("Image: '{name}' is completely discarded, using '{prev}' instead",name=row['name'], prev=name)
+        report = yield self.image.bulkSave(save_list)
+        for name, directory, outcome, prev_name, prev_directory in report:
+            if outcome == INSERTED:
+                continue
+            log.warn("Possible duplicate image: '{name}' with existing '{prev}' in {dir}",name=name, prev=prev_name, dir=prev_directory)
+            if outcome == RELOCATED:
+                oldpath = os.path.join(prev_directory, prev_name)
+                newpath = os.path.join(directory, name)
+                log.error("Fixing '{oldpath}' -> '{newpath}'", oldpath=oldpath, newpath=newpath)
+            elif outcome == DISCARDED:
+                message = _("image: '{0}' is completely discarded, using '{1}' instead").format(name, prev_name)
+                self.view.messageBoxWarn(who=_("Register"), message=message)
+                log.warn("Image: '{name}' is completely discarded, using '{prev}' instead",name=name, prev=prev_name)
+        # Remember what has been hashed so that unchanged files are not hashed again
+        yield self.model.fingerprint.save(save_list)
 
 
     @inlineCallbacks
@@ -239,8 +242,26 @@ class ImageController:
         if self.header_type != FITS_HEADER_TYPE:
             db_set = yield self.image.imagesInDirectory({'directory': directory})
             db_set = set(img[0] for img in db_set)
-        result = sorted(list(input_set - db_set))
-        return list(os.path.join(directory, f) for f in (input_set - db_set))
+        input_set = input_set - db_set
+        # Skip files not modified since their hash was registered.
+        # This works for FITS images too, as re-edited files change their fingerprint
+        current = yield deferToThread(fingerprints, directory, input_set)
+        known   = yield self.model.fingerprint.unchanged({'directory': directory})
+        result  = sorted(name for name, fp in current.items() if known.get(name) != fp)
+        return list(os.path.join(directory, f) for f in result)
+
+    def newRow(self, directory, filepath):
+        return {
+            'name'        : os.path.basename(filepath), 
+            'directory'   : directory,
+            'flagged'     : 0, # Assume a good image for the time being
+            'header_type' : self.header_type,
+            'observer_id' : self.observer_id,
+            'location_id' : self.location_id,
+            'session'     : self.session,
+            'def_fl'      : self.default_focal_length['focal_length'],  # these 2 are not real table columns
+            'def_fn'      : self.default_f_number['f_number'],      # they are here just to fix EXIF optics reading
+        }
 
     @inlineCallbacks
     def doRegister(self, directory):
@@ -258,53 +279,39 @@ class ImageController:
             hash_and_metadata_f = hash_and_metadata_exif
         i = 0
         self.view.mainArea.clearImageDataView()
-        for i, filepath in enumerate(file_list, start=1):
-            if self._abort:
-                break
-            row = {
-                'name'        : os.path.basename(filepath), 
-                'directory'   : directory,
-                'imagetype'   : classify_image_type(self.header_type, filepath),
-                'flagged'     : 0, # Assume a good image for the time being
-                'header_type' : self.header_type,
-                'observer_id' : self.observer_id,
-                'location_id' : self.location_id,
-                'def_fl'      : self.default_focal_length['focal_length'],  # these 2 are not real table columns
-                'def_fn'      : self.default_f_number['f_number'],      # they are here just to fix EXIF optics reading
-            }
-            result = yield self.image.load(row)
-            row['session'] = self.session
-            if result:
-                log.debug('Skipping already registered {row.name}.', row=row)
+        # Images taken with other cameras are rejected by the workers before being hashed
+        jobs = ((filepath, self.newRow(directory, filepath), self.default_model) for filepath in file_list)
+        results = self.workers.imap(hash_and_metadata_f, jobs)
+        try:
+            for i, ((filepath, row, model), deferred) in enumerate(results, start=1):
+                if self._abort:
+                    break
+                try:
+                    row = yield deferred
+                except Exception as e:
+                    message = _("{0}: Error in fingerprint computation or EXIF metadata reading").format(row['name'])
+                    self.view.statusBar.update( _("LOADING"), row['name'], (100*i//N_Files), error=True)
+                    return(None)
+                if 'hash' not in row:
+                    self.view.statusBar.update( _("LOADING"), row['name'], (100*i//N_Files), error=True)
+                    existing_camera = yield self.model.camera.lookup(row)
+                    if not existing_camera:
+                        message = _("Image {0} taken with {1}, that is not found in the database").format(row['name'], row['model'])
+                    else:
+                        message = _("Image {0} taken with {1}, that is not the default camera").format(row['name'], row['model'])
+                    self.view.messageBoxError(who=_("Register"),message=message)
+                    return(None)
+                row['camera_id'] = self.default_camera_id
+                self.view.mainArea.displayImageData(row['name'],row)
                 self.view.statusBar.update( _("LOADING"), row['name'], (100*i//N_Files))
-                continue
-            try:
-                row = yield deferToThread(hash_and_metadata_f, filepath, row)
-            except Exception as e:
-                message = _("{0}: Error in fingerprint computation or EXIF metadata reading").format(row['name'])
-                self.view.statusBar.update( _("LOADING"), row['name'], (100*i//N_Files), error=True)
-                return(None)
-            existing_camera = yield self.model.camera.lookup(row)
-            if not existing_camera:
-                self.view.statusBar.update( _("LOADING"), row['name'], (100*i//N_Files), error=True)
-                message = _("Image {0} taken with {1}, that is not found in the database").format(row['name'], row['model'])
-                self.view.messageBoxError(who=_("Register"),message=message)
-                return(None)
-            row['camera_id'] = int(existing_camera['camera_id'])
-            if row['camera_id'] != self.default_camera_id:
-                self.view.statusBar.update( _("LOADING"), row['name'], (100*i//N_Files), error=True)
-                message = _("Image {0} taken with {1}, that is not the default camera").format(row['name'], row['model'])
-                self.view.messageBoxError(who=_("Register"),message=message)
-                return(None)
-            self.view.mainArea.displayImageData(row['name'],row)
-            self.view.statusBar.update( _("LOADING"), row['name'], (100*i//N_Files))
-            save_list.append(row)
-            if (i % BUFFER_SIZE) == 0:
-                log.debug("Register: saving to database")
-                yield self.saveAndFix(save_list)
-                save_list = list()
+                save_list.append(row)
+                if (i % BUFFER_SIZE) == 0:
+                    log.debug("Register: saving to database")
+                    yield self.saveAndFix(save_list)
+                    save_list = list()
+        finally:
+            results.close()
         if save_list:
             log.debug("Register: saving to database")
             yield self.saveAndFix(save_list)
         return((i, N_Files))
-        
\ No newline at end of file
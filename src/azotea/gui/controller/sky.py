@@ -51,6 +51,8 @@ from azotea import DATE_SELECTION_DATE_RANGE, DATE_SELECTION_LATEST_NIGHT, DATE_
 from azotea.utils import chop
 from azotea.utils.roi import Point, Rect
 from azotea.utils.sky import RAWPY_EXCEPTIONS, CSV_COLUMNS, csv_postprocess, widget_datetime, processImage
+from azotea.utils.workers import WorkerPool, THREAD_POOL, PROCESS_POOL
+from azotea.utils.readahead import read_ahead, dont_need
 from azotea.logger  import startLogging, setLogLevel
 
 
@@ -94,6 +96,7 @@ class SkyBackgroundController:
         self.observerCtrl = None
         self.roiCtrl      = None
         self._abort = False
+        self._pools = dict()
         setLogLevel(namespace=NAMESPACE, levelStr='info')
         pub.subscribe(self.onStatisticsReq,  'sky_brightness_stats_req')
         pub.subscribe(self.onDeleteReq, 'sky_brightness_delete_req')
@@ -159,6 +162,7 @@ class SkyBackgroundController:
                     yield self.sky.deleteDateRange(filter_dict)
             else:
                 pass
+            pub.sendMessage('database_maintenance_req')
         except Exception as e:
             log.failure('{e}',e=e)
             pub.sendMessage('quit', exit_code = 1)
@@ -274,41 +278,76 @@ class SkyBackgroundController:
         log.info("Export to {path} complete",path=path)
 
 
+    def getWorkers(self, header_type):
+        '''LibRaw decoding is CPU bound and runs in a process pool. FITS in a thread pool'''
+        pool_type = PROCESS_POOL if header_type == EXIF_HEADER_TYPE else THREAD_POOL
+        if pool_type not in self._pools:
+            self._pools[pool_type] = WorkerPool(pool_type=pool_type)
+        return self._pools[pool_type]
+
+
+    def shutdown(self):
+        '''Stops the worker pools'''
+        for pool in self._pools.values():
+            pool.shutdown()
+
+
     @inlineCallbacks
     def doStatistics(self):
         # Default settings extracted by doCheckDefaults()
-        conditions = {'observer_id' : self.observer_id, 'roi_id': self.roi_id,}
-        roi_dict = yield self.roi.loadById(conditions)
-        rect = Rect.from_dict(roi_dict)
-        image_id_list = yield self.sky.pending(conditions)
-        N_stats = len(image_id_list)
+        conditions = {'observer_id' : self.observer_id}
+        roi_dict = yield self.roi.loadById({'roi_id': self.roi_id})
+        N_stats = yield self.sky.pendingCount(conditions, [self.roi_id])
+        # Workers decode ahead of us within their window while a single writer
+        # saves the previous batch of results to the database
+        i = 0
         save_list = list()
-        for i, (image_id,) in enumerate(image_id_list, start=1):
-            if self._abort:
-                break
-            name, directory, header_type, exptime, cfa_pattern, camera_id, date_id, time_id, observer_id, location_id = yield self.image.getInitialMetadata({'image_id':image_id})
-            w_date, w_time = widget_datetime(date_id, time_id) 
-            row = {
-                'image_id'   : image_id,
-                'roi_id'     : self.roi_id,
-                'widget_date': w_date,  # for display purposes only
-                'widget_time': w_time,  # for display purposes only
-                'exptime'    : exptime, # for display purposes only
-            }
-            try:
-                row = yield deferToThread(processImage, name, directory, roi_dict, header_type, cfa_pattern, row)
-            except RAWPY_EXCEPTIONS as e:
-                log.error("Corrupt  {name} ({i}/{N}) [{p}%]", i=i, N=N_stats, name=name, p=(100*i//N_stats))
-                yield self.image.flagAsBad(row)
-                self.view.statusBar.update( _("SKY BACKGROUND"), name, (100*i//N_stats), error=True)
-                continue
-            self.view.statusBar.update( _("SKY BACKGROUND"), name, (100*i//N_stats), error=False)
-            self.view.mainArea.displaySkyMeasurement(name, row)
-            save_list.append(row)
-            if (i % BUFFER_SIZE) == 0:
-                log.debug("Sky Background Processor: saving to database")
-                yield self.sky.save(save_list)
-                save_list = list()
+        writer = None
+        chunk = yield self.sky.pendingWithMetadata(conditions, [self.roi_id])
+        while chunk and not self._abort:
+            # The next chunk of pending work is read while this one is being processed
+            next_chunk = self.sky.pendingWithMetadata(conditions, [self.roi_id], after=(chunk[-1][2], chunk[-1][1], chunk[-1][0]))
+            jobs = dict()   # header_type => list of processImage() arguments
+            for image_id, name, directory, hash, header_type, exptime, cfa_pattern, date_id, time_id, camera_id, imagetype, pending_ids in chunk:
+                w_date, w_time = widget_datetime(date_id, time_id) 
+                row = {
+                    'image_id'   : image_id,
+                    'roi_id'     : self.roi_id,
+                    'widget_date': w_date,  # for display purposes only
+                    'widget_time': w_time,  # for display purposes only
+                    'exptime'    : exptime, # for display purposes only
+                }
+                jobs.setdefault(header_type, list()).append((name, directory, roi_dict, header_type, cfa_pattern, row))
+            for header_type, job_list in jobs.items():
+                results = self.getWorkers(header_type).imap(processImage, read_ahead(job_list))
+                try:
+                    for (name, directory, roi_dict, header_type, cfa_pattern, row), deferred in results:
+                        if self._abort:
+                            break
+                        i += 1
+                        try:
+                            row = yield deferred
+                        except RAWPY_EXCEPTIONS as e:
+                            log.error("Corrupt  {name} ({i}/{N}) [{p}%]", i=i, N=N_stats, name=name, p=(100*i//N_stats))
+                            yield self.image.flagAsBad(row)
+                            self.view.statusBar.update( _("SKY BACKGROUND"), name, (100*i//N_stats), error=True)
+                            continue
+                        finally:
+                            dont_need(os.path.join(directory, name))
+                        self.view.statusBar.update( _("SKY BACKGROUND"), name, (100*i//N_stats), error=False)
+                        self.view.mainArea.displaySkyMeasurement(name, row)
+                        save_list.append(row)
+                        if len(save_list) >= BUFFER_SIZE:
+                            log.debug("Sky Background Processor: saving to database")
+                            if writer:
+                                yield writer
+                            writer = self.sky.save(save_list)
+                            save_list = list()
+                finally:
+                    results.close()
+            chunk = yield next_chunk
+        if writer:
+            yield writer
         if save_list:
             log.debug("Sky Background Processor: saving to database")
             yield self.sky.save(save_list)
@@ -81,6 +81,7 @@ class GraphicalService(Service):
     def __init__(self, **kargs):
         super().__init__()
         setLogLevel(namespace=NAMESPACE, levelStr='info')
+        self.controllers = tuple()
         #self.task    = task.LoopingCall(self.heartBeat)
 
     # -----------
@@ -171,6 +172,10 @@ class GraphicalService(Service):
     def stopService(self):
         log.info('Stopping Graphical User Interface Service')
         #self.task.stop()
+        # Worker pools of the image and sky background controllers
+        for controller in self.controllers:
+            if hasattr(controller, 'shutdown'):
+                controller.shutdown()
         return super().stopService()
 
 
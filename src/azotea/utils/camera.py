@@ -16,15 +16,14 @@ import os.path
 # Third party imports
 # -------------------
 
-import exifread
 import rawpy
-from astropy.io import fits 
 
 #--------------
 # local imports
 # -------------
 
 from azotea.utils.fits import fits_assert_valid, fits_check_valid_extension
+from azotea.utils.header import exif_tags, fits_header
 
 # ----------------
 # Module constants
@@ -92,9 +91,9 @@ class TooDifferentValuesBiasError(BiasError):
 def camera_from_image_fits(filepath):
     extension = os.path.splitext(filepath)[1]
     warning = False
-    with fits.open(filepath, memmap=False) as hdu_list:
-        header        = hdu_list[0].header
-        fits_assert_valid(filepath, header)
+    with open(filepath, 'rb') as f:
+        header = fits_header(f)
+    fits_assert_valid(filepath, header)
     info = {
         'model'         : header['INSTRUME'],
         'extension'     : extension,
@@ -151,7 +150,7 @@ def bayer_from_exif(img):
 def camera_from_image_exif(filepath):
     extension = os.path.splitext(filepath)[1]
     with open(filepath, 'rb') as f:
-        exif = exifread.process_file(f, details=False)
+        exif = exif_tags(f)
     # This ensures that non EXIF images are detected and an exeption is raised
     if not exif:
         message = 'Could not open EXIF metadata'
@@ -66,6 +66,7 @@ def create_schema(connection, schema_path, initial_data_dir_path, updates_data_d
     cursor = connection.cursor()
     try:
         cursor.execute(query)
+        cursor.fetchall()   # Finish the statement, as VACUUM may appear in updates
     except Exception:
         created = False
     if not created:
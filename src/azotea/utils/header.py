@@ -0,0 +1,255 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# Lightweight header readers for the metadata hot path.
+# Only the few EXIF tags and FITS keywords used by AZOTEA are decoded,
+# reading just the first bytes of the file and stopping as soon as possible.
+# Anything unusual is handed over to exifread or astropy.
+
+#--------------------
+# System wide imports
+# -------------------
+
+import struct
+
+from fractions import Fraction
+
+# -------------------
+# Third party imports
+# -------------------
+
+import exifread
+from astropy.io import fits
+
+#--------------
+# local imports
+# -------------
+
+# ----------------
+# Module constants
+# ----------------
+
+# TIFF based RAW formats: 42 = NEF, CR2, PEF, DNG ..., 0x4f52 & 0x5352 = ORF
+TIFF_MAGIC = (42, 0x4f52, 0x5352)
+
+TIFF_HEAD_SIZE = 64*1024  # Bytes read in one go. Usually contains IFD0 and the EXIF IFD
+
+# TIFF type => (size, struct format)
+TIFF_TYPES = {
+    1:  (1, 'B'),   # BYTE
+    2:  (1, 's'),   # ASCII
+    3:  (2, 'H'),   # SHORT
+    4:  (4, 'L'),   # LONG
+    5:  (8, 'LL'),  # RATIONAL
+    7:  (1, 's'),   # UNDEFINED
+    9:  (4, 'l'),   # SLONG
+    10: (8, 'll'),  # SRATIONAL
+}
+
+EXIF_IFD_POINTER = 0x8769
+
+# IFD0 tags with exifread names
+IFD0_TAGS = {
+    0x0110: 'Image Model',
+    0x0132: 'Image DateTime',
+}
+
+# EXIF IFD tags with exifread names
+EXIF_TAGS = {
+    0x829A: 'EXIF ExposureTime',
+    0x829D: 'EXIF FNumber',
+    0x8827: 'EXIF ISOSpeedRatings',
+    0x920A: 'EXIF FocalLength',
+}
+
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE  = 80
+
+# FITS keywords used by AZOTEA
+FITS_KEYWORDS = (
+    'NAXIS1', 'NAXIS2', 'INSTRUME', 'EXPTIME', 'DATE-OBS', 'LOG-GAIN', 'FOCALLEN', 'APTDIA',
+    'BAYERPAT', 'SWMODIFY', 'SWCREATE', 'IMAGETYP', 'PEDESTAL', 'XPIXSZ', 'YPIXSZ',
+)
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+# ----------
+# Exceptions
+# ----------
+
+class UnusualHeaderError(Exception):
+    '''Header not handled by the fast parser'''
+    pass
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+class _TiffReader:
+
+    def __init__(self, f, start):
+        self._f = f
+        self._start = start
+        self._head = f.read(TIFF_HEAD_SIZE)
+        if len(self._head) < 8:
+            raise UnusualHeaderError("Too short")
+        order = self._head[0:2]
+        if order == b'II':
+            self._endian = '<'
+        elif order == b'MM':
+            self._endian = '>'
+        else:
+            raise UnusualHeaderError("Not a TIFF file")
+        magic, self.ifd0 = self.unpack('HL', 2)
+        if magic not in TIFF_MAGIC:
+            raise UnusualHeaderError(f"Unknown TIFF magic {magic:#x}")
+
+    def read(self, offset, n):
+        if offset + n <= len(self._head):
+            return self._head[offset:offset+n]
+        self._f.seek(self._start + offset)
+        data = self._f.read(n)
+        if len(data) < n:
+            raise UnusualHeaderError("Truncated file")
+        return data
+
+    def unpack(self, fmt, offset):
+        fmt = self._endian + fmt
+        return struct.unpack(fmt, self.read(offset, struct.calcsize(fmt)))
+
+    def ifd(self, offset, wanted):
+        '''Returns a dictionary tag => value for the wanted tags in an IFD'''
+        result = dict()
+        (n,) = self.unpack('H', offset)
+        for i in range(n):
+            tag, typ, count, value_offset = self.unpack('HHL4s', offset + 2 + 12*i)
+            if tag not in wanted:
+                continue
+            if typ not in TIFF_TYPES or count == 0:
+                raise UnusualHeaderError(f"Tag {tag:#x} with type {typ}")
+            size, fmt = TIFF_TYPES[typ]
+            if size*count <= 4:
+                data = value_offset[:size*count]
+            else:
+                (pointer,) = struct.unpack(self._endian + 'L', value_offset)
+                data = self.read(pointer, size*count)
+            result[tag] = self.decode(tag, typ, count, fmt, data)
+        return result
+
+    def decode(self, tag, typ, count, fmt, data):
+        if fmt == 's':
+            return data.split(b'\x00',1)[0].decode('utf-8')
+        if count != 1:
+            raise UnusualHeaderError(f"Tag {tag:#x} with {count} values")
+        values = struct.unpack(self._endian + fmt, data)
+        if len(values) == 2:
+            if values[1] == 0:
+                raise UnusualHeaderError(f"Tag {tag:#x} with zero denominator")
+            return Fraction(*values)
+        return values[0]
+
+
+def _exif_tags(f):
+    tiff = _TiffReader(f, f.tell())
+    ifd0 = tiff.ifd(tiff.ifd0, set(IFD0_TAGS) | {EXIF_IFD_POINTER})
+    if 0x0110 not in ifd0:
+        raise UnusualHeaderError("Camera model not in IFD0")
+    result = {IFD0_TAGS[tag]: value for tag, value in ifd0.items() if tag in IFD0_TAGS}
+    if EXIF_IFD_POINTER in ifd0:
+        exif = tiff.ifd(ifd0[EXIF_IFD_POINTER], EXIF_TAGS)
+        result.update({EXIF_TAGS[tag]: value for tag, value in exif.items()})
+    return result
+
+
+def _fits_value(card):
+    value = card[10:].lstrip()
+    if value.startswith("'"):
+        # String value, with '' as an embedded quote
+        i = 1; chars = list()
+        while True:
+            j = value.find("'", i)
+            if j < 0:
+                raise UnusualHeaderError(f"Unterminated string in {card}")
+            chars.append(value[i:j])
+            if value[j+1:j+2] == "'":
+                chars.append("'")
+                i = j + 2
+            else:
+                break
+        value = ''.join(chars).rstrip()
+        if value.endswith('&'):
+            raise UnusualHeaderError(f"Long string in {card}")
+        return value
+    value = value.split('/',1)[0].strip()
+    if value == 'T':
+        return True
+    if value == 'F':
+        return False
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace('D','E'))
+    except ValueError:
+        raise UnusualHeaderError(f"Unsupported value in {card}")
+
+
+def _fits_header(f, keywords):
+    result = dict()
+    wanted = set(keywords)
+    first  = True
+    while True:
+        block = f.read(FITS_BLOCK_SIZE)
+        if len(block) < FITS_BLOCK_SIZE:
+            raise UnusualHeaderError("Truncated header")
+        block = block.decode('ascii')
+        for i in range(0, FITS_BLOCK_SIZE, FITS_CARD_SIZE):
+            card    = block[i:i+FITS_CARD_SIZE]
+            keyword = card[:8].rstrip()
+            if first:
+                if keyword != 'SIMPLE':
+                    raise UnusualHeaderError("Not a FITS primary header")
+                first = False
+            if keyword == 'END':
+                return result
+            if keyword in wanted and keyword not in result and card[8:10] == '= ':
+                result[keyword] = _fits_value(card)
+                if len(result) == len(wanted):
+                    return result
+
+# --------------------------------------------
+# Main functions to be exported by this module
+# --------------------------------------------
+
+def exif_tags(f):
+    '''
+    Reads the EXIF tags used by AZOTEA from an open RAW file.
+    Returns a dictionary with the same tag names as exifread.
+    '''
+    start = f.tell()
+    try:
+        return _exif_tags(f)
+    except (UnusualHeaderError, struct.error, UnicodeDecodeError):
+        f.seek(start)
+        return exifread.process_file(f, details=False)
+
+
+def fits_header(f, keywords=FITS_KEYWORDS):
+    '''
+    Reads the given keywords from the primary header of an open FITS file.
+    Returns a dictionary with the keywords found.
+    '''
+    start = f.tell()
+    try:
+        return _fits_header(f, keywords)
+    except (UnusualHeaderError, UnicodeDecodeError):
+        f.seek(start)
+        header = fits.Header.fromfile(f)
+        return {keyword: header[keyword] for keyword in keywords if keyword in header}
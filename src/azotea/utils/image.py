@@ -11,6 +11,7 @@
 
 import os
 import re
+import mmap
 import datetime
 import hashlib
 from fractions import Fraction
@@ -19,8 +20,6 @@ from fractions import Fraction
 # Third party libraries
 # ---------------------
 
-import exifread
-from astropy.io import fits
 
 #--------------
 # local imports
@@ -29,6 +28,7 @@ from astropy.io import fits
 from azotea import FITS_HEADER_TYPE, EXIF_HEADER_TYPE
 
 from azotea.utils.fits import fits_assert_valid
+from azotea.utils.header import exif_tags, fits_header
 
 # ----------------
 # Module constants
@@ -50,6 +50,8 @@ FITS_IMAGE_TYPE_MAPPING = {
     'Tricolor Image' : 'LIGHT'
 }
 
+NIGHT_CHANGE_HOUR = 12   # Images taken before noon belong to the previous night
+
 # -----------------------
 # Module global variables
 # -----------------------
@@ -102,15 +104,17 @@ def default_classify_image_type(filepath):
     return result
 
 
+def fits_classify_header(filepath, header):
+    imagetyp = header.get('IMAGETYP')
+    if imagetyp is None:
+        return default_classify_image_type(filepath)
+    return FITS_IMAGE_TYPE_MAPPING.get(imagetyp,'LIGHT')
+
+
 def fits_classify_image_type(filepath):
-    with fits.open(filepath, mode='update') as hdul:
-        header = hdul[0].header
-        imagetyp = header.get('IMAGETYP')
-        if imagetyp is None:
-            hdul.close()
-            return default_classify_image_type(filepath)
-        result = FITS_IMAGE_TYPE_MAPPING.get(imagetyp,'LIGHT')
-        return result
+    with open(filepath, 'rb') as f:
+        header = fits_header(f)
+    return fits_classify_header(filepath, header)
 
 
 def scan_non_empty_dirs(root_dir, depth=None):
@@ -124,25 +128,87 @@ def scan_non_empty_dirs(root_dir, depth=None):
     return list(filter(lambda d: len(d.split(sep=os.sep)) - L <= depth, dirs))
 
 
-def hash_func(filepath):
-    '''Compute a hash from the image'''
-    BLOCK_SIZE = 1048576 # 1MByte, the size of each read from the file
+def scan_images(root_dir, extension, depth=None, index=None):
+    '''
+    Streaming directory walker.
+    Yields (directory, (mtime_ns, entries, subdirs), file_list) tuples as soon as
+    each directory is listed, where file_list contains the files matching the extension.
+    Leaf directories whose (mtime_ns, entries, subdirs) are in the index dictionary
+    with the same mtime are not listed at all.
+    Sibling directories are visited in reverse order.
+    '''
+    index = index or dict()
+    if os.path.basename(root_dir) == '':
+        root_dir = root_dir[:-1]
+    stack = [(root_dir, os.stat(root_dir).st_mtime_ns, 0)]
+    while stack:
+        directory, mtime_ns, level = stack.pop()
+        known = index.get(directory)
+        if known and known[0] == mtime_ns and known[2] == 0:
+            continue
+        file_list = list(); subdirs = list(); entries = 0
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    entries += 1
+                    # The same hidden file exclusion as glob does
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry)
+                    elif entry.name.endswith(extension) and entry.is_file():
+                        file_list.append(entry.path)
+        except OSError:
+            continue    # Directory vanished or not readable
+        if depth is None or level < depth:
+            for entry in sorted(subdirs, key=lambda e: e.name):
+                try:
+                    stack.append((entry.path, entry.stat(follow_symlinks=False).st_mtime_ns, level+1))
+                except OSError:
+                    pass
+        yield directory, (mtime_ns, entries, len(subdirs)), sorted(file_list)
+
+
+def file_fingerprint(stat_result):
+    '''Cheap file identity to detect changes without rehashing'''
+    return (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino)
+
+
+def fingerprints(directory, names):
+    '''Returns a dictionary name => fingerprint for files in a directory'''
+    result = dict()
+    for name in names:
+        try:
+            result[name] = file_fingerprint(os.stat(os.path.join(directory, name)))
+        except OSError:
+            pass # File vanished in the meantime
+    return result
+
+
+def hash_fileobj(f):
+    '''Compute a hash from an already opened image file'''
     # md5() was the fastest algorithm I've tried
     # but I'm using blake2b with twice the digest size for compatibility
     # with the old AZOTEA software    
     #file_hash = hashlib.md5()
     file_hash = hashlib.blake2b(digest_size=32)
-    with open(filepath, 'rb') as f:
-        block = f.read(BLOCK_SIZE) 
-        while len(block) > 0:
-            file_hash.update(block)
-            block = f.read(BLOCK_SIZE)
+    try:
+        # The whole file is hashed in one call without copying it to user space.
+        # Pages read this way stay in the page cache for the header parsers
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            file_hash.update(mm)
+    except ValueError:
+        pass  # Empty files cannot be mapped
     return file_hash.digest()
 
 
-def exif_metadata(filepath, row):
+def hash_func(filepath):
+    '''Compute a hash from the image'''
     with open(filepath, 'rb') as f:
-        exif = exifread.process_file(f, details=False)
+        return hash_fileobj(f)
+
+
+def exif_to_row(exif, row):
     if not exif:
         message = 'Could not open EXIF metadata'
         raise ValueError(message)
@@ -152,6 +218,8 @@ def exif_metadata(filepath, row):
     row['f_number']     = float(Fraction(str(exif.get('EXIF FNumber', 0))))
     row['exptime']      = float(Fraction(str(exif.get('EXIF ExposureTime', 0))))
     row['date_id'], row['time_id'], row['widget_date'], row['widget_time'] = toDateTime(str(exif.get('Image DateTime', None)))
+    row['night_id']     = night_id(row['date_id'], row['time_id'])
+    row['month_id']     = row['date_id'] // 100
    
     # Fixes missing Focal Length and F/ ratio
     row['focal_length'] = row['def_fl'] if row['focal_length'] == 0 else row['focal_length']
@@ -161,25 +229,45 @@ def exif_metadata(filepath, row):
     row['gain'] = None
     return row
 
-def fits_metadata(filepath, row):
-    with fits.open(filepath, memmap=False) as hdu_list:
-        header        = hdu_list[0].header
-        fits_assert_valid(filepath, header)
-        row['model']   = header['INSTRUME']
-        row['iso']     = None  # Fixed value for AstroCameras (they do not define the ISO concept)
-        row['gain']    = header['LOG-GAIN']
-        row['exptime'] = header['EXPTIME']
-        date_obs       = header['DATE-OBS']
-        row['date_id'], row['time_id'], row['widget_date'], row['widget_time'] = toDateTime(date_obs)
-        # For astro cameras this probably is not in the FITS header 
-        # so we use the default values
-        focal_length = header.get('FOCALLEN')
-        diameter     = header.get('APTDIA')
-        row['focal_length'] = row['def_fl'] if focal_length is None else focal_length
-        row['f_number']     = row['def_fn'] if focal_length is None and diameter is None else round(focal_length/diameter,1)
+
+def fits_to_row(filepath, header, row):
+    fits_assert_valid(filepath, header)
+    row['model']   = header['INSTRUME']
+    row['iso']     = None  # Fixed value for AstroCameras (they do not define the ISO concept)
+    row['gain']    = header['LOG-GAIN']
+    row['exptime'] = header['EXPTIME']
+    date_obs       = header['DATE-OBS']
+    row['date_id'], row['time_id'], row['widget_date'], row['widget_time'] = toDateTime(date_obs)
+    row['night_id'] = night_id(row['date_id'], row['time_id'])
+    row['month_id'] = row['date_id'] // 100
+    # For astro cameras this probably is not in the FITS header 
+    # so we use the default values
+    focal_length = header.get('FOCALLEN')
+    diameter     = header.get('APTDIA')
+    row['focal_length'] = row['def_fl'] if focal_length is None else focal_length
+    row['f_number']     = row['def_fn'] if focal_length is None and diameter is None else round(focal_length/diameter,1)
     return row
+
+
+def exif_metadata(filepath, row):
+    with open(filepath, 'rb') as f:
+        exif = exif_tags(f)
+    return exif_to_row(exif, row)
+
+
+def fits_metadata(filepath, row):
+    with open(filepath, 'rb') as f:
+        header = fits_header(f)
+    return fits_to_row(filepath, header, row)
         
 
+def night_id(date_id, time_id):
+    '''Observation night YYYYMMDD of an image, as the date when the night began'''
+    tstamp = datetime.datetime.strptime(f"{date_id:08d}{time_id:06d}", "%Y%m%d%H%M%S")
+    tstamp -= datetime.timedelta(hours=NIGHT_CHANGE_HOUR)
+    return int(tstamp.strftime("%Y%m%d"))
+
+
 def toDateTime(tstamp):
     for fmt in ('%Y:%m:%d %H:%M:%S','%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
         try:
@@ -202,15 +290,31 @@ def toDateTime(tstamp):
 # Main functions to be exported by this module
 # --------------------------------------------
 
-def hash_and_metadata_fits(filepath, row):
-    row['hash'] = hash_func(filepath)
-    row = fits_metadata(filepath, row)
+# Each file is opened only once: its header is parsed first and,
+# only if taken with the expected camera model, hashed through a memory map.
+# Rejected images are returned without a 'hash' key
+
+def hash_and_metadata_fits(filepath, row, model=None):
+    with open(filepath, 'rb') as f:
+        row['size'], row['mtime_ns'], row['inode'] = file_fingerprint(os.fstat(f.fileno()))
+        header = fits_header(f)
+        row = fits_to_row(filepath, header, row)
+        if model is not None and row['model'] != model:
+            return row
+        row['hash'] = hash_fileobj(f)
+    row['imagetype'] = fits_classify_header(filepath, header)
     return row
 
 
-def hash_and_metadata_exif(filepath, row):
-    row['hash'] = hash_func(filepath)
-    row = exif_metadata(filepath, row)
+def hash_and_metadata_exif(filepath, row, model=None):
+    with open(filepath, 'rb') as f:
+        row['size'], row['mtime_ns'], row['inode'] = file_fingerprint(os.fstat(f.fileno()))
+        exif = exif_tags(f)
+        row = exif_to_row(exif, row)
+        if model is not None and row['model'] != model:
+            return row
+        row['hash'] = hash_fileobj(f)
+    row['imagetype'] = default_classify_image_type(filepath)
     return row
 
 def classify_image_type(header_type, filepath):
@@ -0,0 +1,133 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# Master dark/bias frames built with a bounded memory streaming combine.
+# The mean is a running sum over one frame at a time. The median spools
+# the decoded frames to a temporary memory mapped file on disk and is
+# computed over blocks of rows, so that only a few frames worth of pixels
+# are ever held in memory.
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import hashlib
+import tempfile
+
+# -------------------
+# Third party imports
+# -------------------
+
+import numpy as np
+import rawpy
+from astropy.io import fits
+
+#--------------
+# local imports
+# -------------
+
+from azotea import FITS_HEADER_TYPE
+from azotea.utils.sky import all_channels_stats
+
+# ----------------
+# Module constants
+# ----------------
+
+MEAN   = 'mean'
+MEDIAN = 'median'
+
+COMBINE_METHODS = (MEAN, MEDIAN)
+
+# Version of the combine algorithm, part of the master cache key.
+# Must be increased whenever the combined frames may change
+MASTER_VERSION = 1
+
+MASTER_BLOCK_BYTES = 128*1024*1024   # Spooled pixels read at a time by the median combine
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def master_key(hashes, method):
+    '''Cache key for a master frame: its input image hashes, combine method and algorithm version'''
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{method}:{MASTER_VERSION}".encode())
+    for digest in sorted(hashes):
+        h.update(digest)
+    return h.hexdigest()
+
+
+def read_raw_frame(filepath, header_type):
+    '''Whole raw frame in physical units, in the same pixel layout used for the ROIs'''
+    if header_type == FITS_HEADER_TYPE:
+        return fits.getdata(filepath)
+    with rawpy.imread(filepath) as img:
+        return img.raw_image.copy()
+
+
+def combine_mean(file_list, header_type):
+    if not file_list:
+        raise ValueError("No frames to combine")
+    total = None
+    for filepath in file_list:
+        frame = read_raw_frame(filepath, header_type)
+        if total is None:
+            total = np.zeros(frame.shape, dtype=np.float64)
+        total += frame
+    return (total / len(file_list)).astype(np.float32)
+
+
+def combine_median(file_list, header_type, tmp_dir=None):
+    if not file_list:
+        raise ValueError("No frames to combine")
+    N = len(file_list)
+    with tempfile.TemporaryFile(dir=tmp_dir) as f:
+        for filepath in file_list:
+            frame = read_raw_frame(filepath, header_type)
+            frame.tofile(f)
+        f.flush()
+        spool = np.memmap(f, dtype=frame.dtype, mode='r', shape=(N,) + frame.shape)
+        del frame
+        H, W = spool.shape[1:]
+        master = np.empty((H, W), dtype=np.float32)
+        rows = max(1, MASTER_BLOCK_BYTES // (N * W * spool.itemsize))
+        for r in range(0, H, rows):
+            master[r:r+rows] = np.median(spool[:, r:r+rows], axis=0)
+        del spool
+    return master
+
+# --------------------------------------------
+# Main functions to be exported by this module
+# --------------------------------------------
+
+def build_master(file_list, header_type, method, path):
+    '''
+    Combines the raw frames of the given files into a master frame saved at path (.npy).
+    Returns path. An existing master at path is reused, as its name contains the master_key()
+    Raises ValueError with an empty file list
+    '''
+    if not file_list:
+        raise ValueError("No frames to combine")
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if method == MEAN:
+        master = combine_mean(file_list, header_type)
+    else:
+        master = combine_median(file_list, header_type, os.path.dirname(path))
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, master)
+    os.replace(tmp_path, path)
+    return path
+
+
+def master_roi_stats(path, bayer_pattern, roi):
+    '''Per channel (average, variance) dictionary of a master frame ROI'''
+    master = np.load(path, mmap_mode='r')
+    row = all_channels_stats(master, bayer_pattern, roi, dict())
+    return {channel: (row[f'aver_signal_{channel}'], row[f'vari_signal_{channel}']) for channel in ('R', 'G1', 'G2', 'B')}
@@ -0,0 +1,90 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# Page cache hints for the images being processed.
+# Upcoming images are read ahead in the background while the workers decode
+# the current ones, and images already processed are dropped from the page
+# cache so that they do not evict the database pages.
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import collections
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.internet.threads import deferToThread
+
+#--------------
+# local imports
+# -------------
+
+# ----------------
+# Module constants
+# ----------------
+
+READ_AHEAD = 4   # Default number of images read ahead of the workers
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+# posix_fadvise() is not available on every platform
+ADVICE_SUPPORTED = hasattr(os, 'posix_fadvise')
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def advise(filepath, advice):
+    '''Page cache hint for the whole file. Hints are only hints, so errors are ignored'''
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, advice)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+# --------------------------------------------
+# Main functions to be exported by this module
+# --------------------------------------------
+
+def will_need(filepath):
+    '''Starts reading the file into the page cache in a background thread'''
+    if ADVICE_SUPPORTED:
+        deferToThread(advise, filepath, os.POSIX_FADV_WILLNEED).addErrback(lambda failure: None)
+
+
+def dont_need(filepath):
+    '''Drops the file from the page cache in a background thread'''
+    if ADVICE_SUPPORTED:
+        deferToThread(advise, filepath, os.POSIX_FADV_DONTNEED).addErrback(lambda failure: None)
+
+
+def read_ahead(jobs, depth=READ_AHEAD):
+    '''
+    Generator passing through (name, directory, ...) job tuples, while hinting the 
+    page cache to read the image files of the next depth jobs not yet taken.
+    '''
+    if not depth or not ADVICE_SUPPORTED:
+        yield from jobs
+        return
+    upcoming = collections.deque()
+    for job in jobs:
+        will_need(os.path.join(job[1], job[0]))
+        upcoming.append(job)
+        if len(upcoming) > depth:
+            yield upcoming.popleft()
+    yield from upcoming
@@ -17,15 +17,14 @@ import gettext
 # Third party imports
 # -------------------
 
-import exifread
 import rawpy
-from astropy.io import fits
 
 #--------------
 # local imports
 # -------------
 
 from azotea.utils.fits import fits_assert_valid, fits_check_valid_extension
+from azotea.utils.header import exif_tags, fits_header
 
 
 # Support for internationalization
@@ -112,16 +111,16 @@ class Rect:
 
 
 def raw_dimensions_fits(filepath):
-    with fits.open(filepath, memmap=False) as hdu_list:
-        header = hdu_list[0].header
-        fits_assert_valid(filepath, header)
+    with open(filepath, 'rb') as f:
+        header = fits_header(f)
+    fits_assert_valid(filepath, header)
     return header['NAXIS2'], header['NAXIS1'], header['INSTRUME']
   
      
 def raw_dimensions_exif(filepath):
     # This is to properly detect and EXIF image
     with open(filepath, 'rb') as f:
-        exif = exifread.process_file(f, details=False)
+        exif = exif_tags(f)
         if not exif:
             raise ValueError("Could not open EXIF metadata")
     # Get the real RAW dimensions instead
@@ -14,6 +14,7 @@ import os
 import sys
 import csv
 import math
+import zlib
 import glob
 import hashlib
 import gettext
@@ -49,6 +50,7 @@ from azotea import __version__
 from azotea.utils import chop
 
 from azotea.utils.roi import Point, Rect
+from azotea.utils.image import hash_and_metadata_fits, hash_and_metadata_exif
 from azotea.logger  import startLogging, setLogLevel
 
 from azotea import FITS_HEADER_TYPE, EXIF_HEADER_TYPE
@@ -61,6 +63,23 @@ from azotea import DATE_SELECTION_ALL, DATE_SELECTION_DATE_RANGE, DATE_SELECTION
 
 RAWPY_EXCEPTIONS = (rawpy._rawpy.LibRawIOError, rawpy._rawpy.LibRawFileUnsupportedError)
 
+# Version of the sky statistics algorithm, as stored in the statistics cache.
+# Must be increased whenever the computed figures may change
+STATS_VERSION = 1
+
+STATS_COLUMNS = (
+    'aver_signal_R', 'vari_signal_R', 'aver_signal_G1', 'vari_signal_G1',
+    'aver_signal_G2', 'vari_signal_G2', 'aver_signal_B', 'vari_signal_B',
+)
+
+FULL_FRAME = {'x1': 0, 'y1': 0}   # ROI origin of a whole frame
+
+TILES_GRID = 16   # Default number of tiles per side in full frame statistics maps
+
+HISTOGRAM_MAX_BINS = 65536   # Histograms are only kept for pixel values spanning up to 16 bits
+
+STATS_CHUNK_ROWS = 64   # Raw rows accumulated at a time by bayer_sums(). Must be even
+
 # RGGB => R = [x=0,y=0], G1 = [x=1,y=0], G2 = [x=0,y=1], B = [x=1,y=1]
 # BGGR => R = [x=1,y=1], G1 = [x=1,y=0], G2 = [x=0,y=1], B = [x=0,y=0]
 # GRBG => R = [x=1,y=0], G1 = [x=0,y=0], G2 = [x=1,y=1], B = [x=0,y=1]
@@ -159,37 +178,270 @@ def get_image_roi(debayered_channel, roi):
      x1 = roi['x1'] ; x2 = roi['x2']
      return debayered_channel[y1:y2, x1:x2]
 
-def region_stats(raw_pixels, bayer_pattern, channel, roi):
+def region_stats(raw_pixels, bayer_pattern, channel, roi, offset=0):
      debayered_channel = get_debayered_for_channel(raw_pixels, bayer_pattern, channel)
      section           = get_image_roi(debayered_channel, roi)
-     average, variance = round(section.mean(),1), round(section.var(),3)
+     average, variance = round(section.mean() + offset,1), round(section.var(),3)
      return average, variance
 
-def all_channels_stats(raw_pixels, bayer_pattern, roi, row):
-    row['aver_signal_R'] , row['vari_signal_R']  = region_stats(raw_pixels, bayer_pattern, 'R', roi)
-    row['aver_signal_G1'], row['vari_signal_G1'] = region_stats(raw_pixels, bayer_pattern, 'G1', roi)
-    row['aver_signal_G2'], row['vari_signal_G2'] = region_stats(raw_pixels, bayer_pattern, 'G2', roi)
-    row['aver_signal_B'] , row['vari_signal_B']  = region_stats(raw_pixels, bayer_pattern, 'B', roi)
+def fits_unscaled_offset(header):
+    '''
+    Offset to add to the native integer pixel values to get the physical ones (BZERO)
+    or None if physical values need a real scaling
+    '''
+    if header.get('BSCALE', 1) != 1 or 'BLANK' in header:
+        return None
+    return header.get('BZERO', 0)
+
+def raw_roi_block(roi):
+    '''Raw pixel slices covering all the debayered channels of a ROI'''
+    return slice(2*roi['y1'], 2*roi['y2']), slice(2*roi['x1'], 2*roi['x2'])
+
+def bounding_roi(rois):
+    '''Smallest ROI containing all the given ROIs'''
+    return {
+        'x1': min(roi['x1'] for roi in rois), 'x2': max(roi['x2'] for roi in rois),
+        'y1': min(roi['y1'] for roi in rois), 'y2': max(roi['y2'] for roi in rois),
+    }
+
+def relative_roi(roi, origin=None):
+    '''The same ROI referred to the raw block returned by raw_roi_block(origin)'''
+    origin = origin or roi
+    x0, y0 = origin['x1'], origin['y1']
+    return {'x1': roi['x1'] - x0, 'y1': roi['y1'] - y0, 'x2': roi['x2'] - x0, 'y2': roi['y2'] - y0}
+
+def bayer_sums(raw_block):
+    '''
+    Single pass accumulation over the four CFA sites of a raw block with even dimensions.
+    Returns the number of pixels per site and three 2x2 arrays indexed by [y offset, x offset]:
+    the reference value subtracted (only for floating point data) sums and sums of squares.
+    Integer data is accumulated exactly in int64.
+    '''
+    H, W = raw_block.shape
+    w = W//2
+    if np.issubdtype(raw_block.dtype, np.integer):
+        dtype = np.int64
+        ref   = np.zeros((2,2), dtype=dtype)
+    else:
+        # Shifting by a sample value avoids cancellation when computing the variance
+        dtype = np.float64
+        ref   = raw_block[0:2, 0:2].astype(dtype)
+    sums    = np.zeros((2,w,2), dtype=dtype)
+    squares = np.zeros((2,w,2), dtype=dtype)
+    # Rows are processed in chunks that fit in the CPU cache.
+    # Adding whole rows is much faster than reducing over the strided sites
+    buf = np.empty((min(STATS_CHUNK_ROWS, H), W), dtype=dtype)
+    for r in range(0, H, STATS_CHUNK_ROWS):
+        chunk  = raw_block[r:r+STATS_CHUNK_ROWS]
+        n      = chunk.shape[0]
+        pixels = buf[:n]
+        np.copyto(pixels, chunk, casting='unsafe')
+        sites  = pixels.reshape(n//2, 2, w, 2)
+        if dtype is np.float64:
+            sites -= ref.reshape(1,2,1,2)
+        sums += sites.sum(axis=0)
+        np.multiply(pixels, pixels, out=pixels)
+        squares += sites.sum(axis=0)
+    return (H//2)*w, ref, sums.sum(axis=1), squares.sum(axis=1)
+
+def cfa_stats(raw_block, bayer_pattern, offset=0):
+    '''
+    Average and variance for each CFA channel of a raw block with even dimensions.
+    offset is added to the averages, as with FITS BZERO. Variances are not affected
+    '''
+    n, ref, sums, squares = bayer_sums(raw_block)
+    result = dict()
+    for channel, site in CFA_OFFSETS[bayer_pattern].items():
+        y, x = site['y'], site['x']
+        s, q = sums[y,x].item(), squares[y,x].item()
+        result[channel] = (ref[y,x].item() + s/n + offset, (n*q - s*s)/(n*n))
+    return result
+
+def all_channels_stats(raw_pixels, bayer_pattern, roi, row, offset=0):
+    '''offset is added to the averages, as with FITS BZERO. Variances are not affected'''
+    rows, columns = raw_roi_block(roi)
+    raw_block = raw_pixels[rows, columns]
+    if raw_block.size == 0 or raw_block.shape[0] % 2 or raw_block.shape[1] % 2:
+        # ROI clipped by the image borders
+        for channel in ('R', 'G1', 'G2', 'B'):
+            row[f'aver_signal_{channel}'], row[f'vari_signal_{channel}'] = region_stats(raw_pixels, bayer_pattern, channel, roi, offset)
+        return row
+    for channel, (average, variance) in cfa_stats(raw_block, bayer_pattern, offset).items():
+        row[f'aver_signal_{channel}'], row[f'vari_signal_{channel}'] = round(average,1), round(variance,3)
+    return row
+
+def channel_histogram(section):
+    '''
+    Integer histogram with one bin per raw value of a debayered channel section.
+    Returns (origin, counts) with the raw value of the first bin, or None for unsuitable data
+    '''
+    if section.size == 0 or not np.issubdtype(section.dtype, np.integer):
+        return None
+    values = section.ravel()
+    lo, hi = int(values.min()), int(values.max())
+    if hi - lo >= HISTOGRAM_MAX_BINS:
+        return None
+    if lo >= 0:
+        counts = np.bincount(values, minlength=hi+1)[lo:]
+    else:
+        counts = np.bincount(values.astype(np.int64) - lo)
+    return lo, counts
+
+def encode_histogram(counts):
+    return zlib.compress(counts.astype('<u4').tobytes())
+
+def decode_histogram(origin, blob):
+    '''Returns the (values, counts) NumPy arrays of a stored histogram'''
+    counts = np.frombuffer(zlib.decompress(blob), dtype='<u4')
+    return np.arange(origin, origin + counts.size), counts
+
+def histogram_percentile(values, counts, q):
+    '''q-th percentile (0-100) of the pixel values in a histogram, as the lowest value reaching it'''
+    cumulative = np.cumsum(counts, dtype=np.int64)
+    rank = q/100 * cumulative[-1]
+    return values[np.searchsorted(cumulative, rank)].item()
+
+def histogram_median(values, counts):
+    return histogram_percentile(values, counts, 50)
+
+def cfa_histograms(raw_pixels, bayer_pattern, roi, offset=0):
+    '''
+    Histograms of each CFA channel in a ROI, as {channel: (origin, compressed counts)}.
+    offset is added to the origin, as with FITS BZERO. Channels with unsuitable data are left out.
+    '''
+    result = dict()
+    if offset != int(offset):
+        return result
+    for channel in CFA_OFFSETS[bayer_pattern]:
+        debayered_channel = get_debayered_for_channel(raw_pixels, bayer_pattern, channel)
+        histogram = channel_histogram(get_image_roi(debayered_channel, roi))
+        if histogram:
+            origin, counts = histogram
+            result[channel] = (origin + int(offset), encode_histogram(counts))
+    return result
+
+def cfa_tiles(raw_pixels, bayer_pattern, grid, offset=0):
+    '''
+    Average and variance of each CFA channel over a grid x grid tiling of the whole frame,
+    with as many whole tiles as fit in it. Returns {channel: (grid, tile_width, tile_height, compressed stats)}
+    where tile sizes are in debayered pixels. offset is added to the averages, as with FITS BZERO.
+    '''
+    H, W = raw_pixels.shape
+    th, tw = H // (2*grid), W // (2*grid)
+    if th == 0 or tw == 0:
+        return dict()
+    if np.issubdtype(raw_pixels.dtype, np.integer):
+        dtype = np.int64
+        ref   = np.zeros((2,2), dtype=dtype)
+    else:
+        dtype = np.float64
+        ref   = raw_pixels[0:2, 0:2].astype(dtype)
+    sums    = np.zeros((grid, 2, grid, 2), dtype=dtype)
+    squares = np.zeros((grid, 2, grid, 2), dtype=dtype)
+    # One row of tiles at a time. Whole raw rows are added first, which is much faster
+    # than reducing over the strided sites, and then the columns of each tile
+    for r in range(grid):
+        block = raw_pixels[2*th*r:2*th*(r+1), :2*tw*grid].astype(dtype)
+        if dtype is np.float64:
+            block.reshape(th, 2, grid*tw, 2)[...] -= ref.reshape(1,2,1,2)
+        sums[r] = block.reshape(th, 2, 2*tw*grid).sum(axis=0).reshape(2, grid, tw, 2).sum(axis=2)
+        np.multiply(block, block, out=block)
+        squares[r] = block.reshape(th, 2, 2*tw*grid).sum(axis=0).reshape(2, grid, tw, 2).sum(axis=2)
+    n = th*tw
+    result = dict()
+    for channel, site in CFA_OFFSETS[bayer_pattern].items():
+        y, x = site['y'], site['x']
+        s = sums[:, y, :, x].astype(np.float64)
+        q = squares[:, y, :, x].astype(np.float64)
+        average  = ref[y,x] + s/n + offset
+        variance = (n*q - s*s)/(n*n)
+        result[channel] = (grid, tw, th, encode_tiles(average, variance))
+    return result
+
+def encode_tiles(average, variance):
+    return zlib.compress(np.stack((average, variance), axis=-1).astype('<f4').tobytes())
+
+def decode_tiles(grid, blob):
+    '''Returns the (average, variance) grid x grid NumPy arrays of a stored tile statistics map'''
+    stats = np.frombuffer(zlib.decompress(blob), dtype='<f4').reshape(grid, grid, 2)
+    return stats[..., 0], stats[..., 1]
+
+def roi_measurements(raw_pixels, bayer_pattern, roi, row, offset=0, histograms=False):
+    row = all_channels_stats(raw_pixels, bayer_pattern, roi, row, offset)
+    if histograms:
+        row['histograms'] = cfa_histograms(raw_pixels, bayer_pattern, roi, offset)
     return row
 
 # --------------------
 # MAIN DRIVER FUNCTION
 # --------------------
 
-def processImage(name, directory, roi, header_type, bayer_pattern, row):
+def processImageROIs(name, directory, rois, header_type, bayer_pattern, rows, histograms=False, tiles=0):
+    '''
+    Statistics for several ROIs, one row each, decoding the image only once.
+    Optionally adds the per channel ROI histograms to each row under the 'histograms' key
+    and the tiles x tiles full frame statistics map to the first row under the 'tiles' key.
+    '''
     # THIS IS HEAVY STUFF TO BE IMPLEMENTED IN A THREAD
     filepath = os.path.join(directory, name)
+
+    def measure(raw_pixels, origin, offset=0):
+        return [roi_measurements(raw_pixels, bayer_pattern, relative_roi(roi, origin), row, offset, histograms) for roi, row in zip(rois, rows)]
+
     if header_type == FITS_HEADER_TYPE:
-        with fits.open(filepath, memmap=False) as hdu_list:
-            raw_pixels = hdu_list[0].data
-            # This must be executed unther the context manager
-            # for raw_pixels to become valid
-            row = all_channels_stats(raw_pixels, bayer_pattern, roi, row)
+        # Only the raw pixels covering the ROIs are read from disk, unless the whole frame is needed,
+        # memory mapped and in their native integer type. BZERO is added to the averages
+        if tiles:
+            origin = FULL_FRAME
+            block_rows, block_columns = slice(None), slice(None)
+        else:
+            origin = bounding_roi(rois)
+            block_rows, block_columns = raw_roi_block(origin)
+        with fits.open(filepath, memmap=True, do_not_scale_image_data=True) as hdu_list:
+            offset = fits_unscaled_offset(hdu_list[0].header)
+            if offset is not None:
+                raw_pixels = hdu_list[0].section[block_rows, block_columns]
+                rows = measure(raw_pixels, origin, offset)
+                if tiles:
+                    rows[0]['tiles'] = cfa_tiles(raw_pixels, bayer_pattern, tiles, offset)
+        if offset is None:
+            # Truly scaled data cannot be memory mapped
+            with fits.open(filepath, memmap=False) as hdu_list:
+                raw_pixels = hdu_list[0].section[block_rows, block_columns]
+                rows = measure(raw_pixels, origin)
+                if tiles:
+                    rows[0]['tiles'] = cfa_tiles(raw_pixels, bayer_pattern, tiles)
     else:
          with rawpy.imread(filepath) as img:
             raw_pixels = img.raw_image
             # This must be executed unther the context manager
             # for raw_pixels to become valid
-            row = all_channels_stats(raw_pixels, bayer_pattern, roi, row)
-    return row
+            rows = measure(raw_pixels, FULL_FRAME)
+            if tiles:
+                # Masked sensor borders are left out of the map
+                rows[0]['tiles'] = cfa_tiles(img.raw_image_visible, bayer_pattern, tiles)
+    return rows
+
 
+def processImage(name, directory, roi, header_type, bayer_pattern, row):
+    return processImageROIs(name, directory, [roi], header_type, bayer_pattern, [row])[0]
+
+
+def registerAndProcessImage(filepath, row, model, rois, bayer_pattern, rows, histograms=False, tiles=0):
+    '''
+    Hashes, reads the metadata and measures the ROIs of a new image in one go.
+    Hashing reads the whole file into the page cache so that it is decoded without reading it from disk again.
+    Returns the image row with the ROI statistics rows under the 'sky' key.
+    Images rejected by hash_and_metadata_*() or that cannot be decoded come without it.
+    '''
+    if row['header_type'] == FITS_HEADER_TYPE:
+        row = hash_and_metadata_fits(filepath, row, model)
+    else:
+        row = hash_and_metadata_exif(filepath, row, model)
+    if 'hash' not in row:
+        return row
+    try:
+        row['sky'] = processImageROIs(os.path.basename(filepath), os.path.dirname(filepath), rois, row['header_type'], bayer_pattern, rows, histograms, tiles)
+    except RAWPY_EXCEPTIONS:
+        pass    # Registered anyway. The sky background stage flags it as corrupt
+    return row
@@ -0,0 +1,151 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import sys
+import collections
+import multiprocessing
+import multiprocessing.resource_tracker
+import concurrent.futures
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.internet import reactor, defer
+
+#--------------
+# local imports
+# -------------
+
+# ----------------
+# Module constants
+# ----------------
+
+THREAD_POOL  = 'thread'
+PROCESS_POOL = 'process'
+
+POOL_TYPES = (THREAD_POOL, PROCESS_POOL)
+
+# Worker processes must not be forked from the multithreaded reactor process
+PROCESS_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def start_resource_tracker():
+    '''
+    The multiprocessing resource tracker process is given our stderr file descriptor,
+    but Twisted logging replaces sys.stderr with a file object without any
+    '''
+    stderr = sys.stderr
+    sys.stderr = sys.__stderr__
+    try:
+        multiprocessing.resource_tracker.ensure_running()
+    finally:
+        sys.stderr = stderr
+
+
+def future_to_deferred(future):
+    '''Bridges a concurrent.futures Future to a Deferred fired in the reactor thread'''
+    d = defer.Deferred()
+    def _done(future):
+        try:
+            result = future.result()
+        except BaseException as e:
+            reactor.callFromThread(d.errback, e)
+        else:
+            reactor.callFromThread(d.callback, result)
+    future.add_done_callback(_done)
+    return d
+
+# --------------
+# Module Classes
+# --------------
+
+class WorkerPool:
+    '''
+    Runs blocking functions in a pool of threads or processes.
+    Functions and arguments must be picklable when using a process pool.
+    '''
+
+    def __init__(self, workers=None, pool_type=THREAD_POOL, window=None):
+        if pool_type not in POOL_TYPES:
+            raise ValueError(f"Pool type must be one of {POOL_TYPES}")
+        self.workers   = workers or default_workers()
+        self.pool_type = pool_type
+        self.window    = window or 2*self.workers  # max. number of jobs in flight
+        self._executor = None
+
+    # ----------
+    # Public API
+    # ----------
+
+    def submit(self, func, *args):
+        '''Returns a Deferred'''
+        future = self._getExecutor().submit(func, *args)
+        return future_to_deferred(future)
+
+
+    def imap(self, func, iterable):
+        '''
+        Generator yielding (args, Deferred) pairs in the same order as iterable,
+        where each item in iterable is the tuple of arguments for func.
+        At most self.window jobs are in flight at any time.
+        The iterable is consumed lazily, as results are being taken.
+        '''
+        pending = collections.deque()
+        try:
+            for args in iterable:
+                future = self._getExecutor().submit(func, *args)
+                pending.append((args, future, future_to_deferred(future)))
+                if len(pending) >= self.window:
+                    args, future, d = pending.popleft()
+                    yield args, d
+            while pending:
+                args, future, d = pending.popleft()
+                yield args, d
+        finally:
+            # Early exit by the consumer. Nobody is going to wait for these
+            while pending:
+                args, future, d = pending.popleft()
+                future.cancel()
+                d.addErrback(lambda failure: None)
+
+
+    def shutdown(self):
+        '''Stops the workers, cancelling the jobs not yet started. The pool can still be used afterwards'''
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    # ----------------------
+    # Private helper methods
+    # ----------------------
+
+    def _getExecutor(self):
+        if self._executor is None:
+            if self.pool_type == PROCESS_POOL:
+                start_resource_tracker()
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(PROCESS_START_METHOD))
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
@@ -29,8 +29,9 @@ from twisted.application import service
 from azotea import __version__
 from azotea.utils import get_status_code, mkdate
 from azotea.utils.camera import BAYER_PTN_LIST
+from azotea.utils.master import COMBINE_METHODS, MEDIAN
 from azotea.logger  import startLogging
-from azotea.dbase.service import DatabaseService
+from azotea.dbase.service import DatabaseService, PRAGMA_PROFILES, DEFAULT_PROFILE
 from azotool.cli.service import CommandService
 
 import azotea.consent.form
@@ -61,6 +62,7 @@ def createParser():
     parser.add_argument('-d', '--dbase',    type=str, required=True, action='store', metavar='<file path>', help='SQLite database to operate upon')
     parser.add_argument('-c', '--console', action='store_true',  help='log to console.')
     parser.add_argument('-l', '--log-file', type=str, default=None, action='store', metavar='<file path>', help='log to file')
+    parser.add_argument('--db-profile', choices=tuple(PRAGMA_PROFILES), default=DEFAULT_PROFILE, help='SQLite connection tuning profile')
     
    
     # --------------------------
@@ -218,6 +220,14 @@ def createParser():
     subparser = parser_img.add_subparsers(dest='subcommand')
 
     imgview = subparser.add_parser('summary',  help="View image summary data")
+
+    imgmst = subparser.add_parser('master',  help="Build master dark/bias frames per camera and night")
+    imgmst.add_argument('--type',       type=str, choices=('DARK','BIAS'), default='DARK', help="Calibration image type")
+    imgmst.add_argument('--method',     type=str, choices=COMBINE_METHODS, default=MEDIAN, help="Combine method")
+    imgmst.add_argument('--master-dir', type=str, default=None, action='store', metavar='<directory>', help="Master frames directory (default: 'masters' next to the database)")
+
+    imgrlp = subparser.add_parser('rollup',  help="Rebuild the summary rollup tables from the image and sky brightness tables")
+    imgrlp.add_argument('--check', action='store_true', help="Only report stale rollup rows, exiting with status 1 if any")
    
    
     return parser
@@ -272,7 +282,7 @@ startLogging(
 
 application = service.Application("azotool")
 
-dbaseService = DatabaseService(options.dbase, False)
+dbaseService = DatabaseService(options.dbase, False, profile=options.db_profile)
 dbaseService.setName(DatabaseService.NAME)
 dbaseService.setServiceParent(application)
 
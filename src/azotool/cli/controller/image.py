@@ -38,6 +38,8 @@ from azotea import DATE_SELECTION_DATE_RANGE, DATE_SELECTION_LATEST_NIGHT, DATE_
 from azotea.logger  import setLogLevel
 from azotool.cli   import NAMESPACE, log
 from azotea.utils.sky import CSV_COLUMNS, csv_postprocess
+from azotea.utils.image import night_id
+from azotea.utils.master import master_key, build_master
 
 # ----------------
 # Module constants
@@ -62,9 +64,13 @@ class ImageController:
     def __init__(self, model, config):
         self.model  = model
         self.image    = model.image
+        self.master = model.master
         self.config = config
+        self.observerCtrl = None
         setLogLevel(namespace=NAMESPACE, levelStr='info')
         pub.subscribe(self.onSummaryReq,  'image_summary_req')
+        pub.subscribe(self.onMasterReq,   'image_master_req')
+        pub.subscribe(self.onRollupReq,   'image_rollup_req')
 
 
     @inlineCallbacks
@@ -84,3 +90,57 @@ class ImageController:
         else:
             pub.sendMessage('quit')
 
+
+    @inlineCallbacks
+    def onMasterReq(self, options):
+        try:
+            observer_id, _ = yield self.observerCtrl.getDefault()
+            if not observer_id:
+                raise ValueError("No default observer defined")
+            master_dir = options.master_dir or os.path.join(os.path.dirname(os.path.abspath(options.dbase)), 'masters')
+            images = yield self.master.calibrationImages({'observer_id': observer_id, 'imagetype': options.type})
+            # Group calibration images per camera and night
+            groups = dict()
+            for camera_id, header_type, date_id, time_id, name, directory, hash in images:
+                key = (camera_id, header_type, night_id(date_id, time_id))
+                groups.setdefault(key, list()).append((os.path.join(directory, name), hash))
+            result = list()
+            for (camera_id, header_type, night), frames in sorted(groups.items()):
+                file_list = [filepath for filepath, hash in frames]
+                key  = master_key([hash for filepath, hash in frames], options.method)
+                path = os.path.join(master_dir, f"{options.type.lower()}_{camera_id}_{night}_{key}.npy")
+                log.info("Combining {n} {t} frames taken on night {night} ({method})", n=len(file_list), t=options.type, night=night, method=options.method)
+                yield deferToThread(build_master, file_list, header_type, options.method, path)
+                yield self.master.save({
+                    'key'      : key,
+                    'imagetype': options.type,
+                    'method'   : options.method,
+                    'camera_id': camera_id,
+                    'night_id' : night,
+                    'frames'   : len(file_list),
+                    'path'     : path,
+                })
+                result.append((night, camera_id, len(file_list), path))
+            headers=("Night", "Camera Id", "# Frames", "Master frame")
+            log.info("\n{t}", t=tabulate.tabulate(result, headers=headers, tablefmt='grid'))
+        except Exception as e:
+            log.failure('{e}',e=e)
+            pub.sendMessage('quit', exit_code = 1)
+        else:
+            pub.sendMessage('quit')
+
+
+    @inlineCallbacks
+    def onRollupReq(self, options):
+        try:
+            result = yield self.model.rollup.rebuild(check_only=options.check)
+            stale = sum(result.values())
+            headers=("Rollup table", "# Stale rows")
+            log.info("\n{t}", t=tabulate.tabulate(result.items(), headers=headers, tablefmt='grid'))
+            if stale and not options.check:
+                log.warn("Rebuilt {n} stale rollup rows", n=stale)
+        except Exception as e:
+            log.failure('{e}',e=e)
+            pub.sendMessage('quit', exit_code = 1)
+        else:
+            pub.sendMessage('quit', exit_code = 1 if stale and options.check else 0)
@@ -112,6 +112,9 @@ class CommandService(Service):
                 config = self.dbaseService.dao.config,
             ),
         )
+        # patch ImageController
+        self.controllers[-2].observerCtrl = self.controllers[1]
+
         # patch SkyBackgroundController
         self.controllers[-1].observerCtrl = self.controllers[1]
         self.controllers[-1].roiCtrl      = self.controllers[3]
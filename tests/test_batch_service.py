@@ -0,0 +1,155 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# Cycle scheduling of azotea batch in watch mode, driven by a fake clock:
+# polling interval, settle time after file system events and during busy
+# cycles, and retries after failed cycles.
+#
+# Usage: PYTHONPATH=src python -m twisted.trial tests
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.trial import unittest
+from twisted.internet import task, defer
+from twisted.python.filepath import FilePath
+
+# -------------------
+# Third party imports
+# -------------------
+
+from pubsub import pub
+
+#--------------
+# local imports
+# -------------
+
+from azotea.batch import service
+from azotea.batch.service import BatchService, SETTLE_TIME, INTERVAL, CYCLE_FAILED_EVENT
+from azotea.batch.controller.image import ImageController
+
+# ----------------
+# Module constants
+# ----------------
+
+START_EVENT = 'images_load_req'
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+class FailingConfig:
+    '''Configuration whose reads always fail'''
+    def load(self, section, property):
+        return defer.fail(RuntimeError('database is locked'))
+
+
+class Model:
+    image = None
+
+# ----------
+# Test cases
+# ----------
+
+class WatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(service, 'reactor', self.clock)
+        self.service = BatchService('/images', None, only_load=True, only_sky=False, only_pub=False, also_pub=False, watch=True)
+        self.service.start_event = START_EVENT
+        self.cycles = list()
+        pub.subscribe(self.onLoadReq, START_EVENT)
+
+    def tearDown(self):
+        pub.unsubscribe(self.onLoadReq, START_EVENT)
+
+    def onLoadReq(self, root_dir, depth, full_scan=False, settle=0):
+        self.cycles.append((self.clock.seconds(), settle))
+
+    def test_default_interval(self):
+        self.assertEqual(self.service.interval, INTERVAL)
+        self.assertEqual(INTERVAL, 10)
+
+    def test_settle(self):
+        self.service.startCycle()
+        self.assertEqual(self.cycles, [(0, SETTLE_TIME)])
+        self.service.watch = False
+        self.service.startCycle()
+        self.assertEqual(self.cycles[-1], (0, 0))
+
+    def test_poll_interval(self):
+        self.service.startCycle()
+        self.clock.advance(100)
+        self.service.onCycleDone()
+        self.clock.advance(INTERVAL - 1)
+        self.assertEqual(len(self.cycles), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.cycles[-1], (100 + INTERVAL, SETTLE_TIME))
+
+    def test_file_event(self):
+        self.service.startCycle()
+        self.clock.advance(100)
+        self.service.onCycleDone()
+        # A new file shortens the wait to the settle time
+        self.clock.advance(1)
+        self.service.onFileSystemEvent(None, FilePath('/images/img.CR2'), 0)
+        self.clock.advance(SETTLE_TIME)
+        self.assertEqual(self.cycles[-1], (101 + SETTLE_TIME, SETTLE_TIME))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_later_event_keeps_earlier_cycle(self):
+        self.service.scheduleCycle(SETTLE_TIME)
+        self.clock.advance(1)
+        self.service.scheduleCycle(INTERVAL)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(SETTLE_TIME - 1)
+        self.assertEqual(self.cycles, [(SETTLE_TIME, SETTLE_TIME)])
+
+    def test_event_while_busy(self):
+        self.service.startCycle()
+        self.clock.advance(1)
+        self.service.onFileSystemEvent(None, FilePath('/images/img.CR2'), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])   # Not while the cycle is running
+        self.clock.advance(100)
+        self.service.onCycleDone()
+        self.clock.advance(SETTLE_TIME)
+        self.assertEqual(self.cycles[-1], (101 + SETTLE_TIME, SETTLE_TIME))
+
+    def test_event_just_before_cycle(self):
+        # Files notified within the settle time before a cycle may have been left unsettled
+        self.service.onFileSystemEvent(None, FilePath('/images/img.CR2'), 0)
+        self.clock.advance(SETTLE_TIME)
+        self.service._last_event = self.clock.seconds() - 1
+        self.clock.advance(50)
+        self.service.onCycleDone()
+        self.clock.advance(SETTLE_TIME)
+        self.assertEqual(self.cycles[-1], (SETTLE_TIME + 50 + SETTLE_TIME, SETTLE_TIME))
+
+    def test_failed_cycle(self):
+        quits = list()
+        def quit(exit_code=0):
+            quits.append(exit_code)
+        pub.subscribe(quit, 'quit')
+        pub.subscribe(self.service.onCycleFailed, CYCLE_FAILED_EVENT)
+        controller = ImageController(Model(), FailingConfig(), next_event=None, fail_event=CYCLE_FAILED_EVENT)
+        try:
+            self.service.startCycle()
+            self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+            self.assertEqual(quits, [])
+            self.assertFalse(self.service._busy)
+            self.clock.advance(INTERVAL - 1)
+            self.assertEqual(len(self.cycles), 1)
+            self.clock.advance(1)
+            self.assertEqual(len(self.cycles), 2)
+            self.flushLoggedErrors(RuntimeError)
+        finally:
+            pub.unsubscribe(controller.onLoadReq, START_EVENT)
+            pub.unsubscribe(quit, 'quit')
+            pub.unsubscribe(self.service.onCycleFailed, CYCLE_FAILED_EVENT)
+            controller.shutdown()
@@ -0,0 +1,116 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# FingerprintTable.unchanged(): only files whose hash is still registered
+# in image_t are skipped, plus the rejected ones when asked to.
+#
+# Usage: PYTHONPATH=src python -m twisted.trial tests
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import shutil
+import tempfile
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks
+
+#--------------
+# local imports
+# -------------
+
+from azotea.dbase.service import SQLitePool
+from azotea.dbase.dao import DataAccesObject
+
+from tests.test_image_bulk import new_database, image, digest
+
+# ----------------
+# Module constants
+# ----------------
+
+NIGHT1 = '/images/night1'
+NIGHT2 = '/images/night2'
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def fingerprint(directory, name, inode, hash):
+    return {'directory': directory, 'name': name, 'size': 1000 + inode, 'mtime_ns': 10**18 + inode, 'inode': inode, 'hash': hash}
+
+# ----------
+# Test cases
+# ----------
+
+class UnchangedTestCase(unittest.TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, 'azotea.db')
+        new_database(path)
+        self.pool = SQLitePool(path)
+        self.dao  = DataAccesObject(self.pool, *(['warn'] * 7))
+        yield self.dao.image.bulkSave([
+            image('img1.fits', NIGHT1, 'A'),
+            image('img2.fits', NIGHT1, 'B'),
+            image('img3.fits', NIGHT2, 'C'),
+        ])
+        yield self.dao.fingerprint.save([
+            fingerprint(NIGHT1, 'img1.fits', 1, digest('A')),
+            fingerprint(NIGHT1, 'img2.fits', 2, digest('B')),
+            fingerprint(NIGHT1, 'gone.fits', 4, digest('D')),     # Hashed but never registered
+            fingerprint(NIGHT1, 'other.fits', 5, None),           # Rejected
+            fingerprint(NIGHT2, 'img3.fits', 3, digest('C')),
+        ])
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    @inlineCallbacks
+    def test_registered(self):
+        result = yield self.dao.fingerprint.unchanged({'directory': NIGHT1})
+        self.assertEqual(result, {
+            'img1.fits': (1001, 10**18 + 1, 1),
+            'img2.fits': (1002, 10**18 + 2, 2),
+        })
+
+    @inlineCallbacks
+    def test_rejected(self):
+        result = yield self.dao.fingerprint.unchanged({'directory': NIGHT1}, rejected=True)
+        self.assertEqual(sorted(result), ['img1.fits', 'img2.fits', 'other.fits'])
+        self.assertEqual(result['other.fits'], (1005, 10**18 + 5, 5))
+
+    @inlineCallbacks
+    def test_deleted_image(self):
+        yield self.dao.image.delete({'name': 'img2.fits', 'directory': NIGHT1})
+        result = yield self.dao.fingerprint.unchanged({'directory': NIGHT1})
+        self.assertEqual(sorted(result), ['img1.fits'])
+
+    @inlineCallbacks
+    def test_edited_in_place(self):
+        # A re-edited FITS file is hashed again under the same path
+        yield self.dao.fingerprint.save([fingerprint(NIGHT1, 'img1.fits', 6, digest('A+'))])
+        result = yield self.dao.fingerprint.unchanged({'directory': NIGHT1})
+        self.assertEqual(sorted(result), ['img2.fits'])
+        yield self.dao.image.bulkSave([image('img1.fits', NIGHT1, 'A+', session=2)])
+        result = yield self.dao.fingerprint.unchanged({'directory': NIGHT1})
+        self.assertEqual(result['img1.fits'], (1006, 10**18 + 6, 6))
+
+    @inlineCallbacks
+    def test_directory(self):
+        result = yield self.dao.fingerprint.unchanged({'directory': NIGHT2})
+        self.assertEqual(sorted(result), ['img3.fits'])
+        result = yield self.dao.fingerprint.unchanged({'directory': '/images/night3'}, rejected=True)
+        self.assertEqual(result, {})
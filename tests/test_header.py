@@ -0,0 +1,213 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# The lightweight EXIF and FITS header readers against exifread and astropy
+# on synthetic files. EXIF tags must print the same as exifread ones,
+# as exif_to_row() reads them through str(). FITS keywords must have the
+# very same values as astropy ones. Unusual headers must be handed over
+# to exifread or astropy.
+#
+# Usage: PYTHONPATH=src python -m twisted.trial tests
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import shutil
+import struct
+import tempfile
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.trial import unittest
+
+# -------------------
+# Third party imports
+# -------------------
+
+import exifread
+import numpy as np
+from astropy.io import fits
+
+#--------------
+# local imports
+# -------------
+
+from azotea.utils.header import exif_tags, fits_header, _exif_tags, _fits_header, UnusualHeaderError
+from azotea.utils.header import TIFF_TYPES, EXIF_IFD_POINTER, IFD0_TAGS, EXIF_TAGS, FITS_KEYWORDS
+
+# ----------------
+# Module constants
+# ----------------
+
+ASCII, SHORT, LONG, RATIONAL = 2, 3, 4, 5
+
+IFD0 = [
+    (0x0110, ASCII, 'Canon EOS 550D'),
+    (0x0132, ASCII, '2021:01:03 22:10:05'),
+]
+
+EXIF = [
+    (0x829A, RATIONAL, [(1, 125)]),
+    (0x829D, RATIONAL, [(28, 10)]),
+    (0x8827, SHORT,    [800]),
+    (0x920A, RATIONAL, [(50, 1)]),
+]
+
+CARDS = [
+    ('INSTRUME', 'ZWO ASI294MC'),
+    ('EXPTIME',  30.0),
+    ('DATE-OBS', '2021-01-03T22:10:05'),
+    ('LOG-GAIN', 120),
+    ('BAYERPAT', 'RGGB'),
+    ('SWCREATE', "O'Neil's capture  "),   # Embedded quotes and trailing blanks
+    ('IMAGETYP', 'Light Frame'),
+    ('PEDESTAL', 0),
+]
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def tiff_value(endian, typ, values):
+    '''Returns (count, bytes) of a TIFF tag value'''
+    if typ == ASCII:
+        data = values.encode('utf-8') + b'\x00'
+        return len(data), data
+    size, fmt = TIFF_TYPES[typ]
+    flat = [v for value in values for v in (value if len(fmt) == 2 else (value,))]
+    return len(values), struct.pack(endian + fmt[0]*len(flat), *flat)
+
+
+def tiff_file(order, ifd0, exif):
+    '''A TIFF file with an IFD0 pointing to an EXIF IFD. Entries are (tag, type, values)'''
+    endian = '<' if order == b'II' else '>'
+    exif_offset = 8 + 2 + 12*(len(ifd0)+1) + 4
+    data_offset = exif_offset + 2 + 12*len(exif) + 4
+    data = bytearray()
+    def ifd(entries):
+        result = struct.pack(endian + 'H', len(entries))
+        for tag, typ, values in sorted(entries, key=lambda entry: entry[0]):
+            count, value = tiff_value(endian, typ, values)
+            if len(value) <= 4:
+                value = value.ljust(4, b'\x00')
+            else:
+                pointer = data_offset + len(data)
+                data.extend(value)
+                value = struct.pack(endian + 'L', pointer)
+            result += struct.pack(endian + 'HHL', tag, typ, count) + value
+        return result + struct.pack(endian + 'L', 0)
+    ifd0 = ifd(ifd0 + [(EXIF_IFD_POINTER, LONG, [exif_offset])])
+    exif = ifd(exif)
+    return order + struct.pack(endian + 'HL', 42, 8) + ifd0 + exif + bytes(data)
+
+# ----------
+# Test cases
+# ----------
+
+class ExifTagsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, order, ifd0, exif):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(tiff_file(order, ifd0, exif))
+        with open(path, 'rb') as f:
+            expected = exifread.process_file(f, details=False)
+        self.assertIn('Image Model', expected)
+        return path, expected
+
+    def compare(self, result, expected):
+        for name in list(IFD0_TAGS.values()) + list(EXIF_TAGS.values()):
+            self.assertEqual(str(result.get(name)), str(expected.get(name)), name)
+
+    def test_little_endian(self):
+        path, expected = self.write('little.cr2', b'II', IFD0, EXIF)
+        with open(path, 'rb') as f:
+            self.compare(_exif_tags(f), expected)
+
+    def test_big_endian(self):
+        path, expected = self.write('big.nef', b'MM', IFD0, EXIF)
+        with open(path, 'rb') as f:
+            self.compare(_exif_tags(f), expected)
+
+    def test_rationals(self):
+        exif = [
+            (0x829A, RATIONAL, [(10, 1)]),      # Integer valued
+            (0x829D, RATIONAL, [(56, 10)]),     # Not in lowest terms
+            (0x920A, RATIONAL, [(183, 10)]),
+        ]
+        for order in (b'II', b'MM'):
+            path, expected = self.write('rational.cr2', order, IFD0, exif)
+            with open(path, 'rb') as f:
+                self.compare(_exif_tags(f), expected)
+
+    def test_iso_multi_value(self):
+        exif = [entry for entry in EXIF if entry[0] != 0x8827] + [(0x8827, SHORT, [800, 0])]
+        for order in (b'II', b'MM'):
+            path, expected = self.write('iso.cr2', order, IFD0, exif)
+            with open(path, 'rb') as f:
+                self.assertRaises(UnusualHeaderError, _exif_tags, f)
+            with open(path, 'rb') as f:
+                self.compare(exif_tags(f), expected)
+
+
+class FitsHeaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, cards):
+        path = os.path.join(self.tmpdir, name)
+        hdu = fits.PrimaryHDU(np.zeros((4, 6), dtype=np.uint16))
+        for keyword, value in cards:
+            hdu.header[keyword] = value
+        hdu.writeto(path)
+        header = fits.getheader(path)
+        return path, {keyword: header[keyword] for keyword in FITS_KEYWORDS if keyword in header}
+
+    def test_values(self):
+        path, expected = self.write('values.fits', CARDS)
+        self.assertEqual(expected['SWCREATE'], "O'Neil's capture")
+        with open(path, 'rb') as f:
+            self.assertEqual(_fits_header(f, FITS_KEYWORDS), expected)
+
+    def test_long_string(self):
+        cards = CARDS + [('SWMODIFY', 'azofits ' + 'x'*100)]
+        path, expected = self.write('long.fits', cards)
+        with open(path, 'rb') as f:
+            self.assertIn(b'CONTINUE', f.read(fits.header.BLOCK_SIZE))
+        with open(path, 'rb') as f:
+            self.assertRaises(UnusualHeaderError, _fits_header, f, FITS_KEYWORDS)
+        with open(path, 'rb') as f:
+            self.assertEqual(fits_header(f), expected)
+
+    def test_missing_end_card(self):
+        header = fits.Header([('SIMPLE', True), ('BITPIX', 16), ('NAXIS', 0)] + CARDS)
+        block = header.tostring().replace('END'.ljust(80), ' '*80)
+        path = os.path.join(self.tmpdir, 'truncated.fits')
+        with open(path, 'wb') as f:
+            f.write(block.encode('ascii'))
+        with open(path, 'rb') as f:
+            self.assertRaises(UnusualHeaderError, _fits_header, f, FITS_KEYWORDS)
+        # Handed over to astropy, that complains the same way
+        with open(path, 'rb') as f:
+            self.assertRaises(OSError, fits.getheader, f)
+        with open(path, 'rb') as f:
+            error = self.assertRaises(OSError, fits_header, f)
+        self.assertIn('END', str(error))
@@ -0,0 +1,167 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# ImageTable.bulkSave() must leave image_t exactly as the former
+# row by row saveAndFix() did, batch after batch.
+#
+# Usage: PYTHONPATH=src python -m twisted.trial tests
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import sqlite3
+import hashlib
+import tempfile
+import shutil
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks
+
+#--------------
+# local imports
+# -------------
+
+from azotea import SQL_SCHEMA, SQL_INITIAL_DATA_DIR, SQL_UPDATES_DATA_DIR
+from azotea.utils.database import create_database, create_schema
+from azotea.dbase.service import SQLitePool
+from azotea.dbase.dao import DataAccesObject
+from azotea.dbase.image import INSERTED, RELOCATED, DUPLICATE, DISCARDED
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def digest(content):
+    return hashlib.blake2b(content.encode(), digest_size=32).digest()
+
+
+def image(name, directory, content, session=1):
+    return {
+        'name'        : name,
+        'directory'   : directory,
+        'hash'        : digest(content),
+        'iso'         : '800',
+        'gain'        : None,
+        'exptime'     : 60.0,
+        'focal_length': 50.0,
+        'f_number'    : 2.8,
+        'session'     : session,
+        'imagetype'   : 'LIGHT',
+        'flagged'     : 0,
+        'date_id'     : 20210103,
+        'time_id'     : 223000,
+        'camera_id'   : 1,
+        'observer_id' : 1,
+        'location_id' : 1,
+        'night_id'    : 20210103,
+        'month_id'    : 202101,
+    }
+
+
+def new_database(path):
+    connection, _ = create_database(path)
+    create_schema(connection, SQL_SCHEMA, SQL_INITIAL_DATA_DIR, SQL_UPDATES_DATA_DIR)
+    connection.executescript('''
+        INSERT INTO camera_t (camera_id, model, extension, header_type, bayer_pattern, bias)
+        VALUES (1, 'Test', '.fits', 'FITS', 'RGGB', 0);
+        INSERT INTO observer_t (observer_id, family_name, surname, affiliation, acronym, valid_since, valid_until, valid_state)
+        VALUES (1, 'Doe', 'John', 'None', 'NONE', '2000-01-01T00:00:00', '2999-12-31T23:59:59', 'Current');
+        INSERT INTO location_t (location_id, site_name, location) VALUES (1, 'Home', 'Somewhere');
+    ''')
+    connection.commit()
+    connection.close()
+
+
+def image_rows(path):
+    connection = sqlite3.connect(path)
+    rows = connection.execute('SELECT * FROM image_t ORDER BY image_id').fetchall()
+    connection.close()
+    return rows
+
+
+@inlineCallbacks
+def save_row_by_row(table, save_list):
+    '''The former ImageController.saveAndFix(), without its log messages'''
+    try:
+        yield table.save(save_list)
+    except sqlite3.IntegrityError:
+        for row in save_list:
+            try:
+                yield table.save(row)
+            except sqlite3.IntegrityError:
+                name, directory = yield table.getByHash(row)
+                if row['name'] == name and row['directory'] != directory:
+                    yield table.fixDirectory(row)
+
+# ----------
+# Test cases
+# ----------
+
+class BulkSaveTestCase(unittest.TestCase):
+
+    BATCHES = (
+        # New images, with hashes repeated within the same batch
+        [
+            image('img1.fits', '/images/night1', 'A'),
+            image('img2.fits', '/images/night1', 'B'),
+            image('img3.fits', '/images/night1', 'C'),
+            image('img1.fits', '/images/night1', 'A'),   # Listed twice
+            image('copy.fits', '/images/night1', 'B'),   # Copy under another name
+            image('img3.fits', '/images/moved',  'C'),   # Moved while loading
+        ],
+        # Images moved to another directory, copied and brand new
+        [
+            image('img1.fits', '/images/night2', 'A', session=2),
+            image('img2.fits', '/images/night1', 'B', session=2),
+            image('other.fits', '/images/night2', 'B', session=2),
+            image('img4.fits', '/images/night2', 'D', session=2),
+        ],
+        # FITS files re-edited in place get a new hash under the same path
+        [
+            image('img2.fits', '/images/night1', 'B+', session=3),
+            image('img4.fits', '/images/night2', 'D+', session=3),
+            image('img4.fits', '/images/night2', 'D+', session=3),
+        ],
+    )
+
+    OUTCOMES = (
+        [INSERTED, INSERTED, INSERTED, DUPLICATE, DISCARDED, RELOCATED],
+        [RELOCATED, DUPLICATE, DISCARDED, INSERTED],
+        [INSERTED, INSERTED, DUPLICATE],
+    )
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pools = dict()
+        self.daos  = dict()
+        for name in ('row', 'bulk'):
+            path = os.path.join(self.tmpdir, f"{name}.db")
+            new_database(path)
+            self.pools[name] = SQLitePool(path)
+            self.daos[name]  = DataAccesObject(self.pools[name], *(['warn'] * 7))
+
+    def tearDown(self):
+        for pool in self.pools.values():
+            pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    @inlineCallbacks
+    def test_same_images_as_row_by_row(self):
+        for batch, outcomes in zip(self.BATCHES, self.OUTCOMES):
+            yield save_row_by_row(self.daos['row'].image, [dict(row) for row in batch])
+            report = yield self.daos['bulk'].image.bulkSave([dict(row) for row in batch])
+            self.assertEqual([outcome for _, _, outcome, *_ in report], outcomes)
+            self.assertEqual(
+                image_rows(os.path.join(self.tmpdir, 'bulk.db')),
+                image_rows(os.path.join(self.tmpdir, 'row.db'))
+            )
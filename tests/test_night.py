@@ -0,0 +1,103 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# night_id and month_id computed in Python for new images against the
+# SQL back-fill of migration 10 for already registered ones, on timestamps
+# around noon, midnight, month ends, a leap day and a year end.
+#
+# Usage: PYTHONPATH=src python -m twisted.trial tests
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import shutil
+import sqlite3
+import datetime
+import tempfile
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.trial import unittest
+
+#--------------
+# local imports
+# -------------
+
+from azotea import SQL_SCHEMA, SQL_INITIAL_DATA_DIR, SQL_UPDATES_DATA_DIR
+from azotea.utils.database import create_database, create_schema
+from azotea.utils.image import exif_to_row
+
+# ----------------
+# Module constants
+# ----------------
+
+DAYS = ('2019-12-31', '2020-01-01', '2020-02-28', '2020-02-29', '2020-03-01', '2021-02-28', '2021-03-01', '2021-06-30', '2021-07-01')
+
+TIMES = ('00:00:00', '05:30:15', '11:59:59', '12:00:00', '12:00:01', '18:45:00', '23:59:59')
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def backfill_statements():
+    '''The UPDATE statements of migration 10'''
+    with open(os.path.join(SQL_UPDATES_DATA_DIR, '10_night.sql')) as f:
+        lines = f.readlines()
+    statements = list(); statement = ''
+    for line in lines:
+        if line.startswith('--'):
+            continue
+        statement += line
+        if sqlite3.complete_statement(statement):
+            if statement.strip().startswith('UPDATE'):
+                statements.append(statement)
+            statement = ''
+    return statements
+
+
+def python_row(day, time):
+    '''Image row as computed at registration time'''
+    exif = {'Image Model': 'Synthetic', 'Image DateTime': f"{day.replace('-',':')} {time}"}
+    return exif_to_row(exif, {'def_fl': 50, 'def_fn': 2.8})
+
+# ----------
+# Test cases
+# ----------
+
+class NightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.connection, _ = create_database(os.path.join(self.tmpdir, 'azotea.db'))
+        create_schema(self.connection, SQL_SCHEMA, SQL_INITIAL_DATA_DIR, SQL_UPDATES_DATA_DIR)
+        self.connection.execute('PRAGMA foreign_keys=OFF')
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_backfill(self):
+        rows = [python_row(day, time) for day in DAYS for time in TIMES]
+        self.connection.executemany('''
+            INSERT INTO image_t (name, directory, session, date_id, time_id, camera_id, location_id, observer_id)
+            VALUES (:name, '/images', 1, :date_id, :time_id, 1, 1, 1)
+            ''', [dict(row, name=f"IMG_{i:04d}.CR2") for i, row in enumerate(rows)])
+        statements = backfill_statements()
+        self.assertEqual(len(statements), 2)
+        for sql in statements:
+            self.connection.execute(sql)
+        backfilled = self.connection.execute('SELECT night_id, month_id FROM image_t ORDER BY name').fetchall()
+        self.assertEqual(backfilled, [(row['night_id'], row['month_id']) for row in rows])
+
+    def test_month_is_calendar_month(self):
+        row = python_row('2021-03-01', '05:30:15')
+        self.assertEqual(row['night_id'], 20210228)     # The night began on the previous day
+        self.assertEqual(row['month_id'], 202103)       # But the image was taken in March
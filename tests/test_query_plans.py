@@ -0,0 +1,202 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# Query plan regression check of the SQL statements in azotea/dbase/*.py.
+# Builds a synthetic database with the current schema, runs EXPLAIN QUERY PLAN
+# on every statement and fails if any of them does a full scan
+# of a large table, unless listed in FULL_SCANS_ALLOWED
+#
+# Usage: PYTHONPATH=src python -m twisted.trial tests
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import re
+import ast
+import glob
+import shutil
+import fnmatch
+import sqlite3
+import inspect
+import tempfile
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.trial import unittest
+
+#--------------
+# local imports
+# -------------
+
+import azotea.dbase
+from azotea import SQL_SCHEMA, SQL_INITIAL_DATA_DIR, SQL_UPDATES_DATA_DIR
+from azotea.utils.database import create_database, create_schema
+from azotea.dbase.dao import DataAccesObject
+from azotea.dbase.tables import Table
+
+# ----------------
+# Module constants
+# ----------------
+
+SQL_KEYWORDS = ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')
+
+IMAGES = 2000   # Synthetic images. Plans without ANALYZE statistics do not depend on it
+ROIS   = 2      # Measured ROIs per image
+
+# Tables growing with the number of images
+LARGE_TABLES = ('image_t', 'sky_brightness_t', 'sky_histogram_t', 'sky_tiles_t', 'fingerprint_t', 'directory_t')
+
+# Statements that must visit every row anyway, by statement name pattern
+FULL_SCANS_ALLOWED = {
+    'image.ImageTable.purgeDuplicates'    : 'Groups every image by path',
+    'dao.*._sqlReadEntries'               : 'Reads the whole table',
+    'dao.*._sqlNaturalKeys'               : 'Reads the whole table',
+}
+
+PARAMETER = re.compile(r'(?<![:\w]):(\w+)')
+
+ALIAS = re.compile(r'\b(' + '|'.join(LARGE_TABLES) + r')\s+(?:AS\s+)?(\w+)', re.IGNORECASE)
+
+SQL_RESERVED = ('WHERE', 'JOIN', 'LEFT', 'INNER', 'CROSS', 'USING', 'ON', 'SET', 'GROUP', 'ORDER', 'LIMIT', 'VALUES', 'WITH', 'SELECT', 'AND', 'OR', 'UNION', 'EXCEPT', 'INTERSECT', 'NATURAL')
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def sql_statements():
+    '''
+    Yields (name, sql) for every plain string SQL statement in azotea/dbase/*.py, named as module.Class.method,
+    followed by the statements built at run time by the DAO tables, named as dao.table.method
+    '''
+    directory = os.path.dirname(azotea.dbase.__file__)
+    for path in sorted(glob.glob(os.path.join(directory, '*.py'))):
+        module = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as f:
+            tree = ast.parse(f.read())
+        yield from _statements(tree, [module])
+    dao = DataAccesObject(None, *(['info'] * 7))
+    for attribute, table in sorted(vars(dao).items()):
+        if isinstance(table, Table):
+            for method in sorted(dir(table)):
+                func = getattr(table, method)
+                if method.startswith('_sql') and not inspect.signature(func).parameters:
+                    yield f"dao.{attribute}.{method}", func()
+    roi_ids = [1, 2]
+    yield 'dao.sky.pendingCount', dao.sky._sqlPending(roi_ids, 'count(DISTINCT i.image_id)')
+    yield 'dao.sky.pendingWithMetadata', dao.sky._sqlPendingWithMetadata(roi_ids)
+
+
+def _statements(node, scope):
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, (ast.ClassDef, ast.FunctionDef)):
+            # Nested helper functions belong to their method
+            yield from _statements(child, scope + [child.name] if len(scope) < 3 else scope)
+        elif isinstance(child, (ast.JoinedStr, ast.Expr)):
+            continue    # f-string fragments and docstrings
+        elif isinstance(child, ast.Constant) and isinstance(child.value, str):
+            sql = child.value.strip()
+            if sql.upper().startswith(SQL_KEYWORDS):
+                yield '.'.join(scope), sql
+        else:
+            yield from _statements(child, scope)
+
+
+def synthetic_database(path, images, rois):
+    connection, _ = create_database(path)
+    create_schema(connection, SQL_SCHEMA, SQL_INITIAL_DATA_DIR, SQL_UPDATES_DATA_DIR)
+    connection.executescript(f'''
+        INSERT INTO camera_t (camera_id, model, extension, header_type, bayer_pattern, width, length, bias)
+        VALUES (1, 'Synthetic', '.NEF', 'EXIF', 'RGGB', 6000, 4000, 0);
+        INSERT INTO observer_t (observer_id, family_name, surname, affiliation, acronym, valid_since, valid_until, valid_state)
+        VALUES (1, 'Doe', 'John', 'None', 'NONE', '2000-01-01T00:00:00', '2999-12-31T23:59:59', 'Current');
+        INSERT INTO location_t (location_id, site_name, location) VALUES (1, 'Home', 'Somewhere');
+        INSERT INTO roi_t (roi_id, x1, y1, x2, y2, display_name)
+            WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n+1 FROM seq WHERE n < {rois})
+            SELECT n, 10*n, 10*n, 500+10*n, 400+10*n, 'ROI ' || n FROM seq;
+        INSERT INTO image_t (image_id, name, directory, hash, exptime, imagetype, flagged, session,
+            date_id, time_id, camera_id, location_id, observer_id, night_id, month_id)
+            WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n+1 FROM seq WHERE n < {images})
+            SELECT n, printf('IMG_%06d.NEF', n), printf('/images/night_%05d', n/100), randomblob(32), 60, 'LIGHT', 0, 1,
+                CAST(strftime('%Y%m%d', '2020-01-01', (n/100) || ' days') AS INTEGER),
+                CAST(printf('%02d%02d00', (n/60)%24, n%60) AS INTEGER), 1, 1, 1,
+                CAST(strftime('%Y%m%d', '2020-01-01', (n/100) || ' days') AS INTEGER),
+                CAST(strftime('%Y%m', '2020-01-01', (n/100) || ' days') AS INTEGER)
+            FROM seq;
+        INSERT INTO sky_brightness_t (image_id, roi_id, aver_signal_R, published)
+            SELECT image_id, roi_id, 2048.0, image_id < {images//2} FROM image_t JOIN roi_t;
+        INSERT INTO fingerprint_t (directory, name, size, mtime_ns, inode, hash)
+            SELECT directory, name, 0, 0, image_id, hash FROM image_t;
+        CREATE TEMP TABLE image_staging_t AS SELECT 0 AS seq, * FROM image_t WHERE 0;
+    ''')
+    connection.commit()
+    return connection
+
+
+def parameters(sql):
+    if '?' in sql:
+        return (None,) * sql.count('?')
+    return {name: None for name in PARAMETER.findall(sql)}
+
+
+def aliases(sql):
+    '''Large tables by their names and aliases in a statement'''
+    result = {table: table for table in LARGE_TABLES}
+    for table, alias in ALIAS.findall(sql):
+        if alias.upper() not in SQL_RESERVED:
+            result[alias] = table
+    return result
+
+
+def full_scans(plan, tables):
+    '''Large tables fully scanned in a query plan. Scans through an index are not counted'''
+    result = list()
+    for *_, detail in plan:
+        match = re.match(r'SCAN (\w+)(.*)', detail)
+        if match and 'INDEX' not in match.group(2) and match.group(1) in tables:
+            result.append(tables[match.group(1)])
+    return result
+
+
+# ----------
+# Test cases
+# ----------
+
+class QueryPlanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.connection = synthetic_database(os.path.join(self.tmpdir, 'azotea.db'), IMAGES, ROIS)
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_no_full_scans(self):
+        # Tables in views are shown with the aliases used in their definitions
+        views = ' '.join(sql for (sql,) in self.connection.execute("SELECT sql FROM sqlite_master WHERE type = 'view'"))
+        failures = list(); checked = 0
+        for name, sql in sql_statements():
+            try:
+                plan = self.connection.execute('EXPLAIN QUERY PLAN ' + sql, parameters(sql)).fetchall()
+            except sqlite3.Error:
+                continue    # Temporary tables and the like
+            checked += 1
+            scans = full_scans(plan, aliases(sql + ' ' + views))
+            allowed = any(fnmatch.fnmatchcase(name, pattern) for pattern in FULL_SCANS_ALLOWED)
+            if scans and not allowed:
+                failures.append(f"{name}: full scan of {', '.join(scans)}\n" + '\n'.join(f"     {detail}" for *_, detail in plan))
+        self.assertGreater(checked, 100)
+        self.assertEqual(failures, [], '\n' + '\n'.join(failures))
+
+    def test_full_scan_detected(self):
+        sql = 'SELECT i.name FROM image_t AS i JOIN sky_brightness_t AS s USING(image_id) WHERE i.exptime = :exptime'
+        plan = self.connection.execute('EXPLAIN QUERY PLAN ' + sql, parameters(sql)).fetchall()
+        self.assertEqual(full_scans(plan, aliases(sql)), ['image_t'])
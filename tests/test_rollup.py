@@ -0,0 +1,149 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# The triggers maintaining image_rollup_t and sky_rollup_t against
+# Rollup.rebuild(check_only=True), after every kind of change made
+# to image_t and sky_brightness_t.
+#
+# Usage: PYTHONPATH=src python -m twisted.trial tests
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import sqlite3
+import shutil
+import tempfile
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks
+
+#--------------
+# local imports
+# -------------
+
+from azotea.dbase.service import SQLitePool
+from azotea.dbase.dao import DataAccesObject
+
+from tests.test_image_bulk import new_database, image
+
+# ----------------
+# Module constants
+# ----------------
+
+CONSISTENT = {'image_rollup_t': 0, 'sky_rollup_t': 0}
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def night_image(name, content, observer_id, night_id, imagetype='LIGHT', session=1):
+    row = image(name, f"/images/{night_id}", content, session)
+    row.update(observer_id=observer_id, night_id=night_id, date_id=night_id, month_id=night_id // 100, imagetype=imagetype)
+    return row
+
+
+def sky_row(image_id, roi_id):
+    row = {f'{kind}_signal_{channel}': 1.0 for kind in ('aver', 'vari') for channel in ('R', 'G1', 'G2', 'B')}
+    row.update(image_id=image_id, roi_id=roi_id)
+    return row
+
+# ----------
+# Test cases
+# ----------
+
+class RollupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, 'azotea.db')
+        new_database(path)
+        connection = sqlite3.connect(path)
+        connection.executescript('''
+            INSERT INTO observer_t (observer_id, family_name, surname, affiliation, acronym, valid_since, valid_until, valid_state)
+            VALUES (2, 'Roe', 'Jane', 'None', 'NONE', '2000-01-01T00:00:00', '2999-12-31T23:59:59', 'Current');
+            INSERT INTO roi_t (roi_id, x1, y1, x2, y2, display_name) VALUES (1, 0, 0, 100, 80, 'ROI 1'), (2, 10, 10, 50, 40, 'ROI 2');
+        ''')
+        connection.commit()
+        connection.close()
+        self.pool = SQLitePool(path)
+        self.dao  = DataAccesObject(self.pool, *(['warn'] * 7))
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def execute(self, sql, params=()):
+        def _execute(txn, sql, params):
+            txn.execute(sql, params)
+        return self.pool.runInteraction(_execute, sql, params)
+
+    @inlineCallbacks
+    def check(self, images, measurements):
+        '''The rollup tables agree with the base tables, which are not empty'''
+        result = yield self.dao.rollup.rebuild(check_only=True)
+        self.assertEqual(result, CONSISTENT)
+        def _totals(txn):
+            txn.execute('SELECT (SELECT TOTAL(images) FROM image_rollup_t), (SELECT TOTAL(measurements) FROM sky_rollup_t)')
+            return txn.fetchone()
+        totals = yield self.pool.runReadInteraction(_totals)
+        self.assertEqual(totals, (images, measurements))
+
+    @inlineCallbacks
+    def test_triggers(self):
+        yield self.dao.image.bulkSave([
+            night_image('img1.fits', 'A', 1, 20210103),
+            night_image('img2.fits', 'B', 1, 20210103),
+            night_image('dark.fits', 'C', 1, 20210103, imagetype='DARK'),
+            night_image('img3.fits', 'D', 1, 20210104),
+            night_image('img4.fits', 'E', 2, 20210104),
+        ])
+        yield self.check(5, 0)
+        yield self.dao.sky.save([sky_row(image_id, roi_id) for image_id in range(1, 6) for roi_id in (1, 2)])
+        yield self.check(5, 10)
+        # Image classification changes
+        yield self.dao.image.flagAsBad({'image_id': 2})
+        yield self.execute("UPDATE image_t SET imagetype = 'LIGHT' WHERE image_id = 3")
+        yield self.check(5, 10)
+        # Publishing
+        yield self.execute("UPDATE sky_brightness_t SET published = 1 WHERE image_id <= 2")
+        yield self.check(5, 10)
+        # Images moved to another night or observer take their measurements along
+        yield self.execute("UPDATE image_t SET night_id = 20210102, date_id = 20210102 WHERE image_id = 1")
+        yield self.execute("UPDATE image_t SET observer_id = 2 WHERE image_id = 4")
+        yield self.check(5, 10)
+        # Deletions
+        yield self.dao.sky.deleteLatestNight({'observer_id': 1})
+        yield self.check(5, 6)
+        yield self.dao.sky.deleteUnpublished({'observer_id': 2})
+        yield self.check(5, 2)
+        yield self.execute("DELETE FROM sky_brightness_t WHERE image_id = 1 AND roi_id = 2")
+        yield self.execute("DELETE FROM image_t WHERE image_id = 5")
+        yield self.check(4, 1)
+        # FITS images edited in place, registered again and purged
+        yield self.dao.image.bulkSave([night_image('img3.fits', 'D+', 1, 20210104, session=2)])
+        yield self.check(5, 1)
+        yield self.dao.image.purgeDuplicates()
+        yield self.check(4, 1)
+
+    @inlineCallbacks
+    def test_stale_rollup(self):
+        yield self.dao.image.bulkSave([night_image('img1.fits', 'A', 1, 20210103), night_image('img2.fits', 'B', 2, 20210103)])
+        yield self.execute("UPDATE image_rollup_t SET images = images + 1 WHERE observer_id = 1")
+        yield self.execute("DELETE FROM image_rollup_t WHERE observer_id = 2")
+        result = yield self.dao.rollup.rebuild(check_only=True)
+        self.assertEqual(result, {'image_rollup_t': 3, 'sky_rollup_t': 0})
+        # Only checked, not fixed
+        result = yield self.dao.rollup.rebuild(check_only=True)
+        self.assertEqual(result['image_rollup_t'], 3)
+        yield self.dao.rollup.rebuild()
+        yield self.check(2, 0)
@@ -0,0 +1,132 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# Streaming directory walker: listed files and directory summaries,
+# and leaf directories skipped while unchanged since the last scan.
+#
+# Usage: PYTHONPATH=src python -m twisted.trial tests
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import shutil
+import tempfile
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.trial import unittest
+
+#--------------
+# local imports
+# -------------
+
+from azotea.utils.image import scan_images
+
+# ----------------
+# Module constants
+# ----------------
+
+EXTENSION = '.CR2'
+
+# root
+# |-- night1            leaf
+# |-- night2            leaf
+# `-- season
+#     `-- night3        leaf
+FILES = (
+    'night1/IMG_0001.CR2',
+    'night1/IMG_0002.CR2',
+    'night1/IMG_0002.JPG',      # Another extension
+    'night1/.IMG_0003.CR2',     # Hidden file
+    'night2/IMG_0004.CR2',
+    'season/notes.txt',
+    'season/night3/IMG_0005.CR2',
+)
+
+# ----------
+# Test cases
+# ----------
+
+class ScanImagesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in FILES:
+            path = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('raw')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, directory):
+        return os.path.join(self.root, directory) if directory else self.root
+
+    def scan(self, depth=None, index=None):
+        '''Returns a dictionary directory => ((mtime_ns, entries, subdirs), file names) relative to the root'''
+        result = dict()
+        for directory, summary, file_list in scan_images(self.root, EXTENSION, depth, index):
+            self.assertTrue(all(os.path.dirname(path) == directory for path in file_list))
+            result[os.path.relpath(directory, self.root)] = (summary, [os.path.basename(path) for path in file_list])
+        return result
+
+    def index(self, scanned):
+        '''The directory index as loaded from directory_t'''
+        return {self.path(directory): summary for directory, (summary, _) in scanned.items()}
+
+    def touch(self, directory, name):
+        path = os.path.join(self.path(directory), name)
+        with open(path, 'w') as f:
+            f.write('raw')
+        # A distinct directory mtime even on coarse timestamp file systems
+        mtime_ns = os.stat(self.path(directory)).st_mtime_ns + 1000000000
+        os.utime(self.path(directory), ns=(mtime_ns, mtime_ns))
+
+    def test_full_scan(self):
+        scanned = self.scan()
+        self.assertEqual(sorted(scanned), ['.', 'night1', 'night2', 'season', 'season/night3'])
+        self.assertEqual(scanned['night1'][1], ['IMG_0001.CR2', 'IMG_0002.CR2'])
+        self.assertEqual(scanned['season'][1], [])
+        self.assertEqual(scanned['season/night3'][1], ['IMG_0005.CR2'])
+        # (mtime_ns, entries, subdirs)
+        self.assertEqual(scanned['.'][0], (os.stat(self.root).st_mtime_ns, 3, 3))
+        self.assertEqual(scanned['night1'][0][1:], (4, 0))
+        self.assertEqual(scanned['season'][0][1:], (2, 1))
+
+    def test_unchanged_leaves_skipped(self):
+        index = self.index(self.scan())
+        # Directories with subdirectories are always listed to reach their leaves
+        self.assertEqual(sorted(self.scan(index=index)), ['.', 'season'])
+
+    def test_changed_leaves_listed(self):
+        index = self.index(self.scan())
+        self.touch('night2', 'IMG_0006.CR2')
+        self.touch('season/night3', 'IMG_0007.CR2')
+        scanned = self.scan(index=index)
+        self.assertEqual(sorted(scanned), ['.', 'night2', 'season', 'season/night3'])
+        self.assertEqual(scanned['night2'][1], ['IMG_0004.CR2', 'IMG_0006.CR2'])
+        self.assertEqual(scanned['season/night3'][1], ['IMG_0005.CR2', 'IMG_0007.CR2'])
+
+    def test_leaf_getting_subdirectories(self):
+        index = self.index(self.scan())
+        os.mkdir(os.path.join(self.root, 'night1', 'flats'))
+        self.assertIn('night1/flats', self.scan(index=index))
+
+    def test_partial_index(self):
+        # Directories not indexed yet, as those with unsettled images
+        index = self.index(self.scan())
+        del index[self.path('night1')]
+        self.assertEqual(sorted(self.scan(index=index)), ['.', 'night1', 'season'])
+
+    def test_depth(self):
+        self.assertEqual(sorted(self.scan(depth=0)), ['.'])
+        self.assertEqual(sorted(self.scan(depth=1)), ['.', 'night1', 'night2', 'season'])
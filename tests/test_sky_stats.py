@@ -0,0 +1,109 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# The single pass CFA statistics kernel read through processImageROIs()
+# against the former per channel numpy mean() and var() over the whole
+# scaled FITS frame.
+#
+# Tolerance: integer frames (uint16 with BZERO, int16) must give the very
+# same stored values. float32 frames may differ by one rounding step of
+# the stored values, as numpy accumulates float32 arrays in float32 while
+# the kernel does it in float64: 0.1 for averages, 0.001 plus 1e-6
+# relative for variances.
+#
+# Usage: PYTHONPATH=src python -m twisted.trial tests
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import shutil
+import tempfile
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.trial import unittest
+
+# -------------------
+# Third party imports
+# -------------------
+
+import numpy as np
+from astropy.io import fits
+
+#--------------
+# local imports
+# -------------
+
+from azotea import FITS_HEADER_TYPE
+from azotea.utils.sky import CFA_OFFSETS, processImageROIs
+
+# ----------------
+# Module constants
+# ----------------
+
+CHANNELS = ('R', 'G1', 'G2', 'B')
+
+FRAME_SHAPE = (240, 300)   # Raw pixels
+
+ROIS = (
+    {'x1': 10, 'y1': 20, 'x2': 110, 'y2': 100},
+    {'x1':  0, 'y1':  0, 'x2': 150, 'y2': 120},   # The whole frame
+)
+
+SEEDS = range(10)
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def old_region_stats(raw_pixels, bayer_pattern, channel, roi):
+    '''The former region_stats()'''
+    x, y = CFA_OFFSETS[bayer_pattern][channel]['x'], CFA_OFFSETS[bayer_pattern][channel]['y']
+    section = raw_pixels[y::2, x::2][roi['y1']:roi['y2'], roi['x1']:roi['x2']]
+    return round(section.mean(),1), round(section.var(),3)
+
+# ----------
+# Test cases
+# ----------
+
+class CFAStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def compare(self, make_frame, bayer_pattern, aver_tol, vari_tol, vari_rel_tol):
+        for seed in SEEDS:
+            rng  = np.random.default_rng(seed)
+            name = f"frame{seed}.fits"
+            fits.PrimaryHDU(make_frame(rng)).writeto(os.path.join(self.tmpdir, name))
+            with fits.open(os.path.join(self.tmpdir, name)) as hdu_list:
+                raw_pixels = hdu_list[0].data
+                expected = [{channel: old_region_stats(raw_pixels, bayer_pattern, channel, roi) for channel in CHANNELS} for roi in ROIS]
+            rows = processImageROIs(name, self.tmpdir, ROIS, FITS_HEADER_TYPE, bayer_pattern, [dict() for roi in ROIS])
+            for row, stats in zip(rows, expected):
+                for channel, (average, variance) in stats.items():
+                    self.assertLessEqual(abs(row[f'aver_signal_{channel}'] - average), aver_tol, (seed, channel))
+                    self.assertLessEqual(abs(row[f'vari_signal_{channel}'] - variance), vari_tol + vari_rel_tol*variance, (seed, channel))
+
+    def test_uint16_bzero(self):
+        path = os.path.join(self.tmpdir, 'bzero.fits')
+        fits.PrimaryHDU(np.zeros((2,2), dtype=np.uint16)).writeto(path)
+        self.assertEqual(fits.getheader(path)['BZERO'], 32768)   # Stored as int16
+        self.compare(lambda rng: rng.normal(2048, 50, FRAME_SHAPE).astype(np.uint16), 'RGGB', 0, 0, 0)
+
+    def test_int16(self):
+        self.compare(lambda rng: rng.normal(100, 300, FRAME_SHAPE).astype(np.int16), 'GBRG', 0, 0, 0)
+
+    def test_float32(self):
+        self.compare(lambda rng: rng.normal(2048.3, 50, FRAME_SHAPE).astype(np.float32), 'BGGR', 0.1 + 1e-9, 0.001 + 1e-9, 1e-6)
@@ -0,0 +1,83 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+# Sky statistics cache lookups: hits and misses in key order, whatever
+# the order and repetitions of the keys, on every key column.
+#
+# Usage: PYTHONPATH=src python -m twisted.trial tests
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import shutil
+import tempfile
+
+# ---------------
+# Twisted imports
+# ---------------
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks
+
+#--------------
+# local imports
+# -------------
+
+from azotea.utils.sky import STATS_VERSION, STATS_COLUMNS
+from azotea.dbase.cache import StatsCache, cache_key
+
+# ----------------
+# Module constants
+# ----------------
+
+ROI = {'x1': 10, 'y1': 20, 'x2': 110, 'y2': 100}
+
+# ------------------------
+# Module Utility Functions
+# ------------------------
+
+def stats(value):
+    return {column: value + i for i, column in enumerate(STATS_COLUMNS)}
+
+# ----------
+# Test cases
+# ----------
+
+class StatsCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache  = StatsCache(os.path.join(self.tmpdir, 'cache.db'))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    @inlineCallbacks
+    def test_lookup(self):
+        keys = [cache_key(bytes([i])*32, ROI, 'RGGB') for i in range(10)]
+        yield self.cache.save([dict(key, **stats(100*i)) for i, key in enumerate(keys) if i % 2 == 0])
+        # Keys differing in a single column
+        other_roi     = cache_key(keys[0]['hash'], dict(ROI, x2=112), 'RGGB')
+        other_pattern = cache_key(keys[0]['hash'], ROI, 'BGGR')
+        other_version = dict(keys[0], version=STATS_VERSION - 1)
+        # Extra columns in the keys, as sky background rows carry them
+        lookup = [dict(key, roi_id=1, image_id=i) for i, key in reversed(list(enumerate(keys)))]
+        lookup += [keys[4], other_roi, other_pattern, other_version, keys[4]]
+        result = yield self.cache.lookup(lookup)
+        expected  = [stats(100*i) if i % 2 == 0 else None for i in reversed(range(10))]
+        expected += [stats(400), None, None, None, stats(400)]
+        self.assertEqual(result, expected)
+
+    @inlineCallbacks
+    def test_empty(self):
+        result = yield self.cache.lookup([])
+        self.assertEqual(result, [])
+        result = yield self.cache.lookup([cache_key(b'\x00'*32, ROI, 'RGGB')])
+        self.assertEqual(result, [None])